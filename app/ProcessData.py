@@ -10,322 +10,490 @@
 
 
 import os
-import io
 import sys
-import pickle
 import datetime
 import pathlib
 from getopt import getopt
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
 import numpy as np
 import pandas as pd
 import psycopg2 as dblib
 
-from data_processing import LineCorrection, LineDetection
-from utils.TimeMeasure import Measure
+from data_processing import Distance, LineCorrection, LineDetection, Simplification
+from data_access import BusCache, BusData, LineData
+from utils.TimeMeasure import METRIC_EXTENSIONS, Measure
+from utils.Checkpoint import Checkpoint, ConfigFingerprint, Fingerprint
 from utils.logger import logger
 from utils.Parser import parse_args
 
-def main():
-	# --------------------------------
-	# Setup phase
-	# --------------------------------
-	performanceData = dict()
-	mes = Measure("performance.txt")
-
-	# Parse configurations and parameters, sets logger and global variables
-	CONFIGS = ConfigParser()
-
-	busFilter = None
-	lineFilter = None
-	desiredDate = None
-
-	args = parse_args()
-
-	# Sets logging details
-	log = logger(args.verbose)
-
-	argsReturned = vars(args).keys()
-
-	# sets configuration options
-	configPath = pathlib.Path("/run/secrets")
-	if (configPath / 'main_configurations').exists():
-			CONFIGS.read(configPath / 'main_configurations')
-
-	if args.config:
-		if not args.config.exists():
-			log.critical(f"Configuration file at {args.config.absolute()} does not exits")
+def ReadFilter(path):
+	"""
+	Returns the set of identifiers listed in a whitelist/blacklist file, ignoring empty and commented lines
+	"""
+	with open(path,"r") as filterFile:
+		return set([i for i in filterFile.read().split("\n") if len(i) > 0 and i[0] != '#'])
+
+
+def OverrideConfigs(CONFIGS,args):
+	"""
+	Sets the configurations given on the command line (--backend, --max-memory, --overlap) over the ones read from files
+	"""
+	if args.backend:
+		if not CONFIGS.has_section('default_correction_method'):
+			CONFIGS.add_section('default_correction_method')
+		CONFIGS['default_correction_method']['backend'] = args.backend
+
+	if args.max_memory:
+		if not CONFIGS.has_section('default_correction_method'):
+			CONFIGS.add_section('default_correction_method')
+		CONFIGS['default_correction_method']['maxMemoryMBytes'] = str(args.max_memory)
+
+	if args.overlap is not None:
+		if not CONFIGS.has_section('data_acquisition'):
+			CONFIGS.add_section('data_acquisition')
+		CONFIGS['data_acquisition']['overlapMinutes'] = str(args.overlap)
+
+
+def DateRange(args,log):
+	"""
+	Returns the list of dates to be processed, from either --date or --start-date/--end-date (inclusive).
+	The incremental mode defaults to the current date
+	"""
+	if args.incremental:
+		if args.start_date or args.end_date:
+			log.critical("Incremental mode processes a single date, --start-date/--end-date cannot be used")
 			exit(1)
-		CONFIGS.read(args.config)
-
-	desiredDate = args.date    
-
-	# Get execution parameters
-	if not desiredDate:
-		log.critical("No desired date")
+		return [args.date or datetime.date.today()]
+	if args.date:
+		return [args.date]
+	if not args.start_date or not args.end_date:
+		log.critical("No desired date. Use either --date or both --start-date and --end-date")
 		exit(1)
-
-	# lineFilter = args.line_whitelist if "line_whitelist" in argsReturned else None
-	# busFilter = args.bus_whitelist if "bus_whitelist" in argsReturned else None
-
-
-	# ------------------------------------------------------------------------
-	# Data acquisition
-	# ------------------------------------------------------------------------
-
-	mes.start("data-acquisition")
+	if args.end_date < args.start_date:
+		log.critical(f"End date {args.end_date} is before start date {args.start_date}")
+		exit(1)
+	return [args.start_date + datetime.timedelta(days=i) for i in range((args.end_date - args.start_date).days + 1)]
+
+
+def AcquireDay(database,desiredDate,lineShapes,filters,checkpoints,resume,CONFIGS,log,mes,tag="",incremental=False,busCache=None):
+	"""
+	Arguments:
+		database - psycopg2 connection (only used by the calling thread)
+		desiredDate - date to be processed
+		lineShapes - LineShapes of every line, loaded once per run
+		filters - dict of whitelists/blacklists (sorted lists, None when disabled)
+		checkpoints - function(busSizeList) returning the checkpoint of <desiredDate> and the key of this stage, (None, None)
+			without checkpoints. The key depends on the bus sizes, so rows arriving later invalidate the stage
+		resume - loads the stage from its checkpoint when its key did not change
+		CONFIGS - configparser object
+		log, mes - logger and time measure
+		tag - prefix of the time measure keys
+		incremental - only acquires the buses with rows not corrected yet, from their watermark minus the overlap
+		busCache - (optional) BusCache, the bus data is read from it when the bus sizes did not change and stored otherwise
+	Returns:
+		dict with busSizeList, lineSizeList, busTrajectories, lineTrajectories, busTimestamps and busReported,
+		None when there is no bus data at <desiredDate>
+	"""
+	mes.start(f"{tag}data-acquisition",profile=True)
 	nextDate = desiredDate + datetime.timedelta(days=1)
-	
-	# Starting database connection
-	database = dblib.connect(**CONFIGS['database'])
 
-	if args.status:
-		print("Status: OK")
-		exit(0)
 	log.debug("Bus ids from database")
 
 	# Getting both bus and lines Ids as lists, ordered by size
 	# Bus Ids
-	with database.cursor() as cursor:
-			cursor.execute(f"SELECT bus_id,COUNT(time_detection) AS points FROM bus_data WHERE time_detection BETWEEN %s::timestamp AND %s::timestamp GROUP BY bus_id ORDER BY points DESC",(desiredDate,nextDate))
-			busSizeListComplete = cursor.fetchall()
+	if incremental:
+		# Only the window of each bus with new rows (see BusData.BusWindows)
+		busWindows = BusData.BusWindows(database,desiredDate,nextDate,BusData.GetOverlap(CONFIGS))
+		busSizeListComplete = BusData.WindowSizes(database,busWindows,desiredDate,nextDate) if busWindows else []
+	else:
+		with database.cursor() as cursor:
+				cursor.execute(f"SELECT bus_id,COUNT(time_detection) AS points FROM bus_data WHERE time_detection BETWEEN %s::timestamp AND %s::timestamp GROUP BY bus_id ORDER BY points DESC",(desiredDate,nextDate))
+				busSizeListComplete = cursor.fetchall()
+	database.commit()
 
 	if len(busSizeListComplete) == 0:
-		raise Exception(f"No buses in database at desired date {desiredDate}")
-
-	busMaxSize = busSizeListComplete[0][1]
-	log.debug("line ids from database")
-	
-	# line Ids
-	with database.cursor() as cursor:
-			cursor.execute("SELECT line_id,direction,COUNT(position) as dist FROM line_data GROUP BY line_id,direction ORDER BY dist DESC")
-			lineSizeListComplete = cursor.fetchall()
+		log.warning(f"No {'new ' if incremental else ''}buses in database at desired date {desiredDate}")
+		mes.end(f"{tag}data-acquisition")
+		return None
 
-	if (lineSizeListComplete) == 0:
-		raise Exception("No lines in database")
-	lineMaxSize = lineSizeListComplete[0][2]
+	# line Ids, from the line shapes loaded at the start of the run
+	lineSizeListComplete = [(lineId,lineDirection,int(lineSize)) for (lineId,lineDirection),lineSize in zip(lineShapes.ids,lineShapes.lengths)]
 
 	log.debug("filtering by whitelist/blacklist")
 	# Filtering based on whitelists and blacklists
 	busCompleteSet =set([i[0] for i in busSizeListComplete])
 	lineCompleteSet =set([i[0] for i in lineSizeListComplete])
 
-	if args.whitelist_lines:
-		with open(args.line_whitelist_path,"r") as lineWhitelistFile:
-			lineWhitelist = set([i for i in lineWhitelistFile.read().split("\n") if len(i) > 0 and i[0] != '#'])
-	else:
-		lineWhitelist = lineCompleteSet
-
-	if args.blacklist_lines:
-		with open(args.line_blacklist_path,"r") as lineBlacklistFile:
-			lineBlacklist = set([i for i in lineBlacklistFile.read().split("\n") if len(i) > 0 and i[0] != '#'])
-	else:
-		lineBlacklist = set()
-
-	if args.whitelist_buses:
-		with open(args.bus_whitelist_path,"r") as busWhitelistFile:
-			busWhitelist = set([i for i in busWhitelistFile.read().split("\n") if len(i) > 0 and i[0] != '#'])
-	else:
-		busWhitelist = busCompleteSet
-
-	if args.blacklist_buses:
-		with open(args.bus_blacklist_path,"r") as busBlacklistFile:
-			busBlacklist = set([i for i in busBlacklistFile.read().split("\n") if len(i) > 0 and i[0] != '#'])
-	else:
-		busBlacklist = set()
-
-	lineSet = lineCompleteSet.intersection(lineWhitelist).difference(lineBlacklist)
-	busSet = busCompleteSet.intersection(busWhitelist).difference(busBlacklist)
+	lineSet = lineCompleteSet.intersection(filters['line-whitelist'] if filters['line-whitelist'] is not None else lineCompleteSet).difference(filters['line-blacklist'])
+	busSet = busCompleteSet.intersection(filters['bus-whitelist'] if filters['bus-whitelist'] is not None else busCompleteSet).difference(filters['bus-blacklist'])
 
 	busSizeList = [i for i in busSizeListComplete if i[0] in busSet]
 	lineSizeList = [i for i in lineSizeListComplete if i[0] in lineSet]
 
-	if not args.everything and not (args.whitelist_buses or args.whitelist_lines or args.blacklist_buses or args.blacklist_lines):
-		log.critical("No filters where set and -e option was not set. Program will not operate on all the data unless explicitly said so.")
-		exit(1)
-	
-	log.info(f"Starting comparison between {len(busSizeList)} buses and {len(lineSizeList)} lines")
+	checkpoint,acquisitionKey = checkpoints(busSizeList)
+	if resume and checkpoint is not None and checkpoint.valid("data-acquisition",acquisitionKey):
+		artifacts = checkpoint.load("data-acquisition")
+		artifacts['busSizeList'] = [tuple(i) for i in artifacts['busSizeList']]
+		artifacts['lineSizeList'] = [tuple(i) for i in artifacts['lineSizeList']]
+		mes.end(f"{tag}data-acquisition")
+		return artifacts
+
+	log.info(f"{desiredDate}: comparison between {len(busSizeList)} buses and {len(lineSizeList)} lines")
 	log.debug("Requesting bus data from database")
-	# Buses and lines Tables creation
-	busMatrix = np.full((len(busSizeList),busSizeList[0][1],2),np.nan) # R3 matrix of bus x maxSize x lat/lon
-	busTimestamps = dict() #dict of lists of timestamps of each entry of a certain bus indexed by bus_id	
-	with database.cursor() as cursor:
-		cursor.execute(""" 
-		SELECT 
-			bus_id,time_detection,latitude,longitude,line_reported 
-		FROM bus_data 
-		WHERE 
-			bus_id IN %s 
-			AND time_detection BETWEEN %s AND %s  
-		ORDER BY bus_id, time_detection """, (
-			tuple([i[0] for i in busSizeList]),
-			desiredDate,nextDate
-			)
-		)
-		busTable = pd.DataFrame(cursor.fetchall(),columns=['bus_id','time_detection','lat','lon','reported'])
-	
-	log.debug("Sorting requested bus data")
-	busTable = busTable.sort_values(["bus_id","time_detection"]).copy()
-
-	log.debug("Creating bus matrix")
-	for index,busInfo in enumerate(busSizeList):
-		busId,busSize = busInfo
-		#busTimestamps[busId] = list(busTable.loc[busTable['bus_id'] == busId]['time_detection'])
-		busTrajectoryArray = np.array(busTable.loc[busTable["bus_id"] == busId][["lat","lon"]])
-		busMatrix[index] = np.pad(busTrajectoryArray,((0,busSizeList[0][1] - busSize),(0,0)),constant_values=np.nan)
-
-	log.debug("Requesting line data from database")
-	lineMatrix = np.full((len(lineSizeList),lineSizeList[0][2],2),np.nan)
-	with database.cursor() as cursor:
-		cursor.execute("""
-			SELECT 
-				line_id,direction,latitude,longitude
-			FROM line_data
-			WHERE 
-				line_id IN %s 
-			ORDER BY position;
-			""",(
-				tuple([i[0] for i in lineSizeList])
-			,)
-		)
-		lineTable = pd.DataFrame(cursor.fetchall(),columns=['line_id','direction','lat','lon'])
-
-	log.debug("creating line matrix")
-	for index,lineInfo in enumerate(lineSizeList):
-		lineId, lineDirection, lineSize = lineInfo
-		lineTrajectoryArray = np.array(lineTable.loc[(lineTable["line_id"] == lineId) & (lineTable['direction'] == str(lineDirection))][["lat","lon"]])
-		lineMatrix[index] = np.pad(lineTrajectoryArray,((0,lineSizeList[0][2] - lineSize),(0,0)),constant_values=np.nan)
- 
-
-	mes.end("data-acquisition")
-
-
-	# -------------------
-	# Statistical data and temporary save of files
-	# -------------------
-
-	# Good statistical data for measure later on
-	# Could be part of TimeMeasure:Measure class, so it can save itself without the use of signals
+	# Bus trajectories creation, streamed from the database in chunks
+	busCacheKey = Fingerprint(sorted(busSizeList)) if busCache is not None and not incremental else None
+	cached = busCache.load(desiredDate,busCacheKey) if busCacheKey else None
+	if incremental:
+		busWindows = {bus:busWindows[bus] for bus,_ in busSizeList}
+		busTrajectories, busTimestamps, busReported = BusData.StreamBusData(database,busSizeList,desiredDate,nextDate,BusData.GetChunkSize(CONFIGS),log,
+			BusData.BUS_WINDOW_DATA_QUERY,BusData.WindowParams(busWindows,desiredDate,nextDate))
+		previousLines = BusData.WindowLines(database,busWindows,desiredDate,nextDate)
+	elif cached is not None:
+		busTrajectories, busTimestamps, busReported = cached
+		busSizeList = list(zip(busTrajectories.ids,busTrajectories.lengths.tolist()))
+	else:
+		busTrajectories, busTimestamps, busReported = BusData.StreamBusData(database,busSizeList,desiredDate,nextDate,BusData.GetChunkSize(CONFIGS),log)
+		if busCacheKey:
+			busCache.save(desiredDate,busCacheKey,busTrajectories,busTimestamps,busReported)
+	database.commit()
+
+	log.debug("Selecting line shapes")
+	lineShapeIndex = lineShapes.index()
+	lineTrajectories = lineShapes.subset([lineShapeIndex[(lineId,lineDirection)] for lineId,lineDirection,_ in lineSizeList])
+
+	day = {
+		'busSizeList':busSizeList,'lineSizeList':lineSizeList,
+		'busTrajectories':busTrajectories,'lineTrajectories':lineTrajectories,
+		'busTimestamps':busTimestamps,'busReported':busReported,
+	}
+	if incremental:
+		day['previousLines'] = previousLines
+	mes.count(f"{tag}data-acquisition",rows=len(busTimestamps),points=len(busTrajectories.coordinates))
+	# Saving data in case of crash for fast recovery (--resume)
+	if checkpoint is not None:
+		checkpoint.save("data-acquisition",acquisitionKey,**day)
+
+	mes.end(f"{tag}data-acquisition")
+	return day
+
+
+def PerformanceData(day):
+	"""
+	Good statistical data for measure later on
+	"""
+	# Saved with the stage metrics through Measure.record
 	performanceData = dict()
-	performanceData['bus-amount'] = len(busSizeList)
-	performanceData['line-amount'] = len(lineSizeList)
-	performanceData['total-line-coordinates'] = sum([int(i[2]) for i in lineSizeList])
-	performanceData['total-bus-coordinates'] = sum([int(i[1]) for i in busSizeList])
-	performanceData['bus-matrix-max-points'] = busMatrix.shape[1]
-	performanceData['line-matrix-max-points'] = busMatrix.shape[1]
-	performanceData['bus-wasted-points'] = ((busMatrix.shape[0]*busMatrix.shape[1])-performanceData['total-bus-coordinates'])
-	performanceData['line-wasted-points'] = ((lineMatrix.shape[0]*lineMatrix.shape[1])-performanceData['total-line-coordinates'])
-	performanceData['total-size-bus-matrix-mbytes'] = (32*2*busMatrix.shape[0]*busMatrix.shape[1])/(8*10**6)
-	performanceData['total-size-line-matrix-mbytes'] = (32*2*lineMatrix.shape[0]*lineMatrix.shape[1])/(8*10**6)
+	performanceData['bus-amount'] = len(day['busSizeList'])
+	performanceData['line-amount'] = len(day['lineSizeList'])
+	performanceData['total-line-coordinates'] = sum([int(i[2]) for i in day['lineSizeList']])
+	performanceData['total-bus-coordinates'] = sum([int(i[1]) for i in day['busSizeList']])
+	performanceData['bus-max-points'] = int(np.max(day['busTrajectories'].lengths))
+	performanceData['line-max-points'] = int(np.max(day['lineTrajectories'].lengths))
+	performanceData['total-size-bus-trajectories-mbytes'] = day['busTrajectories'].nbytes/10**6
+	performanceData['total-size-line-trajectories-mbytes'] = day['lineTrajectories'].nbytes/10**6
 	#performanceData['extrapolated-maximum-d-size-mbytes'] = (32*busMatrix.shape[0]*busMatrix.shape[1]*lineMatrix.shape[0]*lineMatrix.shape[1])/(8*10**6)
 	#performanceData['maximum-d-size-batched-mbytes'] = (32*int(CONFIGS['lineDetection']['busStepSize'])*busMatrix.shape[1]*int(CONFIGS['lineDetection']['lineStepSize'])*lineMatrix.shape[1])/(8*10**6)
 	#performanceData['iterations-amount'] = (performanceData['bus-amount']/int(CONFIGS['lineDetection']['busStepSize']))*(performanceData['line-amount']/int(CONFIGS['lineDetection']['lineStepSize']))
-	
-	# Saving temporary data in case of crash for fast recovery (not implemented yet TODO)
-	with open("/tmp/busSizeList.pickle",'wb') as fil:
-		pickle.dump(busSizeList,fil)
-
-	with open("/tmp/lineSizeList.pickle",'wb') as fil:
-		pickle.dump(lineSizeList,fil)
+	return performanceData
+
+
+def CorrectDay(day,checkpoint,detectionKey,correctionKey,resume,CONFIGS,log,mes,tag="",performanceData=None,validateDistance=False):
+	"""
+	Line detection and correction of one day acquired by AcquireDay. Returns the corrected table (busResultTable).
+	Detection statistics are added to <performanceData>, with the distance mode validation report when
+	<validateDistance> is set and the 'projected' distance mode is used
+	"""
+	busTrajectories = day['busTrajectories']
+	lineTrajectories = day['lineTrajectories']
+
+	# Simplification phase: detection and correction run over the thinned trajectories
+	simplification,simplifyLines = Simplification.GetSimplification(CONFIGS)
+	if simplification:
+		mes.start(f"{tag}simplification")
+		originalBusTrajectories = busTrajectories
+		busTrajectories,busOwner = Simplification.Simplify(originalBusTrajectories,simplification)
+		if simplifyLines:
+			lineTrajectories = Simplification.Simplify(lineTrajectories,simplification)[0]
+		if performanceData is not None:
+			performanceData['simplified-bus-coordinates'] = len(busTrajectories.coordinates)
+			performanceData['simplified-line-coordinates'] = len(lineTrajectories.coordinates)
+		log.info(f"Simplification kept {len(busTrajectories.coordinates)} of {len(originalBusTrajectories.coordinates)} bus points")
+		mes.end(f"{tag}simplification")
 
-	with open("/tmp/busMatrix.pickle",'wb') as fil:
-		pickle.dump(busMatrix,fil)
+	# Line detection phase
+	mes.start(f"{tag}line-detection")
 
-	with open("/tmp/lineMatrix.pickle",'wb') as fil:
-		pickle.dump(lineMatrix,fil)
+	# Per point distances of the detected pairs, reused by the correction. Not checkpointed, a resumed
+	# correction computes them again
+	pointDistances = dict() if CONFIGS.getboolean('default_correction_method','emitPointDistances',fallback=False) else None
 
-	with open("/tmp/busTimestamps.pickle",'wb') as fil:
-		pickle.dump(busTimestamps,fil)
+	if resume and checkpoint is not None and checkpoint.valid("line-detection",detectionKey):
+		detectionMatrix = checkpoint.load("line-detection")['detectionMatrix']
+	else:
+		mes.start(f"{tag}line-detection-function",profile=True)
+		detectionStats = dict()
+		detectionMatrix = LineDetection.FilterData(busTrajectories,lineTrajectories,CONFIGS,log,detectionStats,pointDistances)
+		mes.count(f"{tag}line-detection-function",points=len(busTrajectories.coordinates),tiles=detectionStats.get('detection-tiles',0))
+		mes.end(f"{tag}line-detection-function")
+		if performanceData is not None:
+			performanceData.update(detectionStats)
+
+		if validateDistance and Distance.GetDistanceMode(CONFIGS) == "projected":
+			mes.start(f"{tag}distance-validation")
+			report = LineDetection.ValidateDistanceMode(busTrajectories,lineTrajectories,CONFIGS,log,projectedResults=np.asarray(detectionMatrix,dtype=bool).T)
+			if report['differences']:
+				log.warning(f"Projected distance differs from haversine on {report['differences']} bus/line pairs: {report['differing-pairs']}")
+			if performanceData is not None:
+				performanceData['distance-validation'] = report
+			mes.end(f"{tag}distance-validation")
+		
+		if checkpoint is not None:
+			mes.start(f'{tag}line-detection-saving')
+			checkpoint.save("line-detection",detectionKey,detectionMatrix=detectionMatrix)
+			mes.end(f"{tag}line-detection-saving")
 	
-	log.debug("Starting correction process")
+	# Incremental mode: a short tail alone rarely covers detectionPercentage of a line, so the lines
+	# already detected in the context rows of each bus are kept as detected
+	for bus,lines in day.get('previousLines',{}).items():
+		if bus in detectionMatrix.columns:
+			detectionMatrix.loc[detectionMatrix.index.get_level_values(0).isin(list(lines)),bus] = True
 
-	# -------------------
-	# Line detection and correction phase
-	# -------------------
-	# Line detection phase
-	mes.start("line-detection")
-
-	mes.start("line-detection-function")
-	detectionMatrix = LineDetection.FilterData(busMatrix,lineMatrix,busSizeList,lineSizeList,CONFIGS,log)
-	mes.end("line-detection-function")
-	
-	mes.start('line-detection-saving')
-	with open("/tmp/detectMatrix.pickle.tmp",'wb') as fil:
-		pickle.dump(detectionMatrix,fil)
-	mes.end("line-detection-saving")
-	
-	mes.end("line-detection")
+	mes.end(f"{tag}line-detection")
 
 
 	# Line correction phase
-	mes.start("line-correction")
-
-	mes.start('line-correction-function')
-	busResultTable = LineCorrection.CorrectData((detectionMatrix > float(CONFIGS['default_correction_method']['detectionPercentage'])),busMatrix,lineMatrix,busSizeList,lineSizeList,CONFIGS) # Matriz R^3 de (entidade x indice)
-	mes.end("line-correction-function")
+	mes.start(f"{tag}line-correction")
 
-	mes.start('line-correction-saving')
-	with open("/tmp/busResultTable.pickle.tmp",'wb') as fil:
-		pickle.dump(busResultTable,fil)
-	mes.end("line-correction-saving")
+	if resume and checkpoint is not None and checkpoint.valid("line-correction",correctionKey):
+		busResultTable = checkpoint.load("line-correction")['busResultTable']
+	else:
+		mes.start(f'{tag}line-correction-function',profile=True)
+		busResultTable = LineCorrection.CorrectData((detectionMatrix > float(CONFIGS['default_correction_method']['detectionPercentage'])),busTrajectories,lineTrajectories,CONFIGS,pointDistances) # Matriz R^3 de (entidade x indice)
+		if simplification:
+			# Every original point gets the line of the point representing it
+			busResultTable = Simplification.ExpandLabels(busResultTable,originalBusTrajectories,busTrajectories,busOwner)
+		mes.count(f"{tag}line-correction-function",points=len(busTrajectories.coordinates))
+		mes.end(f"{tag}line-correction-function")
+
+		if checkpoint is not None:
+			mes.start(f'{tag}line-correction-saving')
+			checkpoint.save("line-correction",correctionKey,busResultTable=busResultTable)
+			mes.end(f"{tag}line-correction-saving")
 	
-	mes.end("line-correction")
-	log.debug("correction process done")
-	# ----------------------------------------------------------------------------
-	# Database saving
-	# -----------------------------------------------------------------------------
-	mes.start('database-insertion')
+	mes.end(f"{tag}line-correction")
+	return busResultTable
+
+
+def SweepDay(day,tolerances,percentages,outputPath,CONFIGS,log,mes,tag=""):
+	"""
+	Parameter sweep of one day acquired by AcquireDay: line detection for every tolerance x percentage pair,
+	saved at <outputPath> (npz). Returns the (tolerance, percentage) amount of detected bus/line pairs
+	"""
+	mes.start(f"{tag}parameter-sweep",profile=True)
+	tolerances,percentages,fractions,detections = LineDetection.SweepDetection(day['busTrajectories'],day['lineTrajectories'],tolerances,percentages,CONFIGS,log)
+	mes.count(f"{tag}parameter-sweep",points=len(day['busTrajectories'].coordinates))
+
+	outputPath.parent.mkdir(parents=True,exist_ok=True)
+	np.savez(outputPath,tolerances=tolerances,percentages=percentages,detections=detections,fractions=fractions,
+		busIds=np.array(day['busTrajectories'].ids,dtype=str),lineIds=np.array(day['lineTrajectories'].ids,dtype=str))
+	mes.end(f"{tag}parameter-sweep")
+
+	mes.record(f"{tag}sweep",{f"{tolerance:g}m-{percentage:g}":int(detections[row,column]) for row,tolerance in enumerate(tolerances) for column,percentage in enumerate(percentages)})
+	log.info(f"Parameter sweep saved at {outputPath}")
+	return detections
+
+
+def WriteDay(database,desiredDate,day,busResultTable,log,mes,tag="",incremental=False):
+	"""
+	Saves the corrected lines of one day into bus_data. With <incremental>, only rows not corrected yet are updated
+	"""
+	mes.start(f'{tag}database-insertion',profile=True)
+	nextDate = desiredDate + datetime.timedelta(days=1)
 	if busResultTable.shape[0] == 0:
-		print("Done: NO MATCHES WERE DETECTED")
-		exit(0)
+		print(f"Done ({desiredDate}): NO MATCHES WERE DETECTED")
+		mes.end(f'{tag}database-insertion')
+		return
 	
 	log.debug("Sending data to database")
-	# Inserting detected values into corrected places
-	busTable["line_corrected"] = ""
-	print(busTable[['line_corrected']] == None)
-	for index in busResultTable.columns.to_list():
-		busSize = [i[1] for i in busSizeList if i[0] == index][0]
-		busTable.loc[busTable['bus_id'] == index,"line_corrected"] = busResultTable[index].to_list()[:busSize]
-
-	busTable.loc[busTable['line_corrected'] == "","line_corrected"] = "No_line"
-
-	#busTable[['time_detection']] = busTable[['time_detection']].astype("int64") // 10**9
-	busTable['bus_id'] = busTable.bus_id.apply(lambda x: x[1:-1] if x[0] == "'" else x)
-	busTable['reported'] = busTable.reported.apply(lambda x: x[1:-1] if x[0] == "'" else x)
-	
+	# Corrected line of every bus point, aligned with the trajectory coordinates
+	busTrajectories = day['busTrajectories']
+	lineDetected = BusData.LineDetected(busTrajectories,busResultTable)
+
+	# Only the corrected column is sent, bus_data rows are updated in place
+	updated = BusData.WriteLineDetected(database,busTrajectories,day['busTimestamps'],lineDetected,desiredDate,nextDate,log,incremental)
+	mes.count(f'{tag}database-insertion',rows=max(updated,0),points=len(lineDetected))
+
+	mes.end(f'{tag}database-insertion')
+
+
+def RunPipeline(dates,Acquire,Process,Write):
+	"""
+	Arguments:
+		dates - dates to be processed, in order
+		Acquire - Acquire(date) returns the data of the day, None when there is nothing to process
+		Process - Process(date,day) returns the result to be written, None when there is nothing to write
+		Write - Write(date,day,result) saves the result of the day
+	Description:
+		Day N+1 is acquired in a reader thread and day N-1 written in a writer thread while day N is processed
+		in the calling thread. Days are written one at a time in date order, errors of a background thread
+		stop the run when its result is waited for
+	"""
+	with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+		acquisition = reader.submit(Acquire,dates[0])
+		writing = None
+		for position,desiredDate in enumerate(dates):
+			day = acquisition.result()
+			if position + 1 < len(dates):
+				acquisition = reader.submit(Acquire,dates[position+1])
+
+			if day is None:
+				continue
+			result = Process(desiredDate,day)
+			if result is None:
+				continue
+
+			# Only one day is written at a time, errors of the previous write stop the run here
+			if writing is not None:
+				writing.result()
+			writing = writer.submit(Write,desiredDate,day,result)
+
+		if writing is not None:
+			writing.result()
 
-	buff = io.StringIO()
-	# inserting new ones in bus_data table
-	busTable = busTable.rename(columns={"lat":"latitude","lon":"longitude","reported":"line_reported","line_corrected":"line_detected"})
 
-	busTable.to_csv(buff,header=False,index=False,columns=("time_detection","bus_id","latitude","longitude","line_reported","line_detected"))
-	buff.seek(0)
-	with database.cursor() as cursor:
-		cursor.copy_from(buff,"bus_data",sep=",")#,columns=("bus_id","time_detection","latitude","longitude","line_reported","line_detected"))
-	database.commit()
-	
-	# Deleting original values from bus_data (identified by none in line_detected column)
-	with database.cursor() as cursor:
-		cursor.execute(
-			"""
-			DELETE FROM bus_data
-			WHERE
-				time_detection BETWEEN %s AND %s
-				AND bus_id IN %s AND
-				line_detected = ''
-			""",
-			(
-				desiredDate,nextDate,
-				tuple([i[0] for i in busSizeList])
-			)
-		)
-	database.commit()
+def main():
+	# --------------------------------
+	# Setup phase
+	# --------------------------------
+	# Parse configurations and parameters, sets logger and global variables
+	CONFIGS = ConfigParser()
+
+	args = parse_args()
+
+	# Stage metrics are flushed at the end of every stage
+	mes = Measure(args.metrics_path or f"performance{METRIC_EXTENSIONS[args.metrics_format]}",args.metrics_format,args.profile)
+
+	# Sets logging details
+	log = logger(args.verbose)
+
+	# sets configuration options
+	configPath = pathlib.Path("/run/secrets")
+	if (configPath / 'main_configurations').exists():
+			CONFIGS.read(configPath / 'main_configurations')
+
+	if args.config:
+		if not args.config.exists():
+			log.critical(f"Configuration file at {args.config.absolute()} does not exits")
+			exit(1)
+		CONFIGS.read(args.config)
+
+	OverrideConfigs(CONFIGS,args)
+
+	# Starting database connection
+	database = dblib.connect(**CONFIGS['database'])
+
+	if args.status:
+		print("Status: OK")
+		exit(0)
+
+	# Get execution parameters
+	dates = DateRange(args,log)
+	if args.from_cache and args.incremental:
+		log.critical("Incremental mode reads new rows on every run, --from-cache cannot be used")
+		exit(1)
+	busCache = BusCache.GetBusCache(CONFIGS,log) if args.from_cache else None
+
+	# Parameter sweep, missing settings default to the configured ones
+	sweep = args.sweep_tolerances is not None or args.sweep_percentages is not None
+	if sweep:
+		sweepTolerances = args.sweep_tolerances or [CONFIGS.getfloat('default_correction_method','distanceTolerance')]
+		sweepPercentages = args.sweep_percentages or [CONFIGS.getfloat('default_correction_method','detectionPercentage')]
+
+	# ------------------------------------------------------------------------
+	# Filters
+	# ------------------------------------------------------------------------
+
+	if not args.everything and not (args.whitelist_buses or args.whitelist_lines or args.blacklist_buses or args.blacklist_lines):
+		log.critical("No filters where set and -e option was not set. Program will not operate on all the data unless explicitly said so.")
+		exit(1)
+
+	# Whitelists and blacklists (None when disabled)
+	filters = {
+		'line-whitelist':ReadFilter(args.line_whitelist_path) if args.whitelist_lines else None,
+		'line-blacklist':ReadFilter(args.line_blacklist_path) if args.blacklist_lines else set(),
+		'bus-whitelist':ReadFilter(args.bus_whitelist_path) if args.whitelist_buses else None,
+		'bus-blacklist':ReadFilter(args.bus_blacklist_path) if args.blacklist_buses else set(),
+	}
+	filtersFingerprint = Fingerprint({name:(sorted(values) if values is not None else None) for name,values in filters.items()})
+	configHash = ConfigFingerprint(CONFIGS,'default_correction_method')
+
+	# line shapes are loaded only once for every date (from the line shape cache, reloaded from line_data when it changes)
+	log.debug("line ids from database")
+	# Stage checkpoints are only written when requested. Their keys include the line_data version, so
+	# checkpoints built from older line shapes are never reused
+	checkpointing = (args.resume or args.checkpoint) and not args.incremental
+	with mes.span("line-shapes"):
+		lineDataVersion = LineData.LineDataVersion(database) if checkpointing or LineData.GetCachePath(CONFIGS) is not None else None
+		lineShapes = LineData.LoadLineShapes(database,CONFIGS,log,lineDataVersion)
+	if len(lineShapes) == 0:
+		raise Exception("No lines in database")
+
+	# ------------------------------------------------------------------------
+	# Pipeline
+	# ------------------------------------------------------------------------
+	# With more than one date, day N+1 is acquired and day N-1 is written while day N is detected and corrected.
+	# Each background thread owns its database connection
+
+	rangeMode = len(dates) > 1
+	readDatabase = dblib.connect(**CONFIGS['database']) if rangeMode else database
+	writeDatabase = dblib.connect(**CONFIGS['database']) if rangeMode else database
+
+	def Checkpoints(desiredDate,busSizeList):
+		# The incremental mode reads different rows on every run, its stages are not checkpointed
+		if not checkpointing:
+			return None,None,None,None
+		# Each stage key depends on the previous one, so a change invalidates every stage after it. The bus sizes
+		# of the day are part of the acquisition key (as in the bus cache), rows arriving later invalidate it
+		busFingerprint = Fingerprint(sorted(busSizeList))
+		checkpoint = Checkpoint(args.checkpoint_path / desiredDate.isoformat(),{'date':desiredDate.isoformat(),'filters':filtersFingerprint,'config':configHash,'lineData':lineDataVersion,'buses':busFingerprint},log)
+		acquisitionKey = Fingerprint("data-acquisition",desiredDate,filtersFingerprint,lineDataVersion,busFingerprint)
+		detectionKey = Fingerprint("line-detection",acquisitionKey,configHash)
+		correctionKey = Fingerprint("line-correction",detectionKey,configHash)
+		return checkpoint,acquisitionKey,detectionKey,correctionKey
+
+	def Tag(desiredDate):
+		return f"{desiredDate.isoformat()}-" if rangeMode else ""
+
+	def Acquire(desiredDate):
+		checkpoints = lambda busSizeList: Checkpoints(desiredDate,busSizeList)[:2]
+		return AcquireDay(readDatabase,desiredDate,lineShapes,filters,checkpoints,args.resume,CONFIGS,log,mes,Tag(desiredDate),args.incremental,busCache)
+
+	def Process(desiredDate,day):
+		performanceData = PerformanceData(day)
+
+		if sweep:
+			detections = SweepDay(day,sweepTolerances,sweepPercentages,args.sweep_output / f"{desiredDate.isoformat()}.npz",CONFIGS,log,mes,Tag(desiredDate))
+			mes.record(f"{Tag(desiredDate)}performance",performanceData)
+			print(f"Detected bus/line pairs at {desiredDate} (rows: distanceTolerance, columns: detectionPercentage)")
+			print(pd.DataFrame(detections,index=sorted(sweepTolerances),columns=sorted(sweepPercentages)).to_string())
+			return None
+
+		log.debug(f"Starting correction process of {desiredDate}")
+		checkpoint,_,detectionKey,correctionKey = Checkpoints(desiredDate,day['busSizeList'])
+		busResultTable = CorrectDay(day,checkpoint,detectionKey,correctionKey,args.resume,CONFIGS,log,mes,Tag(desiredDate),performanceData,args.validate_distance)
+		mes.record(f"{Tag(desiredDate)}performance",performanceData)
+		log.debug(f"correction process of {desiredDate} done")
+		return busResultTable
+
+	def Write(desiredDate,day,busResultTable):
+		WriteDay(writeDatabase,desiredDate,day,busResultTable,log,mes,Tag(desiredDate),args.incremental)
+
+	RunPipeline(dates,Acquire,Process,Write)
+
+	mes.close()
+
 
-   
-	mes.end('database-insertion')
-	
-	
 if __name__ == '__main__':
 	main()
-	
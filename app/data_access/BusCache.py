@@ -0,0 +1,135 @@
+#
+# BusCache.py
+# Description:
+#	Local cache of the bus data of each day, for runs repeated over the same dates (e.g. tuning of
+#	distanceTolerance/detectionPercentage). Each entry holds the bus trajectories (coordinates and offsets),
+#	time_detection and line_reported columns as npy files, memory-mapped on load. Entries are keyed by the
+#	date and the list of bus sizes returned by the count query, so a change of the filters or of bus_data
+#	makes a new entry instead of reusing stale data. Entries are evicted by age and by total size, least
+#	recently used first, when the cache is opened and after every save.
+#
+
+import os
+import json
+import time
+import shutil
+import pathlib
+import datetime
+import tempfile
+
+import numpy as np
+
+from data_processing.Trajectories import Trajectories
+
+DEFAULT_CACHE_PATH = "/tmp/bus_cache"
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_MBYTES = 10240
+
+
+def GetBusCache(CONFIGS, logging=None):
+	"""
+	Returns the BusCache of the configuration
+	Configurations:
+		CONFIGS['data_acquisition']['busCachePath'] - (optional) cache directory, defaults to DEFAULT_CACHE_PATH
+		CONFIGS['data_acquisition']['busCacheMaxAgeDays'] - (optional) entries not used for longer are evicted
+		CONFIGS['data_acquisition']['busCacheMaxMBytes'] - (optional) least recently used entries are evicted above this size
+	"""
+	return BusCache(
+		CONFIGS.get('data_acquisition','busCachePath',fallback=DEFAULT_CACHE_PATH),
+		datetime.timedelta(days=CONFIGS.getfloat('data_acquisition','busCacheMaxAgeDays',fallback=DEFAULT_MAX_AGE_DAYS)),
+		int(CONFIGS.getfloat('data_acquisition','busCacheMaxMBytes',fallback=DEFAULT_MAX_MBYTES) * 2**20),
+		logging)
+
+
+class BusCache:
+	"""
+	Arguments:
+		directory - root directory of the cache, one subdirectory per entry
+		maxAge - timedelta, entries not used for longer are evicted
+		maxBytes - total size of the cache, least recently used entries are evicted above it
+		logging - logger
+	Description:
+		Opening the cache evicts the entries beyond its limits, so they are never loaded
+	"""
+	def __init__(self, directory, maxAge, maxBytes, logging=None):
+		self.directory = pathlib.Path(directory)
+		self.maxAge = maxAge
+		self.maxBytes = maxBytes
+		self.log = logging
+		self.evict()
+
+	def path(self, date, key):
+		return self.directory / f"{date.isoformat()}-{key}"
+
+	def load(self, date, key):
+		"""
+		Returns busTrajectories, busTimestamps and busReported (as StreamBusData) memory-mapped from the
+		entry of <date> and <key>, None when there is no such entry
+		"""
+		entryPath = self.path(date, key)
+		if not (entryPath / "manifest.json").exists():
+			return None
+
+		# The manifest modification time is the last use of the entry
+		os.utime(entryPath / "manifest.json")
+		busTrajectories = Trajectories.load(entryPath / "busTrajectories", mmapMode="r")
+		busTimestamps = np.load(entryPath / "busTimestamps.npy", mmap_mode="r")
+		busReported = np.load(entryPath / "busReported.npy", mmap_mode="r")
+		if self.log:
+			self.log.info(f"Bus data of {date} loaded from cache {entryPath}")
+		return busTrajectories, busTimestamps, busReported
+
+	def save(self, date, key, busTrajectories, busTimestamps, busReported):
+		"""
+		Stores the bus data of <date> as the entry of <key>, then evicts old entries
+		"""
+		# Written in a temporary directory and renamed, so a crash never leaves a partial entry behind
+		self.directory.mkdir(parents=True, exist_ok=True)
+		temporaryPath = pathlib.Path(tempfile.mkdtemp(prefix=".building-", dir=self.directory))
+		entryPath = self.path(date, key)
+		try:
+			busTrajectories.save(temporaryPath / "busTrajectories")
+			np.save(temporaryPath / "busTimestamps.npy", np.asarray(busTimestamps))
+			np.save(temporaryPath / "busReported.npy", np.asarray(busReported))
+			with open(temporaryPath / "manifest.json", "w") as fil:
+				json.dump({'date': date.isoformat(), 'key': key, 'buses': len(busTrajectories), 'points': len(busTrajectories.coordinates)}, fil)
+			if entryPath.exists():
+				shutil.rmtree(entryPath)
+			temporaryPath.rename(entryPath)
+		except OSError:
+			shutil.rmtree(temporaryPath, ignore_errors=True)
+			if not entryPath.exists():
+				raise
+		if self.log:
+			self.log.debug(f"Bus data of {date} saved in cache {entryPath}")
+		self.evict(keep=entryPath)
+
+	def entries(self):
+		"""
+		Returns (last use, size in bytes, path) of every entry, least recently used first
+		"""
+		if not self.directory.exists():
+			return []
+		entries = []
+		for entryPath in self.directory.iterdir():
+			if entryPath.name.startswith(".") or not (entryPath / "manifest.json").exists():
+				continue
+			size = sum(fil.stat().st_size for fil in entryPath.rglob("*") if fil.is_file())
+			entries.append(((entryPath / "manifest.json").stat().st_mtime, size, entryPath))
+		return sorted(entries)
+
+	def evict(self, keep=None):
+		"""
+		Removes the entries unused for longer than maxAge, then the least recently used ones until the cache
+		fits maxBytes. The entry at <keep> is never removed
+		"""
+		entries = self.entries()
+		oldest = time.time() - self.maxAge.total_seconds()
+		total = sum(size for _, size, _ in entries)
+		for lastUse, size, entryPath in entries:
+			if entryPath == keep or (lastUse >= oldest and total <= self.maxBytes):
+				continue
+			shutil.rmtree(entryPath, ignore_errors=True)
+			total -= size
+			if self.log:
+				self.log.debug(f"Bus cache entry {entryPath.name} evicted")
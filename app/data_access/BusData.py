@@ -0,0 +1,289 @@
+#
+# BusData.py
+# Description:
+#	Streaming acquisition of bus GPS data. Rows are read through a server-side cursor in fixed size
+#	chunks and written straight into the bus matrix, without building an intermediate DataFrame.
+#
+
+import io
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from data_processing.Trajectories import Trajectories
+
+# Default amount of rows fetched from the server on each round trip
+DEFAULT_CHUNK_SIZE = 50000
+
+# Default context (minutes before each bus watermark) requested by the incremental mode
+DEFAULT_OVERLAP_MINUTES = 15
+
+# Some sources store bus_id and line_reported between quotes
+def _StripQuotes(column):
+	return f"CASE WHEN left({column},1) = '''' THEN substr({column},2,length({column})-2) ELSE {column} END"
+
+
+BUS_DATA_QUERY = """
+	SELECT
+		bus_id,time_detection,latitude,longitude,line_reported
+	FROM bus_data
+	WHERE
+		bus_id IN %s
+		AND time_detection BETWEEN %s AND %s
+	ORDER BY bus_id, time_detection """
+
+# Incremental mode. Buses are identified by their unquoted id, since corrected rows are stored unquoted.
+# The watermark of a bus is its last corrected time_detection, only buses with rows not corrected yet are returned
+BUS_WATERMARK_QUERY = f"""
+	SELECT
+		{_StripQuotes("bus_id")} AS bus,
+		MAX(time_detection) FILTER (WHERE line_detected <> '') AS watermark,
+		MIN(time_detection) FILTER (WHERE line_detected = '') AS oldest
+	FROM bus_data
+	WHERE time_detection BETWEEN %s AND %s
+	GROUP BY bus
+	HAVING COUNT(*) FILTER (WHERE line_detected = '') > 0 """
+
+# Rows of each bus from its window start (see BusWindows)
+BUS_WINDOW_JOIN = f"""
+	FROM bus_data
+	JOIN unnest(%s::text[], %s::timestamp[]) AS bus_window(bus, since)
+		ON {_StripQuotes("bus_data.bus_id")} = bus_window.bus
+	WHERE
+		bus_data.time_detection BETWEEN %s AND %s
+		AND bus_data.time_detection >= bus_window.since """
+
+BUS_WINDOW_SIZE_QUERY = f"""
+	SELECT
+		bus_window.bus, COUNT(*) AS points
+	{BUS_WINDOW_JOIN}
+	GROUP BY bus_window.bus
+	ORDER BY points DESC """
+
+# Lines already detected in the context rows of each window
+BUS_WINDOW_LINES_QUERY = f"""
+	SELECT
+		bus_window.bus, array_agg(DISTINCT bus_data.line_detected)
+	{BUS_WINDOW_JOIN}
+		AND bus_data.line_detected NOT IN ('', 'No_line')
+	GROUP BY bus_window.bus """
+
+BUS_WINDOW_DATA_QUERY = f"""
+	SELECT
+		bus_window.bus,bus_data.time_detection,bus_data.latitude,bus_data.longitude,bus_data.line_reported
+	{BUS_WINDOW_JOIN}
+	ORDER BY bus_window.bus, bus_data.time_detection """
+
+
+def GetOverlap(CONFIGS):
+	"""
+	Returns CONFIGS['data_acquisition']['overlapMinutes'] as a timedelta, defaults to DEFAULT_OVERLAP_MINUTES
+	"""
+	return datetime.timedelta(minutes=CONFIGS.getfloat('data_acquisition','overlapMinutes',fallback=DEFAULT_OVERLAP_MINUTES))
+
+
+def BusWindows(database, startDate, endDate, overlap):
+	"""
+	Arguments:
+		database - psycopg2 connection
+		startDate, endDate - time_detection interval
+		overlap - timedelta of already corrected context requested before each watermark
+	Returns:
+		dict from (unquoted) bus_id to the start of its window, for every bus with rows not corrected yet.
+		Windows start <overlap> before the watermark, or at the oldest row not corrected yet when it is older
+		(rows arriving late with an old time_detection). Buses never corrected start at <startDate>
+	"""
+	with database.cursor() as cursor:
+		cursor.execute(BUS_WATERMARK_QUERY, (startDate, endDate))
+		watermarks = cursor.fetchall()
+	start = startDate if isinstance(startDate, datetime.datetime) else datetime.datetime.combine(startDate, datetime.time.min)
+	return {bus: (min(watermark - overlap, oldest or watermark) if watermark is not None else start) for bus, watermark, oldest in watermarks}
+
+
+def WindowSizes(database, windows, startDate, endDate):
+	"""
+	Returns busSizeList (bus, points) of the rows inside each bus window, ordered by size
+	"""
+	with database.cursor() as cursor:
+		cursor.execute(BUS_WINDOW_SIZE_QUERY, WindowParams(windows, startDate, endDate))
+		return cursor.fetchall()
+
+
+def WindowLines(database, windows, startDate, endDate):
+	"""
+	Returns a dict from bus to the set of lines already detected in its window
+	"""
+	with database.cursor() as cursor:
+		cursor.execute(BUS_WINDOW_LINES_QUERY, WindowParams(windows, startDate, endDate))
+		return {bus: set(lines) for bus, lines in cursor.fetchall()}
+
+
+def WindowParams(windows, startDate, endDate):
+	"""
+	Parameters of the BUS_WINDOW queries
+	"""
+	buses = list(windows.keys())
+	return (buses, [windows[bus] for bus in buses], startDate, endDate)
+
+
+def GetChunkSize(CONFIGS):
+	"""
+	Returns CONFIGS['data_acquisition']['chunkSize'], defaults to DEFAULT_CHUNK_SIZE
+	"""
+	return CONFIGS.getint('data_acquisition','chunkSize',fallback=DEFAULT_CHUNK_SIZE)
+
+
+def StreamBusData(database, busSizeList, startDate, endDate, chunkSize=DEFAULT_CHUNK_SIZE, logging=None, query=BUS_DATA_QUERY, params=None):
+	"""
+	Arguments:
+		database - psycopg2 connection
+		busSizeList - busSizeList[<indice>] -> (<identificadorOnibus>,<tamanho>), ordered by size
+		startDate, endDate - time_detection interval to request
+		chunkSize - rows fetched per round trip
+		logging - logger
+		query, params - (optional) query returning (bus, time_detection, latitude, longitude, line_reported) rows
+			ordered by bus and time, with its parameters. Defaults to every row of the buses in the interval
+	Returns:
+		busTrajectories - Trajectories of every bus, in busSizeList order
+		busTimestamps - time_detection of every point, aligned with busTrajectories.coordinates
+		busReported - line_reported of every point, aligned with busTrajectories.coordinates
+	Description:
+		Rows arrive ordered by (bus_id, time_detection), so each chunk is split in runs of the same bus
+		and each run is copied to the next free positions of that bus in the coordinate buffer.
+	"""
+	busIndex = {busId: index for index, (busId, _) in enumerate(busSizeList)}
+	busSizes = np.array([size for _, size in busSizeList], dtype=np.int64)
+	filled = np.zeros(len(busSizeList), dtype=np.int64)
+
+	busTrajectories = Trajectories.empty(busSizes, busIndex.keys())
+	timestamps = [[] for _ in busSizeList]
+	reported = [[] for _ in busSizeList]
+	overflow = 0
+
+	with database.cursor(name="bus_data_stream") as cursor:
+		cursor.itersize = chunkSize
+		cursor.execute(query, params if params is not None else (tuple(busIndex.keys()), startDate, endDate))
+		while True:
+			rows = cursor.fetchmany(chunkSize)
+			if not rows:
+				break
+			busIds, times, lat, lon, lines = zip(*rows)
+			busIds = np.array(busIds, dtype=object)
+			coordinates = np.column_stack((np.array(lat, dtype=float), np.array(lon, dtype=float)))
+
+			# Boundaries of each run of rows of the same bus inside the chunk
+			boundaries = np.concatenate(([0], np.nonzero(busIds[1:] != busIds[:-1])[0] + 1, [len(rows)]))
+			for start, end in zip(boundaries[:-1], boundaries[1:]):
+				index = busIndex[busIds[start]]
+				position = filled[index]
+				amount = min(end - start, busSizes[index] - position)
+				overflow += (end - start) - amount
+
+				bufferStart = busTrajectories.offsets[index] + position
+				busTrajectories.coordinates[bufferStart:bufferStart+amount] = coordinates[start:start+amount]
+				timestamps[index].extend(times[start:start+amount])
+				reported[index].extend(lines[start:start+amount])
+				filled[index] += amount
+
+	if logging and overflow:
+		logging.warning(f"{overflow} bus rows arrived after the bus sizes were counted and were ignored")
+	if np.any(filled < busSizes):
+		if logging:
+			logging.warning(f"{int(np.sum(busSizes - filled))} bus rows counted were not received")
+		busTrajectories = Trajectories.fromArrays([busTrajectories[index][:filled[index]] for index in range(len(busSizeList))], busTrajectories.ids)
+
+	busTimestamps = np.array([time for busTimes in timestamps for time in busTimes], dtype="datetime64[us]")
+	busReported = np.array([line for busLines in reported for line in busLines], dtype=str)
+	return busTrajectories, busTimestamps, busReported
+
+
+BUS_CORRECTION_STAGING = """
+	CREATE TEMPORARY TABLE bus_correction (
+		bus_id TEXT,
+		time_detection TIMESTAMP,
+		line_detected TEXT
+	) ON COMMIT DROP """
+
+BUS_CORRECTION_UPDATE = f"""
+	UPDATE bus_data SET
+		line_detected = bus_correction.line_detected,
+		bus_id = {_StripQuotes("bus_data.bus_id")},
+		line_reported = {_StripQuotes("bus_data.line_reported")}
+	FROM bus_correction
+	WHERE
+		bus_data.bus_id = bus_correction.bus_id
+		AND bus_data.time_detection = bus_correction.time_detection
+		AND bus_data.time_detection BETWEEN %s AND %s """
+
+# Incremental write-back: ids of the trajectories are unquoted and only rows not corrected yet are updated
+BUS_CORRECTION_UPDATE_NEW = f"""
+	UPDATE bus_data SET
+		line_detected = bus_correction.line_detected,
+		bus_id = {_StripQuotes("bus_data.bus_id")},
+		line_reported = {_StripQuotes("bus_data.line_reported")}
+	FROM bus_correction
+	WHERE
+		{_StripQuotes("bus_data.bus_id")} = bus_correction.bus_id
+		AND bus_data.time_detection = bus_correction.time_detection
+		AND bus_data.line_detected = ''
+		AND bus_data.time_detection BETWEEN %s AND %s """
+
+
+def LineDetected(busTrajectories, busResultTable):
+	"""
+	Arguments:
+		busTrajectories - Trajectories of the buses
+		busResultTable - corrected lines, as returned by LineCorrection.CorrectData, one column per corrected bus
+	Returns:
+		corrected line of every bus point, aligned with busTrajectories.coordinates. Points of buses not
+		corrected and points without a line get "No_line"
+	"""
+	lineDetected = np.full(len(busTrajectories.coordinates), "No_line", dtype=object)
+	busPosition = busTrajectories.index()
+	for busId in busResultTable.columns.to_list():
+		position = busPosition[busId]
+		start, end = busTrajectories.offsets[position], busTrajectories.offsets[position+1]
+		lineDetected[start:end] = busResultTable[busId].to_numpy()[:end-start]
+	lineDetected[pd.isna(lineDetected) | (lineDetected == "")] = "No_line"
+	return lineDetected
+
+
+def WriteLineDetected(database, busTrajectories, busTimestamps, lineDetected, startDate, endDate, logging=None, incremental=False):
+	"""
+	Arguments:
+		database - psycopg2 connection
+		busTrajectories - Trajectories of the buses, as returned by StreamBusData
+		busTimestamps - time_detection of every point, aligned with busTrajectories.coordinates
+		lineDetected - corrected line of every point, aligned with busTrajectories.coordinates
+		startDate, endDate - time_detection interval of the data
+		logging - logger
+		incremental - data of the incremental mode (rows from the BusWindows windows), only the rows not corrected yet are updated
+	Returns:
+		amount of bus_data rows updated
+	Description:
+		Only (bus_id, time_detection, line_detected) is copied, into a temporary (unlogged) staging table,
+		and applied to bus_data by a single UPDATE. Everything runs in one transaction, rolled back on failure.
+	"""
+	buff = io.StringIO()
+	pd.DataFrame({
+		'bus_id': np.repeat(np.array(busTrajectories.ids, dtype=object), busTrajectories.lengths),
+		'time_detection': busTimestamps,
+		'line_detected': lineDetected,
+	}).to_csv(buff, header=False, index=False)
+	buff.seek(0)
+
+	try:
+		with database.cursor() as cursor:
+			cursor.execute(BUS_CORRECTION_STAGING)
+			cursor.copy_expert("COPY bus_correction (bus_id,time_detection,line_detected) FROM STDIN WITH (FORMAT csv)", buff)
+			cursor.execute(BUS_CORRECTION_UPDATE_NEW if incremental else BUS_CORRECTION_UPDATE, (startDate, endDate))
+			updated = cursor.rowcount
+		database.commit()
+	except BaseException:
+		database.rollback()
+		raise
+
+	if logging:
+		logging.debug(f"{updated} bus_data rows updated")
+	return updated
@@ -0,0 +1,125 @@
+#
+# LineData.py
+# Description:
+#	Line shapes acquisition with a persistent on-disk cache. Line shapes rarely change, so every line is
+#	stored once (coordinates, radians and cos(latitude)) under a directory named after a fingerprint of
+#	line_data (LINE_VERSION_QUERY) and reused by every run until the table changes.
+#
+
+import shutil
+import pathlib
+import tempfile
+
+import numpy as np
+
+from data_processing.Trajectories import LineShapes, Trajectories
+
+DEFAULT_CACHE_PATH = "/tmp/line_cache"
+
+# Exact aggregates of line_data (integer and numeric, so independent of the row order), computed in a single
+# scan without sorting or building text. Coordinates are summed in fixed point weighted by their line and
+# position, so edited, moved or renamed points change them
+LINE_VERSION_QUERY = """
+	SELECT
+		COUNT(*),
+		MAX(position),
+		SUM(hashtext(concat_ws(',',line_id,direction))::bigint),
+		SUM(round(latitude*1e7)::numeric * (position+1) * hashtext(concat_ws(',',line_id,direction))),
+		SUM(round(longitude*1e7)::numeric * (position+1) * hashtext(concat_ws(',',line_id,direction)))
+	FROM line_data """
+
+LINE_DATA_QUERY = """
+	SELECT
+		line_id,direction,latitude,longitude
+	FROM line_data
+	ORDER BY line_id,direction,position """
+
+
+def GetCachePath(CONFIGS):
+	"""
+	Returns CONFIGS['data_acquisition']['lineCachePath'] as a path (defaults to DEFAULT_CACHE_PATH), None if set empty
+	"""
+	path = CONFIGS.get('data_acquisition','lineCachePath',fallback=DEFAULT_CACHE_PATH)
+	return pathlib.Path(path) if path else None
+
+
+def LineDataVersion(database):
+	"""
+	Returns a string identifying the current content of line_data
+	"""
+	with database.cursor() as cursor:
+		cursor.execute(LINE_VERSION_QUERY)
+		aggregates = cursor.fetchone()
+	return "_".join(str(aggregate) for aggregate in aggregates)
+
+
+def FetchLineShapes(database):
+	"""
+	Arguments:
+		database - psycopg2 connection
+	Returns:
+		LineShapes of every line and direction in line_data, ordered by size (biggest first), ids are (line_id, direction)
+	"""
+	with database.cursor() as cursor:
+		cursor.execute(LINE_DATA_QUERY)
+		rows = cursor.fetchall()
+	if len(rows) == 0:
+		return LineShapes(np.zeros((0,2)), [0], [])
+
+	lineIds, directions, lat, lon = zip(*rows)
+	keys = np.array([f"{lineId}\x00{direction}" for lineId, direction in zip(lineIds, directions)], dtype=object)
+	coordinates = np.column_stack((np.array(lat, dtype=float), np.array(lon, dtype=float)))
+
+	# Rows are ordered by line, so each (line_id, direction) is a contiguous run
+	starts = np.concatenate(([0], np.nonzero(keys[1:] != keys[:-1])[0] + 1))
+	ends = np.append(starts[1:], len(rows))
+	ids = [(lineIds[start], str(directions[start])) for start in starts]
+
+	order = sorted(range(len(starts)), key=lambda i: (-(ends[i] - starts[i]), ids[i]))
+	lines = Trajectories.fromArrays([coordinates[starts[i]:ends[i]] for i in order], [ids[i] for i in order])
+	return LineShapes.fromTrajectories(lines)
+
+
+def LoadLineShapes(database, CONFIGS, logging=None, version=None):
+	"""
+	Arguments:
+		database - psycopg2 connection
+		CONFIGS - configparser object
+		logging - logger
+		version - (optional) LineDataVersion already queried by the caller
+	Returns:
+		LineShapes of every line, from the cache when line_data did not change since it was stored
+	Configurations:
+		CONFIGS['data_acquisition']['lineCachePath'] - (optional) cache directory, empty disables the cache
+	"""
+	cachePath = GetCachePath(CONFIGS)
+	if cachePath is None:
+		return FetchLineShapes(database)
+
+	version = LineDataVersion(database) if version is None else version
+	versionPath = cachePath / version
+	if versionPath.exists():
+		if logging:
+			logging.debug(f"Line shapes loaded from cache {versionPath}")
+		return LineShapes.load(versionPath, mmapMode="r")
+
+	if logging:
+		logging.info(f"line_data changed, rebuilding line shape cache at {versionPath}")
+	lineShapes = FetchLineShapes(database)
+
+	# Written in a temporary directory and renamed, so a crash never leaves a partial cache behind
+	cachePath.mkdir(parents=True, exist_ok=True)
+	temporaryPath = pathlib.Path(tempfile.mkdtemp(prefix=".building-", dir=cachePath))
+	try:
+		lineShapes.save(temporaryPath)
+		temporaryPath.rename(versionPath)
+	except OSError:
+		shutil.rmtree(temporaryPath, ignore_errors=True)
+		if not versionPath.exists():
+			raise
+
+	# Older versions are no longer useful
+	for oldPath in cachePath.iterdir():
+		if oldPath != versionPath and not oldPath.name.startswith("."):
+			shutil.rmtree(oldPath, ignore_errors=True)
+	return lineShapes
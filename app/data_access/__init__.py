@@ -0,0 +1 @@
+__all__ = ["BusCache","BusData","LineData"]
@@ -0,0 +1,99 @@
+#
+# Backend.py
+# Description:
+#	Array backend used by the detection and correction phases. NumPy is always available and CuPy is
+#	only used when it is installed and a GPU can be reached.
+#
+
+import numpy as np
+
+try:
+	import cupy as cp
+except ImportError:
+	cp = None
+
+BACKENDS = ("auto", "numpy", "cupy")
+
+# Default size (in megabytes) of each intermediate distance tile computed on the CPU path
+DEFAULT_CPU_TILE_MBYTES = 4
+
+
+def CupyAvailable():
+	"""
+	Returns:
+		True if cupy is installed and at least one GPU can be reached
+	"""
+	if cp is None:
+		return False
+	try:
+		return cp.cuda.runtime.getDeviceCount() > 0
+	except Exception:
+		return False
+
+
+def GetBackend(name="auto"):
+	"""
+	Arguments:
+		name - 'auto', 'numpy' or 'cupy'. 'auto' picks cupy when available, numpy otherwise
+	Returns:
+		xp - array module (numpy or cupy) used for the computations
+	"""
+	name = (name or "auto").strip().lower()
+	if name not in BACKENDS:
+		raise ValueError(f"Unknown array backend '{name}'. Options are: {', '.join(BACKENDS)}")
+
+	if name == "numpy":
+		return np
+	if name == "cupy":
+		if not CupyAvailable():
+			raise ImportError("cupy backend requested but cupy is not installed or no GPU is available")
+		return cp
+	return cp if CupyAvailable() else np
+
+
+def GetConfiguredBackend(CONFIGS):
+	"""
+	Arguments:
+		CONFIGS - configparser object
+	Returns:
+		xp - array module chosen by CONFIGS['default_correction_method']['backend'] (defaults to 'auto')
+	"""
+	return GetBackend(CONFIGS.get('default_correction_method', 'backend', fallback="auto"))
+
+
+def GetArrayModule(*arrays):
+	"""
+	Returns the array module (numpy or cupy) of the given arrays
+	"""
+	if cp is not None:
+		return cp.get_array_module(*arrays)
+	return np
+
+
+def IsGPU(xp):
+	return xp is not np
+
+
+def ToDevice(array, xp):
+	"""
+	Moves <array> to the device handled by <xp>
+	"""
+	return xp.asarray(array)
+
+
+def ToHost(array):
+	"""
+	Returns <array> as a numpy array, copying it from the GPU if needed
+	"""
+	if cp is not None and isinstance(array, cp.ndarray):
+		return cp.asnumpy(array)
+	return np.asarray(array)
+
+
+def GetTileBytes(CONFIGS):
+	"""
+	Returns the size in bytes of the distance tiles used on the CPU path
+	(CONFIGS['default_correction_method']['cpuTileMBytes'])
+	"""
+	tileMBytes = CONFIGS.getfloat('default_correction_method', 'cpuTileMBytes', fallback=DEFAULT_CPU_TILE_MBYTES)
+	return int(tileMBytes * 2**20)
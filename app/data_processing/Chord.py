@@ -0,0 +1,123 @@
+#
+# Chord.py
+# Description:
+#	Line detection by matrix products of 3-D unit vectors. A line point is within the tolerance of a bus
+#	point when the central angle between them is below tolerance/R, that is when the dot product of their
+#	unit vectors is above cos(tolerance/R). The bus point x line point comparisons of a batch of buses become
+#	one BLAS matrix multiply followed by a maximum per bus and line point. Dot products too close to the
+#	threshold for float64 to decide are checked again with the haversine of the dense engine, so results
+#	are the same.
+#
+
+import numpy as np
+
+from data_processing import Distance, TilePlanner
+from data_processing.Trajectories import LineShapes
+
+# Dot products within this margin of cos(tolerance/R) are decided by the haversine instead. Rounding of the
+# unit vectors and of the products stays orders of magnitude below it
+GEMM_MARGIN = 1e-12
+
+# Maximum amount of (busPoint, linePoint) dot products computed at once, when no budget is given
+MAX_ELEMENTS = 2**22
+
+
+def UnitVectors(lat, lon, cosLat=None):
+	"""
+	Returns the (point, x/y/z) unit vectors of latitudes and longitudes in radians
+	"""
+	cosLat = np.cos(lat) if cosLat is None else cosLat
+	return np.column_stack((cosLat * np.cos(lon), cosLat * np.sin(lon), np.sin(lat)))
+
+
+def BusBatches(busLengths, candidates, maxElements):
+	"""
+	Groups the buses with points in batches of about sqrt(<maxElements>) stacked points (at least one bus
+	each), so each matrix multiply is a square block of bus points by line points. The buses of a batch have
+	the same candidate lines, and are ordered by decreasing length (see TilePlanner)
+	Returns:
+		list of (bus indices, line indices of the batch or None for every line)
+	"""
+	fits = lambda count, maxLength: count * maxLength <= max(1, int(np.sqrt(maxElements)))
+	buses = np.nonzero(busLengths)[0]
+	if candidates is None:
+		groups = [(buses, None)]
+	else:
+		groups = TilePlanner.CandidateGroups(buses, candidates)
+
+	batches = []
+	for group, lines in groups:
+		group = TilePlanner.ByLength(group, busLengths)
+		batches += [(tile, lines) for tile in TilePlanner.SplitTiles(group, busLengths[group], fits)]
+	return batches
+
+
+def DetectLines(busTrajectories, lineTrajectories, tolerance, detectionPercentage, candidates=None, maxElements=MAX_ELEMENTS):
+	"""
+	Arguments:
+		busTrajectories, lineTrajectories - Trajectories of the buses and lines
+		tolerance - distance tolerance in meters (haversine)
+		detectionPercentage - minimum fraction of close line points for detection
+		candidates - (optional) (bus, line) boolean matrix, only these pairs are evaluated
+		maxElements - maximum amount of (busPoint, linePoint) dot products computed at once. Several buses are
+			stacked in each matrix multiply (see BusBatches), the line points are chunked to fit
+	Returns:
+		(bus, line) boolean detection matrix, the same as the dense engine with the haversine distance
+	"""
+	# Converted like the padded tensors of the dense engine, so the haversine checks are the same
+	busLat, busLon = Distance.BusRadians(np.asarray(busTrajectories.coordinates, dtype=float))
+	busCos = np.cos(busLat)
+	if isinstance(lineTrajectories, LineShapes):
+		lineLat, lineLon, lineCos = (np.asarray(values, dtype=float) for values in (lineTrajectories.lat, lineTrajectories.lon, lineTrajectories.cosLat))
+	else:
+		lineLat, lineLon = Distance.LineRadians(np.asarray(lineTrajectories.coordinates, dtype=float))
+		lineCos = np.cos(lineLat)
+	busVectors = UnitVectors(busLat, busLon, busCos)
+	lineVectors = UnitVectors(lineLat, lineLon, lineCos)
+
+	angle = tolerance / Distance.EARTH_RADIUS
+	threshold = np.cos(angle) if angle < np.pi else -np.inf
+	busLengths = busTrajectories.lengths
+	busOffsets = busTrajectories.offsets
+	lineLengths = lineTrajectories.lengths
+	lineOffsets = lineTrajectories.offsets
+
+	results = np.zeros((len(busTrajectories), len(lineTrajectories)), dtype=bool)
+	for buses, lines in BusBatches(busLengths, candidates, maxElements):
+		lines = np.arange(len(lineTrajectories)) if lines is None else lines
+		lines = lines[lineLengths[lines] > 0]
+		if not len(lines):
+			continue
+
+		# Stacked points of the buses, bus i of the batch owns the points busStarts[i]:busStarts[i+1]
+		busPoints = np.concatenate([np.arange(busOffsets[bus], busOffsets[bus+1]) for bus in buses])
+		busStarts = np.concatenate(([0], np.cumsum(busLengths[buses])))
+		batchVectors = np.ascontiguousarray(busVectors[busPoints].T)
+
+		# Every point of the selected lines, with the position of its line in <lines>
+		counts = lineLengths[lines]
+		owner = np.repeat(np.arange(len(lines)), counts)
+		points = np.repeat(lineOffsets[lines], counts) + (np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts))
+
+		closeCounts = np.zeros((len(buses), len(lines)))
+		rowsPerChunk = max(1, maxElements // len(busPoints))
+		for chunk in range(0, len(points), rowsPerChunk):
+			chunkPoints = points[chunk:chunk+rowsPerChunk]
+			chunkOwner = owner[chunk:chunk+rowsPerChunk]
+			# (linePoint, busPoint) products, the bus points of each bus are contiguous in every row
+			maxDot = np.maximum.reduceat(lineVectors[chunkPoints] @ batchVectors, busStarts[:-1], axis=1).T
+			close = maxDot > threshold + GEMM_MARGIN
+
+			# Too close to the threshold, decided by the haversine of the dense engine
+			for row, column in zip(*np.nonzero(~close & (maxDot >= threshold - GEMM_MARGIN))):
+				bus = slice(busOffsets[buses[row]], busOffsets[buses[row]+1])
+				point = chunkPoints[column]
+				distances = Distance.PairDistance(busLat[bus], busLon[bus], lineLat[point], lineLon[point], busCos=busCos[bus], lineCos=lineCos[point])
+				close[row, column] = np.min(distances) < tolerance
+
+			# Close points of each line of the chunk, lines may continue on the next chunk
+			segments = np.concatenate(([0], np.nonzero(np.diff(chunkOwner))[0] + 1))
+			closeCounts[:, chunkOwner[segments]] += np.add.reduceat(close, segments, axis=1)
+
+		results[np.ix_(buses, lines)] = closeCounts / counts[None, :] > detectionPercentage
+	return results
@@ -0,0 +1,107 @@
+#
+# Distance.py
+# Description:
+#	Distance kernels shared by the detection engines and the correction phase
+#
+
+import numpy as np
+
+# Earth radius in meters
+EARTH_RADIUS = 1000*6371.0088
+
+def BroadcastRadians(busMatrix,lineMatrix,xp=np):
+	"""
+	Splits bus and line matrices into latitude/longitude in radians, shaped (bus, point, 1, 1) for buses
+	and (1, 1, line, point) for lines so that both broadcast into the (bus, busPoint, line, linePoint) tensor
+	"""
+	busLat = busMatrix[:,:,0,None,None] * (xp.pi/180)
+	busLon = busMatrix[:,:,1,None,None] * (xp.pi/180)
+	lineLat = lineMatrix[None,None,:,:,0] * xp.pi/180
+	lineLon = lineMatrix[None,None,:,:,1] * xp.pi/180
+	return busLat,busLon,lineLat,lineLon
+
+def BusRadians(points,xp=np):
+	"""
+	(point, lat/lon) in degrees to latitude and longitude in radians, converted like the buses in BroadcastRadians
+	"""
+	return points[:,0] * (xp.pi/180), points[:,1] * (xp.pi/180)
+
+def LineRadians(points,xp=np):
+	"""
+	(point, lat/lon) in degrees to latitude and longitude in radians, converted like the lines in BroadcastRadians
+	"""
+	return points[:,0] * xp.pi/180, points[:,1] * xp.pi/180
+
+def PairDistance(busLat,busLon,lineLat,lineLon,haversine=True,xp=np,busCos=None,lineCos=None):
+	"""
+	Elementwise distance between (broadcastable) bus and line coordinates in radians.
+	Haversine in meters or euclidian in radians, based on <haversine>.
+	busCos/lineCos are optional precomputed cos(busLat)/cos(lineLat)
+	"""
+	if haversine:
+		busCos = xp.cos(busLat) if busCos is None else busCos
+		lineCos = xp.cos(lineLat) if lineCos is None else lineCos
+		return 2*EARTH_RADIUS*xp.arcsin(
+		xp.sqrt(
+			(xp.sin((busLat - lineLat)*0.5)**2 + \
+			 busCos* lineCos * xp.sin((busLon - lineLon)*0.5)**2)
+		))
+	return xp.sqrt((busLat-lineLat)**2+(busLon-lineLon)**2)
+
+def ToleranceAngles(tolerance,maxLat):
+	"""
+	Returns the latitude and longitude differences (radians) beyond which two points are always farther
+	than <tolerance> meters, for points with absolute latitude up to <maxLat> (radians)
+	Description:
+		A pair closer than <tolerance> has |dLat| < tolerance/R. For the longitude, the haversine gives
+		cos(lat1)cos(lat2)hav(dLon) <= hav(tolerance/R), bounded using the highest absolute latitude a
+		point within tolerance of the others can have
+	"""
+	angle = tolerance / EARTH_RADIUS
+	cosMin = np.cos(min(maxLat + angle, np.pi/2))
+	ratio = np.sin(angle/2) / cosMin if cosMin > 0 else np.inf
+	return angle, (2*np.arcsin(ratio) if ratio < 1 else np.pi)
+
+# Distance modes, chosen by CONFIGS['default_correction_method']['distanceMode']
+#   haversine - float64 haversine between every pair (exact)
+#   projected - float32 local equirectangular projection, computed once, compared by squared meters
+DISTANCE_MODES = ("haversine","projected")
+
+def GetDistanceMode(CONFIGS):
+	mode = CONFIGS.get('default_correction_method','distanceMode',fallback="haversine")
+	if mode not in DISTANCE_MODES:
+		raise ValueError(f"Unknown distance mode '{mode}'. Options are: {', '.join(DISTANCE_MODES)}")
+	return mode
+
+def ProjectionOrigin(points):
+	"""
+	Returns the (latitude, longitude) in radians of the center of the bounding box of (point, lat/lon) degrees
+	"""
+	points = np.asarray(points,dtype=float)
+	if not np.any(~np.isnan(points[:,0])):
+		return 0.0, 0.0
+	lat,lon = BusRadians(points)
+	return (np.nanmin(lat)+np.nanmax(lat))/2, (np.nanmin(lon)+np.nanmax(lon))/2
+
+def Project(points,origin):
+	"""
+	(point, lat/lon) in degrees to float32 (point, north/east) meters from <origin>. Coordinates are
+	relative to the origin so that float32 keeps millimeter precision at city scale
+	"""
+	lat,lon = BusRadians(np.asarray(points,dtype=float))
+	projected = np.empty((len(lat),2),dtype=np.float32)
+	projected[:,0] = EARTH_RADIUS * (lat - origin[0])
+	projected[:,1] = EARTH_RADIUS * (lon - origin[1]) * np.cos(origin[0])
+	return projected
+
+def BroadcastPoints(busMatrix,lineMatrix):
+	"""
+	As BroadcastRadians, for projected coordinates (no conversion)
+	"""
+	return busMatrix[:,:,0,None,None],busMatrix[:,:,1,None,None],lineMatrix[None,None,:,:,0],lineMatrix[None,None,:,:,1]
+
+def SquaredDistance(busNorth,busEast,lineNorth,lineEast):
+	"""
+	Elementwise squared distance (square meters) between (broadcastable) projected coordinates
+	"""
+	return (busNorth - lineNorth)**2 + (busEast - lineEast)**2
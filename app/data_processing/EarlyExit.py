@@ -0,0 +1,116 @@
+#
+# EarlyExit.py
+# Description:
+#	Decision mode line detection. FilterData only needs to know if the fraction of close line points is
+#	above detectionPercentage, so the line points of each bus/line pair are evaluated in growing blocks and
+#	the pair stops as soon as the close points already reach the amount required for detection (clear hit)
+#	or the remaining points can no longer reach it (clear miss).
+#	This numpy engine decides between blocks: every point of a block is evaluated, a pair only stops before
+#	the next one. Stopping at the exact point where the pair is decided is done by the Numba kernels of the
+#	fused engine (see Fused), which share RequiredPoints.
+#
+
+import numpy as np
+
+from data_processing import Distance
+from data_processing.Trajectories import LineShapes
+
+# Line points of each pair in the first block, doubled on every following block
+DEFAULT_BLOCK_POINTS = 16
+
+# Maximum amount of (linePoint, busPoint) distances evaluated at once
+MAX_ELEMENTS = 2**21
+
+
+def RequiredPoints(lengths, detectionPercentage):
+	"""
+	Returns the minimum amount of close points of each line for detection, the smallest count c with
+	c/length > detectionPercentage (the comparison of FilterData). Lines that can never be detected get length+1
+	"""
+	lengths = np.asarray(lengths, dtype=np.int64)
+	required = np.clip(np.floor(detectionPercentage * lengths).astype(np.int64), 0, lengths + 1)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		# floor() may be off by one either way, the division is the exact criterion
+		for _ in range(2):
+			required = np.where((required > 0) & ((required - 1) / lengths > detectionPercentage), required - 1, required)
+		for _ in range(2):
+			required = np.where((required <= lengths) & ~(required / lengths > detectionPercentage), required + 1, required)
+	# Empty lines have a NaN fraction, never detected
+	return np.where(lengths > 0, required, 1)
+
+
+def GetBlockPoints(CONFIGS):
+	return CONFIGS.getint('default_correction_method', 'earlyBlockPoints', fallback=DEFAULT_BLOCK_POINTS)
+
+
+def DetectLines(busTrajectories, lineTrajectories, tolerance, detectionPercentage, candidates=None, projected=False, blockPoints=DEFAULT_BLOCK_POINTS):
+	"""
+	Arguments:
+		busTrajectories, lineTrajectories - Trajectories of the buses and lines
+		tolerance - distance tolerance in meters
+		detectionPercentage - minimum fraction of close line points for detection
+		candidates - (optional) (bus, line) boolean matrix, only these pairs are evaluated
+		projected - compares projected float32 coordinates (see Distance.Project) instead of the haversine
+		blockPoints - line points of each pair in the first block. Pairs are only stopped between blocks
+	Returns:
+		(bus, line) boolean detection matrix, the same as the dense engine
+	"""
+	lineLengths = lineTrajectories.lengths
+	lineOffsets = lineTrajectories.offsets
+	required = RequiredPoints(lineLengths, detectionPercentage)
+
+	if projected:
+		origin = Distance.ProjectionOrigin(lineTrajectories.coordinates if len(lineTrajectories.coordinates) else busTrajectories.coordinates)
+		busPoints = busTrajectories.projected(origin).coordinates
+		linePoints = lineTrajectories.projected(origin).coordinates
+		threshold = np.float32(tolerance)**2
+		Close = lambda bus, line: Distance.SquaredDistance(bus[0][None, :], bus[1][None, :], linePoints[line, 0, None], linePoints[line, 1, None]) < threshold
+		busColumns = lambda start, end: (busPoints[start:end, 0], busPoints[start:end, 1])
+	else:
+		# Converted like the padded tensors of the dense engine, so the distances are the same
+		busLat, busLon = Distance.BusRadians(np.asarray(busTrajectories.coordinates, dtype=float))
+		busCos = np.cos(busLat)
+		if isinstance(lineTrajectories, LineShapes):
+			lineLat, lineLon, lineCos = (np.asarray(values, dtype=float) for values in (lineTrajectories.lat, lineTrajectories.lon, lineTrajectories.cosLat))
+		else:
+			lineLat, lineLon = Distance.LineRadians(np.asarray(lineTrajectories.coordinates, dtype=float))
+			lineCos = np.cos(lineLat)
+		Close = lambda bus, line: Distance.PairDistance(bus[0][None, :], bus[1][None, :], lineLat[line, None], lineLon[line, None],
+			busCos=bus[2][None, :], lineCos=lineCos[line, None]) < tolerance
+		busColumns = lambda start, end: (busLat[start:end], busLon[start:end], busCos[start:end])
+
+	results = np.zeros((len(busTrajectories), len(lineTrajectories)), dtype=bool)
+	for busIndex in range(len(busTrajectories)):
+		lines = np.arange(len(lineTrajectories)) if candidates is None else np.nonzero(candidates[busIndex])[0]
+
+		# Pairs decided before any point: nothing is required, or more than the line has
+		results[busIndex, lines[required[lines] <= 0]] = True
+		active = lines[(required[lines] > 0) & (required[lines] <= lineLengths[lines])]
+		start, end = busTrajectories.offsets[busIndex], busTrajectories.offsets[busIndex+1]
+		if end == start:
+			continue
+		bus = busColumns(start, end)
+		rowsPerChunk = max(1, MAX_ELEMENTS // (end - start))
+
+		close = np.zeros(len(active), dtype=np.int64)
+		position = 0
+		block = blockPoints
+		while len(active):
+			# Next <block> points of every active line
+			counts = np.minimum(block, lineLengths[active] - position)
+			owner = np.repeat(np.arange(len(active)), counts)
+			points = np.repeat(lineOffsets[active] + position, counts) + (np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts))
+
+			for chunk in range(0, len(points), rowsPerChunk):
+				pointClose = np.any(Close(bus, points[chunk:chunk+rowsPerChunk]), axis=1)
+				close += np.bincount(owner[chunk:chunk+rowsPerChunk], weights=pointClose, minlength=len(active)).astype(np.int64)
+
+			position += block
+			remaining = np.maximum(lineLengths[active] - position, 0)
+			hit = close >= required[active]
+			miss = close + remaining < required[active]
+			results[busIndex, active[hit]] = True
+			undecided = ~(hit | miss)
+			active, close = active[undecided], close[undecided]
+			block *= 2
+	return results
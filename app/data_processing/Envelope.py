@@ -0,0 +1,79 @@
+#
+# Envelope.py
+# Description:
+#	Bounding box prefilter of bus x line pairs. A line point can only be within tolerance of a bus when the
+#	bounding boxes of both trajectories, expanded by the tolerance, intersect. Pairs failing this test have
+#	no close line point at all, so they are never detected and can skip the exact distance computation.
+#	In the projected mode the boxes are built from the same float32 projected points the engines compare.
+#
+
+import numpy as np
+
+from data_processing import Distance
+
+# Margin over the expansion to absorb floating point differences close to the tolerance
+ENVELOPE_MARGIN = 1 + 1e-6
+
+
+def Envelopes(trajectories, origin=None):
+	"""
+	Arguments:
+		trajectories - Trajectories
+		origin - (optional) projection origin, the boxes hold projected meters (see Distance.Project)
+	Returns:
+		low, high - (trajectory, lat/lon) minimum and maximum coordinates in radians, (north/east) meters when
+			projected. Empty trajectories get an inverted (+inf, -inf) box that intersects nothing
+	"""
+	low = np.full((len(trajectories), 2), np.inf)
+	high = np.full((len(trajectories), 2), -np.inf)
+	nonEmpty = trajectories.lengths > 0
+	if np.any(nonEmpty):
+		# Empty trajectories have no width, so the reduction of each start only spans its own trajectory
+		starts = trajectories.offsets[:-1][nonEmpty]
+		if origin is not None:
+			coordinates = np.asarray(trajectories.projected(origin).coordinates, dtype=float)
+			low[nonEmpty] = np.fmin.reduceat(coordinates, starts, axis=0)
+			high[nonEmpty] = np.fmax.reduceat(coordinates, starts, axis=0)
+		else:
+			coordinates = np.asarray(trajectories.coordinates, dtype=float)
+			low[nonEmpty] = np.column_stack(Distance.BusRadians(np.fmin.reduceat(coordinates, starts, axis=0)))
+			high[nonEmpty] = np.column_stack(Distance.BusRadians(np.fmax.reduceat(coordinates, starts, axis=0)))
+	return low, high
+
+
+def CandidatePairs(busTrajectories, lineTrajectories, tolerance, origin=None):
+	"""
+	Arguments:
+		busTrajectories - Trajectories of the buses
+		lineTrajectories - Trajectories of the lines
+		tolerance - distance tolerance in meters
+		origin - (optional) projection origin of the projected mode. Far from it, float32 rounding moves the projected
+			distances by more than the margin around the haversine, so the boxes are projected as well
+	Returns:
+		(bus, line) boolean matrix, False only for pairs that cannot have any line point within tolerance of the bus
+	"""
+	busLow, busHigh = Envelopes(busTrajectories, origin)
+	lineLow, lineHigh = Envelopes(lineTrajectories, origin)
+
+	if origin is not None:
+		margin = np.array([tolerance, tolerance]) * ENVELOPE_MARGIN
+		candidates = np.ones((len(busTrajectories), len(lineTrajectories)), dtype=bool)
+		for axis in (0, 1):
+			candidates &= (busLow[:, None, axis] - margin[axis]) <= lineHigh[None, :, axis]
+			candidates &= lineLow[None, :, axis] <= (busHigh[:, None, axis] + margin[axis])
+		return candidates
+
+	latitudes = np.concatenate((busLow[:, 0], busHigh[:, 0], lineLow[:, 0], lineHigh[:, 0]))
+	latitudes = latitudes[np.isfinite(latitudes)]
+	latAngle, lonAngle = Distance.ToleranceAngles(tolerance, np.max(np.abs(latitudes)) if len(latitudes) else 0)
+	margin = np.array([latAngle, lonAngle]) * ENVELOPE_MARGIN
+
+	# Expanded boxes overlap on both axes. Boxes crossing the antimeridian are not handled, any
+	# longitude expansion reaching pi keeps every pair
+	candidates = np.ones((len(busTrajectories), len(lineTrajectories)), dtype=bool)
+	for axis in (0, 1):
+		if axis == 1 and margin[axis] >= np.pi:
+			continue
+		candidates &= (busLow[:, None, axis] - margin[axis]) <= lineHigh[None, :, axis]
+		candidates &= lineLow[None, :, axis] <= (busHigh[:, None, axis] + margin[axis])
+	return candidates
@@ -0,0 +1,154 @@
+#
+# Fused.py
+# Description:
+#	Fused line detection kernel, compiled with Numba when it is installed. Each bus/line pair is evaluated
+#	straight from the ragged trajectory buffers: every line point scans the bus points until one is within
+#	the tolerance and the close points are counted, so neither the (bus, busPoint, line, linePoint) distance
+#	tensor nor any NaN padding is ever allocated. Pairs run in parallel threads.
+#
+
+import math
+
+import numpy as np
+
+from data_processing import Distance, EarlyExit
+from data_processing.Trajectories import LineShapes
+
+try:
+	import numba
+except ImportError:
+	numba = None
+
+prange = numba.prange if numba is not None else range
+
+EARTH_RADIUS = Distance.EARTH_RADIUS
+
+# Relative margin of the haversine term prefilter, the exact distance is only computed below it
+HAVERSINE_MARGIN = 1 + 1e-9
+
+
+def NumbaAvailable():
+	"""
+	Returns:
+		True if numba is installed
+	"""
+	return numba is not None
+
+
+def _HaversineCounts(busLat, busLon, busCos, busOffsets, lineLat, lineLon, lineCos, lineOffsets, pairBus, pairLine, tolerance, havTolerance, required, out):
+	"""
+	out[pair] - amount of points of line pairLine[pair] within <tolerance> meters (haversine) of bus pairBus[pair].
+	With required[line] >= 0 the pair stops at the first line point where the count reaches it or can no longer
+	reach it (see EarlyExit), so only the comparison with required[line] is exact
+	"""
+	for pair in prange(len(pairBus)):
+		bus = pairBus[pair]
+		line = pairLine[pair]
+		close = 0
+		for j in range(lineOffsets[line], lineOffsets[line+1]):
+			if required[line] >= 0 and (close >= required[line] or close + lineOffsets[line+1] - j < required[line]):
+				break
+			for i in range(busOffsets[bus], busOffsets[bus+1]):
+				hav = math.sin((busLat[i] - lineLat[j])*0.5)**2 + busCos[i] * lineCos[j] * math.sin((busLon[i] - lineLon[j])*0.5)**2
+				# Same expression as Distance.PairDistance, only evaluated when the haversine term may be close
+				if hav < havTolerance and 2*EARTH_RADIUS*math.asin(math.sqrt(hav)) < tolerance:
+					close += 1
+					break
+		out[pair] = close
+
+
+def _ProjectedCounts(busNorth, busEast, busOffsets, lineNorth, lineEast, lineOffsets, pairBus, pairLine, threshold, required, out):
+	"""
+	As _HaversineCounts, for projected float32 coordinates compared by squared distance to <threshold>
+	"""
+	for pair in prange(len(pairBus)):
+		bus = pairBus[pair]
+		line = pairLine[pair]
+		close = 0
+		for j in range(lineOffsets[line], lineOffsets[line+1]):
+			if required[line] >= 0 and (close >= required[line] or close + lineOffsets[line+1] - j < required[line]):
+				break
+			for i in range(busOffsets[bus], busOffsets[bus+1]):
+				if (busNorth[i] - lineNorth[j])**2 + (busEast[i] - lineEast[j])**2 < threshold:
+					close += 1
+					break
+		out[pair] = close
+
+
+# Compiled on the first call of each process. Not cached on disk, the cache would be written next to this file
+if numba is not None:
+	_HaversineCounts = numba.njit(parallel=True)(_HaversineCounts)
+	_ProjectedCounts = numba.njit(parallel=True)(_ProjectedCounts)
+
+
+def PairCounts(busTrajectories, lineTrajectories, tolerance, pairBus, pairLine, projected=False, required=None):
+	"""
+	Arguments:
+		busTrajectories, lineTrajectories - Trajectories of the buses and lines
+		tolerance - distance tolerance in meters
+		pairBus, pairLine - bus and line index of every evaluated pair
+		projected - compares projected float32 coordinates (see Distance.Project) instead of the haversine
+		required - (optional) amount of close points required by each line (see EarlyExit.RequiredPoints).
+			Pairs stop as soon as their detection is decided
+	Returns:
+		amount of line points within tolerance of the bus, for every pair. With <required>, only whether it
+		reaches required is exact
+	"""
+	pairBus = np.ascontiguousarray(pairBus, dtype=np.int64)
+	pairLine = np.ascontiguousarray(pairLine, dtype=np.int64)
+	required = np.full(len(lineTrajectories), -1, dtype=np.int64) if required is None else np.ascontiguousarray(required, dtype=np.int64)
+	out = np.empty(len(pairBus), dtype=np.int64)
+
+	if projected:
+		origin = Distance.ProjectionOrigin(lineTrajectories.coordinates if len(lineTrajectories.coordinates) else busTrajectories.coordinates)
+		bus = busTrajectories.projected(origin).coordinates
+		line = lineTrajectories.projected(origin).coordinates
+		_ProjectedCounts(np.ascontiguousarray(bus[:, 0]), np.ascontiguousarray(bus[:, 1]), busTrajectories.offsets,
+			np.ascontiguousarray(line[:, 0]), np.ascontiguousarray(line[:, 1]), lineTrajectories.offsets,
+			pairBus, pairLine, np.float32(tolerance)**2, required, out)
+		return out
+
+	# Converted like the padded tensors of the dense engine, so the distances are the same
+	busLat, busLon = Distance.BusRadians(np.asarray(busTrajectories.coordinates, dtype=float))
+	if isinstance(lineTrajectories, LineShapes):
+		lineLat, lineLon, lineCos = (np.asarray(values, dtype=float) for values in (lineTrajectories.lat, lineTrajectories.lon, lineTrajectories.cosLat))
+	else:
+		lineLat, lineLon = Distance.LineRadians(np.asarray(lineTrajectories.coordinates, dtype=float))
+		lineCos = np.cos(lineLat)
+	havTolerance = np.sin(tolerance / (2*EARTH_RADIUS))**2 * HAVERSINE_MARGIN
+	_HaversineCounts(busLat, busLon, np.cos(busLat), busTrajectories.offsets, lineLat, lineLon, lineCos, lineTrajectories.offsets,
+		pairBus, pairLine, float(tolerance), havTolerance, required, out)
+	return out
+
+
+def PairFractions(busTrajectories, lineTrajectories, tolerance, pairBus, pairLine, projected=False):
+	"""
+	Returns the fraction of the line points within tolerance of the bus, for every pair (NaN for empty lines)
+	"""
+	lengths = lineTrajectories.lengths[np.asarray(pairLine, dtype=np.int64)]
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return PairCounts(busTrajectories, lineTrajectories, tolerance, pairBus, pairLine, projected) / lengths
+
+
+def DetectLines(busTrajectories, lineTrajectories, tolerance, detectionPercentage, candidates=None, projected=False):
+	"""
+	Arguments:
+		busTrajectories, lineTrajectories - Trajectories of the buses and lines
+		tolerance - distance tolerance in meters
+		detectionPercentage - minimum fraction of close line points for detection
+		candidates - (optional) (bus, line) boolean matrix, only these pairs are evaluated
+		projected - see PairFractions
+	Returns:
+		(bus, line) boolean detection matrix
+	"""
+	if numba is None:
+		raise ImportError("fused detection engine requested but numba is not installed")
+	if candidates is None:
+		candidates = np.ones((len(busTrajectories), len(lineTrajectories)), dtype=bool)
+	pairBus, pairLine = np.nonzero(candidates)
+
+	# Decision mode, pairs stop once detected or out of reach
+	required = EarlyExit.RequiredPoints(lineTrajectories.lengths, detectionPercentage)
+	results = np.zeros((len(busTrajectories), len(lineTrajectories)), dtype=bool)
+	results[pairBus, pairLine] = PairCounts(busTrajectories, lineTrajectories, tolerance, pairBus, pairLine, projected, required) >= required[pairLine]
+	return results
@@ -1,6 +1,8 @@
 #
-# DataCorrection.py
+# LineCorrection.py
 # Descricao:
+#	Correção da linha de cada ponto dos ônibus detectados. Os grupos curtos de pontos são eliminados (RunLength)
+#	e cada ponto reivindicado por várias linhas fica com a linha do maior grupo que o contém.
 #
 
 import configparser
@@ -8,154 +10,131 @@ import logging
 
 import pandas as pd
 import numpy as np
-import cupy as cp
 
-from LineDetection import HaversineLocal
+from data_processing import Backend, Distance, RunLength
+from data_processing.LineDetection import HaversineLocal
+from data_processing.RunLength import SuppressShortRuns
 
-def sigmoid(array):
-	return 1 / (1 + np.exp(-array))
-
-def CorrectData(detectionTable, busMatrix, linesMatrix, busList, lineList, CONFIGS):
+def CorrectData(detectionTable, busTrajectories, lineTrajectories, CONFIGS, pointDistances=None):
 	"""
 	Arguments:
 		detectionTable - detectionTable[('<linha>', '<direção>']['<ônibus>'] -> True se linha pertence ao ônibus
-		busMatrix - busMatrix[<onibus>][<coord>][<lat/lon>]
-		linesMatrix - linesMatrix[<linha>][<coord>][<lat/lon>]
-		busList - busList[<indice>] -> (<identificadorOnibus>,<tamanho>)
-		lineList -lineList[<indice>] -> (<identificadorLinha>,<direcao>)
+		busTrajectories - Trajectories of the buses, ids are bus_id
+		lineTrajectories - Trajectories of the lines, ids are (line_id, direction)
 		CONFIGS - configparser object
+		pointDistances - (optional) per point distances emitted by LineDetection.FilterData. Pairs found there are
+			not computed again, only the missing ones (e.g. lines kept from the incremental context)
 	Returns:
-		results - Pandas DataFrame of same bus data with appended column of corrected line column data
+		results - Pandas DataFrame with one column per detected bus holding the corrected line of each of its points (None when no line)
 	Description:
 		Gets all of bus data and corrects each bus' line column based on results from FilterData
 	Required Configurations:
-		CONFIGS['line_correction']['limit'] - The minimun value to consider a set of points as a valid group
+		CONFIGS['default_correction_method']['limit'] - The minimun value to consider a set of points as a valid group
+		CONFIGS['default_correction_method']['distanceTolerance'] - maximum distance (meters) of a bus point to the line
+		CONFIGS['default_correction_method']['distanceMode'] - (optional) one of Distance.DISTANCE_MODES, defaults to 'haversine'
 	"""
+	distanceTolerance = float(CONFIGS["default_correction_method"]["distanceTolerance"])
+	limit = int(CONFIGS['default_correction_method']['limit'])
+
+	busIndex = busTrajectories.index()
+	lineIndex = lineTrajectories.index()
+	detections = np.asarray(detectionTable, dtype=bool)
+	linePairs = list(detectionTable.index)
+
+	xp = Backend.GetConfiguredBackend(CONFIGS)
 
-	# Listagem com todos os conjuntos linha-ônibus detectados. Série contendo tuplas (<linha>,<sentido>,<onibus>)
-	detections = detectionTable[detectionTable == True].stack()
-	buses_detected = detections.index.get_level_values(2).unique()
-	lines_detected = list(set(map(lambda x: (x[0], x[1]), detections.index)))
-	busList = list(map(lambda x: x[0], busList))
-	lineList = list(map(lambda x: (x[0]), lineList))
+	# Projected mode: trajectories are projected once and compared by squared meters
+	projected = Distance.GetDistanceMode(CONFIGS) == "projected"
+	if projected:
+		origin = Distance.ProjectionOrigin(lineTrajectories.coordinates if len(lineTrajectories.coordinates) else busTrajectories.coordinates)
+		busTrajectories = busTrajectories.projected(origin)
+		lineTrajectories = lineTrajectories.projected(origin)
+	pointType = np.float32 if projected else float
 
+	busesDetected = []
 	correctedData = []
-	for bus in buses_detected:
-		busMap = np.array(busMatrix[busList.index(bus)])
-		busMap = busMap[~np.any(np.isnan(busMap), axis=1)]					# Removendo valores NaN no fim do tensor
-		lines = [i[0] for i in detectionTable[bus].loc[detectionTable[bus] == True].index.unique()]
-		linesToCompare = []
-
-		for line in lines:
-			lineMap = np.array(linesMatrix[lineList.index(line)])
-			lineMap = lineMap[~np.any(np.isnan(lineMap), axis=1)]
-			distanceMatrix = sigmoid(int(CONFIGS["default_correction_method"]["distanceTolerance"]) 
-										- cp.asnumpy(HaversineLocal(cp.asarray(np.expand_dims(busMap,0)), cp.asarray(np.expand_dims(lineMap,0)))[0]))
-			distanceMatrix = np.squeeze(distanceMatrix)
-			belongingArray = np.round(np.amax(distanceMatrix, axis=1))
-			belongingArray = CorrectLine(belongingArray, CONFIGS['default_correction_method']['limit'])
-			linesToCompare += [belongingArray]
-		belongingMatrix = np.stack(linesToCompare)
-		# Os pontos em que devemos nos preocupar são aqueles em que há sobreposição nas linhas, e reconhecendo estes pontos
-		# podemos determinar o tamanho do grupo que estes pontos pertencem e usar este critério como abordagem para resolver o conflito
-		conflicts1 = np.sum(belongingMatrix,axis=0)
-		conflicts2 = np.nonzero(conflicts1 > 1)
-		conflicts  = np.stack(conflicts2)
-		#conflicts = np.stack(np.nonzero(np.sum(belongingMatrix,axis=0) > 1))
-
-		if len(conflicts) != 0:
-			# Matriz_prioridade consiste em uma matriz de M linhas onde M é o número de linhas de ônibus e N colunas onde N
-			# é o número de pontos onde ocorreu conflito
-			# A matriz_prioridade é preenchida com o número de pontos no grupo em que o conflito em um determinado ponto para
-			# uma determinada linha foi detectado
-			priorityMatrix = np.zeros((belongingMatrix.shape[0], conflicts.shape[0]))
-			for line in range(len(belongingMatrix)):
-				#ocurrences, counters = torch.unique_consecutive(belongingMatrix[line], return_counts=True)
-				ocurrences = belongingMatrix[line][np.insert(np.absolute(np.diff(belongingMatrix[line])) > 0.00001, 0, True)]
-				counters = np.diff(np.concatenate(([True],np.absolute(np.diff(belongingMatrix[line])) > 0,[True])).nonzero()[0])
-				print("occurences")
-				print(ocurrences)
-				print("counters")
-				print(counters)
-				auxiliarCounters = np.cumsum(counters, 0)
-				print("auxiliary counters")
-				print(auxiliarCounters)
-				print("belonging")
-				print(belongingMatrix)
-				for conflict in range(conflicts.shape[0]):
-					if len(conflicts[conflict]) == 0:
-						priorityMatrix[line][conflict] = 0
-						break
-					print("conflictsconfigl")
-					print(conflicts)
-					contagemConflitos = np.where(auxiliarCounters > conflicts[conflict])[0]
-					print(contagemConflitos)
-					if len(contagemConflitos) == 0:
-						priorityMatrix[line][conflict] = 0
-						break
-					grupo = contagemConflitos.item()
-					priorityMatrix[line][conflict] = counters[grupo] if ocurrences[grupo] == 1 else 0
-			
-			# As linhas cujo grupo que engloba o ponto de conflito é maior é selecionada para ser feita a substituição
-			#_, dominantLines = priorityMatrix.max(0)
-			dominantLines = priorityMatrix.max(0)
-
-			dominantLines = dominantLines if (dominantLines.shape != tuple() and dominantLines.shape != (1,)) else dominantLines
-			# Por fim a matriz de pertencimento é atualizada eliminando os conflitos
-			for line in range(len(belongingMatrix)):
-				for conflict in range(conflicts.shape[0]):
-					if line != dominantLines[conflict]:
-						belongingMatrix[line][conflicts[conflict]] = 0
-			# Para evitar flutuações que possam surgir nesse processo os arrays de pertencimento de linha
-			# passam novamente pela função CorrectLine()
-			for line in range(len(belongingMatrix)):
-				belongingMatrix[line] = CorrectLine(belongingMatrix[line], CONFIGS['default_correction_method']['limit'])
-		correctedData += [[lines[i] for i in np.where(belongingMatrix == belongingMatrix.max(0))[0]]]
+	for busColumn in np.nonzero(np.any(detections, axis=0))[0]:
+		bus = detectionTable.columns[busColumn]
+		busPoints = busTrajectories[busIndex[bus]]
+		busMap = None
+		lineRows = np.nonzero(detections[:, busColumn])[0]
+
+		# Matriz de pertencimento (linha x ponto do ônibus): 1 quando o ponto está a menos de distanceTolerance da linha
+		belongingMatrix = np.zeros((len(lineRows), len(busPoints)), dtype="int64")
+		for row, lineRow in enumerate(lineRows):
+			distances = pointDistances.get((bus, linePairs[lineRow])) if pointDistances is not None else None
+			if distances is not None:
+				belongingMatrix[row] = np.asarray(distances, dtype=float) < distanceTolerance
+				continue
+
+			if busMap is None:
+				busMap = Backend.ToDevice(np.expand_dims(np.array(busPoints, dtype=pointType), 0), xp)
+			lineMap = Backend.ToDevice(np.expand_dims(np.array(lineTrajectories[lineIndex[linePairs[lineRow]]], dtype=pointType), 0), xp)
+			if projected:
+				distances = Backend.ToHost(Distance.SquaredDistance(*Distance.BroadcastPoints(busMap, lineMap)))[0, :, 0, :]
+				belongingMatrix[row] = np.min(distances, axis=1) < np.float32(distanceTolerance)**2
+			else:
+				distances = Backend.ToHost(HaversineLocal(busMap, lineMap)[0])[0, :, 0, :]
+				belongingMatrix[row] = np.min(distances, axis=1) < distanceTolerance
+
+		belongingMatrix = SuppressShortRuns(belongingMatrix, limit)
+		belongingMatrix = ResolveConflicts(belongingMatrix, limit)
+
+		# Cada ponto recebe a linha com o maior grupo que o contém, ou None se nenhuma linha o contém
+		dominantLines = np.argmax(RunLength.RunLengths(belongingMatrix) * belongingMatrix, axis=0)
+		lines = np.array([linePairs[lineRow][0] for lineRow in lineRows] + [None], dtype=object)
+		correctedData += [list(lines[np.where(np.any(belongingMatrix, axis=0), dominantLines, len(lineRows))])]
+		busesDetected += [bus]
+
 	# Criação de dataframe pandas. matriz de m linhas representando os ônibus e n colunas representando os pontos de ônibus.
-	correctedDataframe = pd.DataFrame(correctedData, index=buses_detected)
+	correctedDataframe = pd.DataFrame(correctedData, index=busesDetected)
 
 	return correctedDataframe.T
 
 
+def ResolveConflicts(belongingMatrix, limit):
+	"""
+	Arguments:
+		belongingMatrix - (line, point) binary matrix of one bus
+		limit - The minimun value to consider a set of points as a valid group
+	Returns:
+		belongingMatrix where each point claimed by more than one line is kept only by the line whose group
+		containing that point is the largest
+	"""
+	# Os pontos em que devemos nos preocupar são aqueles em que há sobreposição nas linhas, e reconhecendo estes pontos
+	# podemos determinar o tamanho do grupo que estes pontos pertencem e usar este critério como abordagem para resolver o conflito
+	belongingMatrix = np.asarray(belongingMatrix, dtype="int64")
+	conflicts = np.sum(belongingMatrix, axis=0) > 1
+	if not np.any(conflicts):
+		return belongingMatrix
+
+	# Matriz de prioridade: tamanho do grupo de cada linha que engloba cada ponto (0 se o ponto não pertence à linha)
+	priorityMatrix = RunLength.RunLengths(belongingMatrix) * belongingMatrix
+	dominantLines = np.argmax(priorityMatrix, axis=0)
+
+	# Por fim a matriz de pertencimento é atualizada eliminando os conflitos
+	dominated = conflicts[None, :] & (np.arange(len(belongingMatrix))[:, None] != dominantLines[None, :])
+	belongingMatrix = np.where(dominated, 0, belongingMatrix)
+
+	# Para evitar flutuações que possam surgir nesse processo os arrays de pertencimento de linha
+	# passam novamente pela função CorrectLine()
+	return SuppressShortRuns(belongingMatrix, limit)
+
+
 def CorrectLine(LineDetected, limite):
 	"""
 	The function receives a 'belonging array'  for one line and the minimum group limit and eliminate fluctuations.
 	Arguments:
-		LineDetected: 'belonging array' (torch tensor).
+		LineDetected: 'belonging array'.
 		limit: The minimun value to consider a set of points as a valid group
 	Return: new array without fluctuations
 	"""
-	
-	# Resumimos a quantidade de informação utilizando o método unique_consecutive, criando o tensor ocorrencias com
-	# as sequências de grupos e o tensor contadores com o número de ocorrências para o i-ésimo grupo
-	#ocorrencias, contadores = torch.unique_consecutive(LineDetected, return_counts=True)
-	ocorrencias = cp.asnumpy(LineDetected)[np.insert(np.absolute(np.diff(cp.asnumpy(LineDetected))) > 0.00001, 0, True)]
-	contadores = np.diff(np.concatenate(([True],np.absolute(np.diff(cp.asnumpy(LineDetected))) > 0,[True])).nonzero()[0])
-
-	# Array de contador auxiliar para saber onde alterar no array original
-	contadores_auxiliar = contadores.cumsum()
-	
-	# Criar máscara para substituição no array de LineDetected
-	mascara = np.zeros((LineDetected.shape[0]), dtype="bool")
-
-	substituidos = np.where(contadores < int(limite))[0]
-	if len(substituidos) != 0:
-		for grupo in substituidos:
-			if grupo == 0:
-				inicio = contadores_auxiliar[0]
-			else:
-				inicio = contadores_auxiliar[grupo - 1]
-			fim = inicio + contadores[grupo]
-			mascara[inicio:fim] = True
-
-	# Eliminar flutuações removendo grupos pequenos
-	linha_Corrigida = np.where(mascara, np.logical_not(cp.asnumpy(LineDetected)).astype("int64"), cp.asnumpy(LineDetected).astype("int64"))
-	
-	return linha_Corrigida
+	return SuppressShortRuns(Backend.ToHost(LineDetected), limite)
 
 
 if __name__ == "__main__":
 	from time import time
+	from data_processing.Trajectories import Trajectories
 
 	CONFIGS = configparser.ConfigParser()
 	CONFIGS['default_correction_method'] = {'limit': '3', 'distanceTolerance': '300'}
@@ -176,7 +155,7 @@ if __name__ == "__main__":
 	print("antes:\n", matrizOnibus)
 	print("oni:\n",oni)
 	print("li:\n",li)
-	resultado = CorrectData(matrizOnibus, oni, li, busList, lineList, CONFIGS)
+	resultado = CorrectData(matrizOnibus, Trajectories.fromPadded(oni, [i[0] for i in busList]), Trajectories.fromPadded(li, lineList), CONFIGS)
 	print("depois:\n", resultado.to_string())
 #	 """
 
@@ -189,13 +168,13 @@ if __name__ == "__main__":
 	oni = np.random.rand(QO,PPO,2) * 100
 	li = np.random.rand(QL,PPL,2) * 100
 	busList = ['O'+str(i) for i in range(QO)]
-	lineList = [('L'+str(i),0) for i in range(QL)]
+	lineList = [('L'+str(i),'0') for i in range(QL)]
 	
 	matrizOnibus = pd.DataFrame((np.random.rand(QL,QO) > 0.5), index=pd.MultiIndex.from_tuples(lineList), columns=busList)
 
 	print("Starting")
 	start = time()
-	resultado = CorrectData(matrizOnibus, oni, li, busList, lineList, CONFIGS)
+	resultado = CorrectData(matrizOnibus, Trajectories.fromPadded(oni, busList), Trajectories.fromPadded(li, lineList), CONFIGS)
 	end = time()
 
 	print(f"time:{end-start}")
@@ -1,94 +1,386 @@
-import cupy as cp
+from configparser import ConfigParser
+
 import pandas as pd
 import numpy as np
 
+from data_processing import Backend, Chord, Distance, EarlyExit, Envelope, Fused, Multiresolution, Parallel, SpatialIndex, TilePlanner
+
 # TODO: ENVIAR TODA A MATRIZ PRA GPU E RETIRAR OS RESULTADOS POR LOOP
 
 def HaversineLocal(busMatrix,lineMatrix,haversine=True):
-    MatrizOnibus = cp.copy(busMatrix)
-    MatrizLinhas = cp.copy(lineMatrix)
-
-    MatrizLinhas = cp.dsplit(MatrizLinhas,2)
-    MatrizOnibus = cp.dsplit(MatrizOnibus,2)
-
-    infVector = cp.squeeze(cp.sum(cp.isnan(MatrizLinhas[0]),axis=1),axis=-1)
-
-    MatrizLinhas[0] = cp.expand_dims(MatrizLinhas[0],axis=-1)
-    MatrizLinhas[1] = cp.expand_dims(MatrizLinhas[1],axis=-1)
-    MatrizOnibus[0] = cp.expand_dims(MatrizOnibus[0],axis=-1)
-    MatrizOnibus[1] = cp.expand_dims(MatrizOnibus[1],axis=-1)
-
-    MatrizOnibus[0] *=  cp.pi/180 
-    MatrizOnibus[1] *=  cp.pi/180
-    MatrizLinhas[1]  =  cp.transpose(MatrizLinhas[1],[2,3,0,1]) * cp.pi/180
-    MatrizLinhas[0]  =  cp.transpose(MatrizLinhas[0],[2,3,0,1]) * cp.pi/180
-
-    # Haversine or euclidian, based on <haversine>
-    if haversine:
-        results = 1000*2*6371.0088*cp.arcsin(
-        cp.sqrt(
-            (cp.sin((MatrizOnibus[0] - MatrizLinhas[0])*0.5)**2 + \
-             cp.cos(MatrizOnibus[0])* cp.cos(MatrizLinhas[0]) * cp.sin((MatrizOnibus[1] - MatrizLinhas[1])*0.5)**2)
-        ))
-    else:
-        results = cp.sqrt((MatrizOnibus[0]-MatrizLinhas[0])**2+(MatrizOnibus[1]-MatrizLinhas[1])**2)
+    xp = Backend.GetArrayModule(busMatrix,lineMatrix)
+
+    infVector = xp.sum(xp.isnan(lineMatrix[:,:,0]),axis=1)
+    results = Distance.PairDistance(*Distance.BroadcastRadians(busMatrix,lineMatrix,xp),haversine,xp)
 
     return results,infVector
 
 
-def FilterData(matrizOnibusCpu,matrizLinhasCpu,busIdList,lineIdList,CONFIGS,logging):
-        
-        distanceTolerance = float(CONFIGS['default_correction_method']['distanceTolerance'])
-        detectionPercentage = float(CONFIGS['default_correction_method']['detectionPercentage'])
-        
-        busStepSize = int(CONFIGS['default_correction_method']['busStepSize'])
-        lineStepSize = int(CONFIGS['default_correction_method']['lineStepSize'])
-        
-        matrizOnibus = cp.asarray(matrizOnibusCpu)
-        matrizLinhas = cp.asarray(matrizLinhasCpu)
-
-        busesList = cp.array_split(matrizOnibus,int(matrizOnibus.shape[0]/busStepSize if matrizOnibus.shape[0] > busStepSize else 1))
-        for index in range(1,len(busesList)):
-                if len(busesList[index].shape) == 2:
-                        busesList[index][None,:]
-                busesList[index] = cp.hsplit(busesList[index],[int(cp.argwhere(cp.isnan(busesList[index][0,:,1]))[0]),busesList[index].shape[1]])[0]
-
-        linesList = cp.array_split(matrizLinhas,int(matrizLinhas.shape[0]/lineStepSize if matrizLinhas.shape[0] > lineStepSize else 1))
-
-        for index in range(1,len(linesList)):
-                if len(linesList[index].shape) == 2:
-                        linesList[index][None,:]
-                linesList[index] = cp.hsplit(linesList[index],[int(cp.argwhere(cp.isnan(linesList[index][0,:,1]))[0]),linesList[index].shape[1]])[0]
-
-
-        #busDataset = tr.utils.data.DataLoader(busesList,drop_last=True)
-        #lineDataset = tr.utils.data.DataLoader(linesList,drop_last=True)
-
-        #algorithm = Algorithm()
-        #algorithm.cuda()
-        fullResults = None
-        for nowBus, busTensor in enumerate(busesList):
-                allLinesResult = None
-                for nowLine,lineTensor in enumerate(linesList):
-                        # Algorithm segment
-                        #algRes = algorithm.FullAlgorithm(busTensor,lineTensor,distanceTolerance,detectionPercentage)
-                        #algRes = FullAlgorithm(busTensor,lineTensor,distanceTolerance,detectionPercentage)
-                        algRes = cp.asnumpy(Algorithm(busTensor,lineTensor,TOLERANCE=distanceTolerance,detectionPercentage=detectionPercentage))
-                        #segmentResults = algRes.numpy()
-                        # Concatenation to full results matrix
-                        if allLinesResult is None:
-                                allLinesResult = np.copy(algRes)
-                        else:
-                                allLinesResult = np.concatenate([allLinesResult,algRes],axis=1)
-                if fullResults is None:
-                        fullResults = np.copy(allLinesResult)        
+# Available detection engines, chosen by CONFIGS['default_correction_method']['detectionEngine']
+#   dense - Haversine tensor between every bus point and every line point, tiled by busStepSize/lineStepSize
+#   grid - grid bucket index of the line points answering radius queries, haversine only (see SpatialIndex)
+#   fused - Numba kernel over the ragged trajectories, each bus/line pair stops at the line point deciding its detection (see Fused)
+#   early - line points evaluated in growing numpy blocks, each bus/line pair stops after the block deciding its detection (see EarlyExit)
+#   gemm - dot products of 3-D unit vectors against cos(tolerance/R), one BLAS matrix multiply per batch of buses, haversine only (see Chord)
+#   multires - pairs scored on coarse blocks of points first, only the undecided ones run dense (see Multiresolution)
+DETECTION_ENGINES = ("dense","grid","fused","early","gemm","multires")
+
+# Storage types of the per point distances emitted for CorrectData, chosen by CONFIGS['default_correction_method']['pointDistanceType']
+POINT_DISTANCE_TYPES = ("float32","float16")
+
+# Maximum amount of (busPoint, linePoint) distances computed at once by PairPointDistances
+MAX_POINT_DISTANCE_ELEMENTS = 2**22
+
+def PrefilterOrigin(busTrajectories,lineTrajectories,CONFIGS):
+    """
+    Returns the projection origin the engines compare the projected mode with, None for haversine. The prefilter
+    boxes are built on the same projected points so that float32 rounding far from the origin never prunes a pair
+    """
+    if Distance.GetDistanceMode(CONFIGS) != "projected":
+        return None
+    return Distance.ProjectionOrigin(lineTrajectories.coordinates if len(lineTrajectories.coordinates) else busTrajectories.coordinates)
+
+def FilterData(busTrajectories,lineTrajectories,CONFIGS,logging,stats=None,pointDistances=None):
+    """
+    Arguments:
+        busTrajectories - Trajectories of the buses, ids are bus_id
+        lineTrajectories - Trajectories of the lines, ids are (line_id, direction)
+        CONFIGS - configparser object
+        logging - logger
+        stats - (optional) dict filled with detection statistics (prefilter pruning, tiles and evaluated pairs of the
+            serial dense engine)
+        pointDistances - (optional) dict filled, for every detected pair, with the distance of each bus point to the
+            closest line point (see EncodePointDistances), keyed by (bus_id, (line_id, direction)) as results.
+            LineCorrection.CorrectData reuses them instead of computing the distances again
+    Returns:
+        results - Pandas DataFrame indexed by (<linha>,<direcao>) with one column per bus, True when the line was detected
+    Required Configurations:
+        CONFIGS['default_correction_method']['distanceTolerance'] - maximum distance (meters) of a line point to the bus
+        CONFIGS['default_correction_method']['detectionPercentage'] - minimum fraction of close line points for detection
+        CONFIGS['default_correction_method']['detectionEngine'] - (optional) one of DETECTION_ENGINES, defaults to 'dense'
+        CONFIGS['default_correction_method']['workers'] - (optional) detection processes for the numpy backend, defaults to 1
+        CONFIGS['default_correction_method']['prefilter'] - (optional) skips bus/line pairs whose bounding boxes, expanded
+            by distanceTolerance, do not intersect. Defaults to True
+        CONFIGS['default_correction_method']['pointDistanceType'] - (optional) one of POINT_DISTANCE_TYPES, storage of
+            <pointDistances>. Defaults to 'float32'
+    """
+    candidates = None
+    if CONFIGS.getboolean('default_correction_method','prefilter',fallback=True):
+        candidates = Envelope.CandidatePairs(busTrajectories,lineTrajectories,float(CONFIGS['default_correction_method']['distanceTolerance']),
+            PrefilterOrigin(busTrajectories,lineTrajectories,CONFIGS))
+        pairs = candidates.size
+        prunedRatio = 1 - np.count_nonzero(candidates)/pairs if pairs else 0.0
+        if stats is not None:
+            stats['prefilter-pairs'] = int(pairs)
+            stats['prefilter-candidate-pairs'] = int(np.count_nonzero(candidates))
+            stats['prefilter-pruned-ratio'] = float(prunedRatio)
+        if logging:
+            logging.info(f"Bounding box prefilter pruned {100*prunedRatio:.1f}% of {pairs} bus/line pairs")
+
+    workers = Parallel.GetWorkers(CONFIGS)
+    if workers > 1 and Backend.IsGPU(Backend.GetConfiguredBackend(CONFIGS)):
+        if logging:
+            logging.warning("Parallel detection workers are only used with the numpy backend, running serially")
+        workers = 1
+
+    # The serial dense engine keeps the distances of its tiles, the other pairs are computed after detection
+    engineDistances = dict() if pointDistances is not None else None
+    if workers > 1:
+        fullResults = Parallel.ParallelDetection(busTrajectories,lineTrajectories,CONFIGS,workers,logging,candidates)
+    else:
+        engineStats = dict()
+        fullResults = RunEngine(busTrajectories,lineTrajectories,CONFIGS,logging,candidates,engineStats,engineDistances)
+        if stats is not None:
+            stats.update(engineStats)
+        # Pairs the dense tiles actually compared, the pruning ratio alone does not tell whether work was skipped
+        if logging and 'detection-evaluated-pairs' in engineStats:
+            logging.info(f"Dense detection evaluated {engineStats['detection-evaluated-pairs']} of {len(busTrajectories)*len(lineTrajectories)} bus/line pairs")
+
+    lineLabel = [(i[0],str(i[1])) for i in lineTrajectories.ids]
+    busLabel = list(busTrajectories.ids)
+    if pointDistances is not None:
+        pairs = list(zip(*np.nonzero(fullResults)))
+        computed = PairPointDistances(busTrajectories,lineTrajectories,[pair for pair in pairs if pair not in engineDistances],CONFIGS)
+        for bus,line in pairs:
+            pointDistances[(busLabel[bus],lineLabel[line])] = engineDistances[(bus,line)] if (bus,line) in engineDistances else computed[(bus,line)]
+        if stats is not None:
+            stats['point-distance-pairs'] = len(pairs)
+            stats['point-distance-reused-pairs'] = len(pairs) - len(computed)
+            stats['point-distance-bytes'] = int(sum(distances.nbytes for distances in pointDistances.values()))
+    results = pd.DataFrame(fullResults.T,index=pd.MultiIndex.from_tuples(lineLabel),columns=busLabel)
+    return results
+
+
+def RunEngine(busTrajectories,lineTrajectories,CONFIGS,logging=None,candidates=None,stats=None,pointDistances=None):
+    """
+    Runs the configured detection engine between every bus and every line
+    Arguments:
+        candidates - (optional) (bus, line) boolean matrix, pairs set to False are not evaluated and never detected
+        pointDistances - (optional) dict where the dense engine stores the per point distances of the detected pairs
+            (see DenseDetection). The other engines leave it empty
+        stats - (optional) dict where the dense engine counts its tiles ('detection-tiles') and the bus/line pairs
+            they evaluate ('detection-evaluated-pairs'), and the multires engine its evaluated and refined pairs
+            ('multires-pairs', 'multires-refined-pairs')
+    Returns:
+        fullResults - (bus, line) boolean detection matrix
+    """
+    distanceTolerance = float(CONFIGS['default_correction_method']['distanceTolerance'])
+    detectionPercentage = float(CONFIGS['default_correction_method']['detectionPercentage'])
+
+    engine = CONFIGS.get('default_correction_method','detectionEngine',fallback="dense")
+    if engine == "dense":
+        return DenseDetection(busTrajectories,lineTrajectories,distanceTolerance,detectionPercentage,CONFIGS,candidates,stats,pointDistances=pointDistances)
+    elif engine == "grid":
+        if Distance.GetDistanceMode(CONFIGS) == "projected":
+            raise ValueError("The grid detection engine compares haversine distances, it does not support distanceMode 'projected'")
+        results = SpatialIndex.DetectLines(busTrajectories,lineTrajectories,distanceTolerance,detectionPercentage,logging)
+        return results if candidates is None else results & candidates
+    elif engine == "fused":
+        return Fused.DetectLines(busTrajectories,lineTrajectories,distanceTolerance,detectionPercentage,candidates,Distance.GetDistanceMode(CONFIGS) == "projected")
+    elif engine == "early":
+        return EarlyExit.DetectLines(busTrajectories,lineTrajectories,distanceTolerance,detectionPercentage,candidates,Distance.GetDistanceMode(CONFIGS) == "projected",EarlyExit.GetBlockPoints(CONFIGS))
+    elif engine == "gemm":
+        if Distance.GetDistanceMode(CONFIGS) == "projected":
+            raise ValueError("The gemm detection engine compares central angles, it does not support distanceMode 'projected'")
+        # Same memory budget as the distance chunks of the dense engine
+        maxMemory = TilePlanner.GetMaxMemory(CONFIGS)
+        tileBytes = TilePlanner.ChunkBytes(maxMemory) if maxMemory else Backend.GetTileBytes(CONFIGS)
+        return Chord.DetectLines(busTrajectories,lineTrajectories,distanceTolerance,detectionPercentage,candidates,max(1,tileBytes // TilePlanner.VALUE_BYTES))
+    elif engine == "multires":
+        # The refined subsets are projected from the origin of the full line set, as in the exhaustive run
+        origin = Distance.ProjectionOrigin(lineTrajectories.coordinates if len(lineTrajectories.coordinates) else busTrajectories.coordinates)
+        Refine = lambda busSubset,lineSubset,refineCandidates: DenseDetection(busSubset,lineSubset,distanceTolerance,detectionPercentage,CONFIGS,refineCandidates,stats,origin=origin)
+        return Multiresolution.DetectLines(busTrajectories,lineTrajectories,distanceTolerance,detectionPercentage,Refine,candidates,
+            Distance.GetDistanceMode(CONFIGS) == "projected",*Multiresolution.GetBlockPoints(CONFIGS),stats=stats,logging=logging,origin=origin)
+    raise ValueError(f"Unknown detection engine '{engine}'. Options are: {', '.join(DETECTION_ENGINES)}")
+
+
+def GetPointDistanceType(CONFIGS):
+    pointDistanceType = CONFIGS.get('default_correction_method','pointDistanceType',fallback="float32")
+    if pointDistanceType not in POINT_DISTANCE_TYPES:
+        raise ValueError(f"Unknown point distance type '{pointDistanceType}'. Options are: {', '.join(POINT_DISTANCE_TYPES)}")
+    return np.dtype(pointDistanceType)
+
+
+def EncodePointDistances(distances,tolerance,dtype,projected=False):
+    """
+    Arguments:
+        distances - distance of each bus point to the closest line point, as computed by the detection (squared
+            meters when projected)
+        tolerance - distance tolerance in meters
+        dtype - storage type, one of POINT_DISTANCE_TYPES
+        projected - <distances> are squared meters of the projected mode
+    Returns:
+        distances in meters stored as <dtype>. Values rounded to the wrong side of the tolerance are moved to
+        the closest value of <dtype> on the right side, so comparing them with the tolerance in float64 gives
+        the same points as the detection comparison
+    """
+    distances = np.asarray(distances)
+    close = distances < (np.float32(tolerance)**2 if projected else tolerance)
+    encoded = (np.sqrt(distances.astype(float)) if projected else distances).astype(dtype)
+
+    rounded = dtype.type(tolerance)
+    below = rounded if float(rounded) < tolerance else np.nextafter(rounded,dtype.type(-np.inf))
+    above = rounded if float(rounded) >= tolerance else np.nextafter(rounded,dtype.type(np.inf))
+    encodedClose = encoded.astype(float) < tolerance
+    encoded[close & ~encodedClose] = below
+    encoded[~close & encodedClose] = above
+    return encoded
+
+
+def PairPointDistances(busTrajectories,lineTrajectories,pairs,CONFIGS):
+    """
+    Arguments:
+        busTrajectories, lineTrajectories, CONFIGS - as FilterData
+        pairs - (bus, line) indices
+    Returns:
+        dict from each (bus, line) pair to the distance of each bus point to the closest line point, encoded by
+        EncodePointDistances with the distance of the dense engine
+    """
+    distanceTolerance = float(CONFIGS['default_correction_method']['distanceTolerance'])
+    dtype = GetPointDistanceType(CONFIGS)
+    projected = Distance.GetDistanceMode(CONFIGS) == "projected"
+    if not pairs:
+        return dict()
+
+    if projected:
+        origin = Distance.ProjectionOrigin(lineTrajectories.coordinates if len(lineTrajectories.coordinates) else busTrajectories.coordinates)
+        busPoints = busTrajectories.projected(origin).coordinates
+        linePoints = lineTrajectories.projected(origin).coordinates
+        Distances = lambda bus,line: Distance.SquaredDistance(bus[:,0,None],bus[:,1,None],line[None,:,0],line[None,:,1])
+    else:
+        # Converted like the padded tensors of the dense engine, so the distances are the same
+        busPoints = np.column_stack(Distance.BusRadians(np.asarray(busTrajectories.coordinates,dtype=float)))
+        linePoints = np.column_stack(Distance.LineRadians(np.asarray(lineTrajectories.coordinates,dtype=float)))
+        Distances = lambda bus,line: Distance.PairDistance(bus[:,0,None],bus[:,1,None],line[None,:,0],line[None,:,1])
+
+    results = dict()
+    for bus,line in pairs:
+        busSlice = busPoints[busTrajectories.offsets[bus]:busTrajectories.offsets[bus+1]]
+        lineSlice = linePoints[lineTrajectories.offsets[line]:lineTrajectories.offsets[line+1]]
+        rowsPerChunk = max(1,MAX_POINT_DISTANCE_ELEMENTS // max(1,len(lineSlice)))
+        distances = np.concatenate([np.min(Distances(busSlice[start:start+rowsPerChunk],lineSlice),axis=1,initial=np.inf)
+            for start in range(0,len(busSlice),rowsPerChunk)] or [np.zeros(0)])
+        results[(bus,line)] = EncodePointDistances(distances,distanceTolerance,dtype,projected)
+    return results
+
+
+def ValidateDistanceMode(busTrajectories,lineTrajectories,CONFIGS,logging=None,maxReported=100,projectedResults=None):
+    """
+    Arguments:
+        busTrajectories, lineTrajectories, CONFIGS - as FilterData
+        maxReported - maximum amount of differing pairs listed in the report
+        projectedResults - (optional) (bus, line) detection matrix of the 'projected' mode already computed
+            (FilterData results transposed), only the 'haversine' mode is run when given
+    Returns:
+        report - dict with the amount of bus/line pairs classified differently by the 'projected' distance
+            mode and the exact 'haversine' mode, and the first <maxReported> of them as (bus, line, haversine)
+    """
+    results = dict()
+    if projectedResults is not None:
+        results['projected'] = np.asarray(projectedResults,dtype=bool)
+    for mode in Distance.DISTANCE_MODES:
+        if mode in results:
+            continue
+        configuration = ConfigParser()
+        configuration.read_dict({'default_correction_method': dict(CONFIGS['default_correction_method'])})
+        configuration['default_correction_method']['distanceMode'] = mode
+        results[mode] = RunEngine(busTrajectories,lineTrajectories,configuration,logging)
+
+    busRows,lineColumns = np.nonzero(results['haversine'] != results['projected'])
+    report = {
+        'pairs': int(results['haversine'].size),
+        'haversine-detections': int(np.count_nonzero(results['haversine'])),
+        'projected-detections': int(np.count_nonzero(results['projected'])),
+        'differences': int(len(busRows)),
+        'differing-pairs': [(busTrajectories.ids[bus],lineTrajectories.ids[line],bool(results['haversine'][bus,line])) for bus,line in zip(busRows[:maxReported],lineColumns[:maxReported])],
+    }
+    if logging:
+        logging.info(f"Distance mode validation: {report['differences']} of {report['pairs']} bus/line pairs differ from haversine")
+    return report
+
+
+def SweepDetection(busTrajectories,lineTrajectories,tolerances,percentages,CONFIGS,logging=None):
+    """
+    Detection for every distanceTolerance x detectionPercentage setting of a parameter sweep. The distance
+    between bus and line points is computed once (dense engine), every setting is a threshold over it
+    Arguments:
+        busTrajectories, lineTrajectories, CONFIGS - as FilterData (distanceTolerance and detectionPercentage are not used)
+        tolerances - distance tolerances (meters)
+        percentages - detection percentages
+    Returns:
+        tolerances, percentages - sorted settings
+        fractions - (tolerance, bus, line) fraction of line points close to each bus (as compared by FilterData)
+        detections - (tolerance, percentage) amount of detected bus/line pairs
+    """
+    tolerances = np.sort(np.asarray(tolerances,dtype=float))
+    percentages = np.sort(np.asarray(percentages,dtype=float))
+
+    # The prefilter is valid for every tolerance when built with the biggest one
+    candidates = None
+    if CONFIGS.getboolean('default_correction_method','prefilter',fallback=True):
+        candidates = Envelope.CandidatePairs(busTrajectories,lineTrajectories,tolerances[-1],PrefilterOrigin(busTrajectories,lineTrajectories,CONFIGS))
+    if logging:
+        logging.info(f"Parameter sweep of {len(tolerances)} tolerances x {len(percentages)} percentages")
+
+    fractions = np.moveaxis(DenseDetection(busTrajectories,lineTrajectories,None,None,CONFIGS,candidates,tolerances=tolerances),2,0)
+    detections = np.stack([np.count_nonzero(fractions > percentage,axis=(1,2)) for percentage in percentages],axis=1)
+    return tolerances,percentages,fractions,detections
+
+
+def DenseDetection(busTrajectories,lineTrajectories,distanceTolerance,detectionPercentage,CONFIGS,candidates=None,stats=None,tolerances=None,pointDistances=None,origin=None):
+    """
+    Runs Algorithm over tiles of busStepSize buses by lineStepSize lines, taken from length buckets (see
+    TilePlanner). Each tile is NaN padded only up to its own longest bus and line. With <candidates>, the buses of
+    each length bucket are grouped by identical candidate lines (see TilePlanner.CandidateGroups) before tiling, so
+    only candidate pairs are evaluated and buses without candidates are skipped.
+    With <tolerances>, runs SweepAlgorithm instead (distanceTolerance and detectionPercentage are not used).
+    With <pointDistances> (a dict), the distance of each bus point to the closest line point of every detected pair
+    is taken from the same tiles and stored there by (bus, line) index (see EncodePointDistances).
+    In projected mode, <origin> (see Distance.ProjectionOrigin) defaults to the one of the given lines, callers
+    running on a subset of the lines pass the origin of the full set.
+    Returns:
+        fullResults - (bus, line) boolean detection matrix, or (bus, line, tolerance) fractions of close
+            line points with <tolerances>
+    Configurations:
+        CONFIGS['default_correction_method']['maxMemoryMBytes'] - (optional) memory budget of each tile. When set,
+            tile sizes are chosen by TilePlanner from the trajectory lengths and busStepSize is not used
+        CONFIGS['default_correction_method']['bucketing'] - (optional) one of TilePlanner.BUCKETING_MODES, defaults to 'pow2'
+        CONFIGS['default_correction_method']['bucketAmount'] - (optional) amount of buckets of the 'quantile' bucketing
+        CONFIGS['default_correction_method']['distanceMode'] - (optional) one of Distance.DISTANCE_MODES, defaults to 'haversine'
+    """
+    busStepSize = int(CONFIGS['default_correction_method']['busStepSize'])
+    lineStepSize = int(CONFIGS['default_correction_method']['lineStepSize'])
+
+    xp = Backend.GetConfiguredBackend(CONFIGS)
+    tileBytes = Backend.GetTileBytes(CONFIGS)
+
+    # Projected mode: coordinates are projected once, tiles are float32 meters
+    projected = Distance.GetDistanceMode(CONFIGS) == "projected"
+    tileType = np.float32 if projected else np.float64
+    if projected:
+        if origin is None:
+            origin = Distance.ProjectionOrigin(lineTrajectories.coordinates if len(lineTrajectories.coordinates) else busTrajectories.coordinates)
+        busTrajectories = busTrajectories.projected(origin)
+        lineTrajectories = lineTrajectories.projected(origin)
+
+    # Buses and lines are grouped in length buckets, tiles never mix buckets
+    bucketing,bucketAmount = TilePlanner.GetBucketing(CONFIGS)
+    busBuckets = TilePlanner.Buckets(np.arange(len(busTrajectories)),busTrajectories.lengths,bucketing,bucketAmount)
+    lineBuckets = lambda lineIndices: TilePlanner.Buckets(lineIndices,lineTrajectories.lengths,bucketing,bucketAmount)
+
+    maxMemory = TilePlanner.GetMaxMemory(CONFIGS)
+    if maxMemory:
+        plan = TilePlanner.TilePlan(busTrajectories.lengths,lineTrajectories.lengths,lineStepSize,maxMemory,Backend.IsGPU(xp))
+        busTiles = plan.busTiles
+        lineTiles = lambda lineIndices: [tile for bucket in lineBuckets(lineIndices) for tile in plan.lineTiles(bucket)]
+        tileBytes = TilePlanner.ChunkBytes(maxMemory)
+    else:
+        busTiles = lambda busIndices: [busIndices[busStart:busStart+busStepSize] for busStart in range(0,len(busIndices),busStepSize)]
+        lineTiles = lambda lineIndices: [bucket[lineStart:lineStart+lineStepSize] for bucket in lineBuckets(lineIndices) for lineStart in range(0,len(bucket),lineStepSize)]
+
+    # Buses sharing the same candidate lines are tiled together, without candidates every bus is compared with every line
+    if candidates is None:
+        busGroups = [(bucket,np.arange(len(lineTrajectories))) for bucket in busBuckets]
+    else:
+        busGroups = [group for bucket in busBuckets for group in TilePlanner.CandidateGroups(bucket,candidates)]
+
+    emitDistances = pointDistances is not None and tolerances is None
+    pointDistanceType = GetPointDistanceType(CONFIGS) if emitDistances else None
+    if tolerances is None:
+        fullResults = np.zeros((len(busTrajectories),len(lineTrajectories)),dtype=bool)
+        Evaluate = lambda busTensor,lineTensor: Algorithm(busTensor,lineTensor,TOLERANCE=distanceTolerance,detectionPercentage=detectionPercentage,tileBytes=tileBytes,projected=projected,busMinimum=emitDistances)
+    else:
+        fullResults = np.zeros((len(busTrajectories),len(lineTrajectories),len(tolerances)))
+        Evaluate = lambda busTensor,lineTensor: SweepAlgorithm(busTensor,lineTensor,tolerances,tileBytes=tileBytes,projected=projected)
+    tiles = 0
+    evaluatedPairs = 0
+    lineTensors = None
+    for busGroup,lineSelection in busGroups:
+        # Without candidates the line tiles are the same for every bus tile, padded once
+        if candidates is not None or lineTensors is None:
+            lineTensors = [(lineIndices,Backend.ToDevice(lineTrajectories.padded(lineIndices,tileType),xp)) for lineIndices in lineTiles(lineSelection)]
+
+        for busIndices in busTiles(busGroup):
+            busTensor = Backend.ToDevice(busTrajectories.padded(busIndices,tileType),xp)
+            for lineIndices,lineTensor in lineTensors:
+                if emitDistances:
+                    algRes,busMin = map(Backend.ToHost,Evaluate(busTensor,lineTensor))
                 else:
-                        fullResults = np.concatenate([fullResults,allLinesResult],axis=0)
-        #fullResults = fullResults > detectionPercentage
-        lineLabel = [(i[0],str(i[1])) for i in lineIdList]
-        busLabel = [i[0] for i in busIdList]
-        results = pd.DataFrame(fullResults.T,index=pd.MultiIndex.from_tuples(lineLabel),columns=busLabel)
-        return results
+                    algRes = Backend.ToHost(Evaluate(busTensor,lineTensor))
+                fullResults[np.ix_(busIndices,lineIndices)] = algRes
+                tiles += 1
+                evaluatedPairs += len(busIndices)*len(lineIndices)
+
+                if emitDistances:
+                    for busRow,lineColumn in zip(*np.nonzero(algRes)):
+                        bus,line = busIndices[busRow],lineIndices[lineColumn]
+                        pointDistances[(bus,line)] = EncodePointDistances(busMin[busRow,:busTrajectories.lengths[bus],lineColumn],distanceTolerance,pointDistanceType,projected)
+
+    if stats is not None:
+        stats['detection-tiles'] = stats.get('detection-tiles',0) + tiles
+        stats['detection-evaluated-pairs'] = stats.get('detection-evaluated-pairs',0) + evaluatedPairs
+    return fullResults
 
         
 #class Algorithm(tr.nn.Module):
@@ -121,50 +413,111 @@ def FullAlgorithm(MatrizOnibus,MatrizLinhas,TOLERANCE,detectionPercentage):
         final = below / (sizeLine - infMatrix)
         return final
 
-def Algorithm(MO,ML,TOLERANCE,detectionPercentage=None,haversine=True):
+def Algorithm(MO,ML,TOLERANCE,detectionPercentage=None,haversine=True,tileBytes=None,projected=False,busMinimum=False):
+    """
+    Arguments:
+        MO - bus tensor (bus, point, lat/lon), NaN padded
+        ML - line tensor (line, point, lat/lon), NaN padded
+        TOLERANCE - maximum distance (meters) between a line point and the bus trajectory
+        detectionPercentage - if set, returns the boolean detection instead of the percentages
+        tileBytes - on the CPU, maximum size of each intermediate distance tile. The bus points are
+            processed in chunks so the full (bus, busPoint, line, linePoint) tensor is never allocated
+        projected - MO and ML hold projected (north, east) meters (see Distance.Project), compared by
+            squared distance instead of haversine
+        busMinimum - also returns the distance of each bus point to the closest point of each line (see MinimumDistances)
+    Returns:
+        resultsPerc - (bus, line) matrix with the fraction of line points close to each bus
+        busMin - only with <busMinimum>, (bus, busPoint, line) distances
+    """
     # global to analise
     global resultsMin
-    # 
-    MatrizOnibus = cp.copy(MO)
-    MatrizLinhas = cp.copy(ML)
-
-    MatrizLinhas = cp.dsplit(MatrizLinhas,2)
-    MatrizOnibus = cp.dsplit(MatrizOnibus,2)
-
-    infVector = cp.squeeze(cp.sum(cp.isnan(MatrizLinhas[0]),axis=1),axis=-1)
-
-    MatrizLinhas[0] = cp.expand_dims(MatrizLinhas[0],axis=-1)
-    MatrizLinhas[1] = cp.expand_dims(MatrizLinhas[1],axis=-1)
-    MatrizOnibus[0] = cp.expand_dims(MatrizOnibus[0],axis=-1)
-    MatrizOnibus[1] = cp.expand_dims(MatrizOnibus[1],axis=-1)
-
-    MatrizOnibus[0] *=  cp.pi/180 
-    MatrizOnibus[1] *=  cp.pi/180
-    MatrizLinhas[1]  =  cp.transpose(MatrizLinhas[1],[2,3,0,1]) * cp.pi/180
-    MatrizLinhas[0]  =  cp.transpose(MatrizLinhas[0],[2,3,0,1]) * cp.pi/180
-
-    # Haversine or euclidian, based on <haversine>
-    if haversine:
-        results = 1000*2*6371.0088*cp.arcsin(
-        cp.sqrt(
-            (cp.sin((MatrizOnibus[0] - MatrizLinhas[0])*0.5)**2 + \
-             cp.cos(MatrizOnibus[0])* cp.cos(MatrizLinhas[0]) * cp.sin((MatrizOnibus[1] - MatrizLinhas[1])*0.5)**2)
-        ))
-    else:
-        results = cp.sqrt((MatrizOnibus[0]-MatrizLinhas[0])**2+(MatrizOnibus[1]-MatrizLinhas[1])**2)
-        
-    # Matriz D^[min]
-    resultsMin = cp.nanmin(results,axis=1)
+    xp = Backend.GetArrayModule(MO,ML)
+
+    infVector = xp.sum(xp.isnan(ML[:,:,0]),axis=1)
+    threshold = MO.dtype.type(TOLERANCE)**2 if projected else TOLERANCE
+
+    resultsMin = MinimumDistances(MO,ML,haversine,tileBytes,projected,busMinimum)
+    if busMinimum:
+        resultsMin,busMin = resultsMin
     #resultsGroup = cp.pad(resultsMin,[(0,0),(0,0),(0,resultsMin.shape[2]%groupSize)],constant_values=cp.NaN)
     #resultsGroup = cp.reshape(resultsGroup,(resultsGroup.shape[0],resultsGroup.shape[1],-1,groupSize))
     sizeLine = resultsMin.shape[2]
     #below = cp.sum(resultsMin,axis=2)
-    below = cp.sum(resultsMin<TOLERANCE,axis=2)
+    below = xp.sum(resultsMin<threshold,axis=2)
     resultsPerc = below / (sizeLine - infVector)
     if detectionPercentage:
-        return resultsPerc > cp.array(detectionPercentage)
+        resultsPerc = resultsPerc > xp.array(detectionPercentage)
+    if busMinimum:
+        return resultsPerc,busMin
     return resultsPerc
 
+
+def MinimumDistances(MO,ML,haversine=True,tileBytes=None,projected=False,busMinimum=False):
+    """
+    Arguments:
+        MO, ML, haversine, tileBytes, projected - as Algorithm
+        busMinimum - also returns the minimum over the line points, taken from the same distances
+    Returns:
+        resultsMin - (bus, line, linePoint) distance from each line point to the closest point of each bus
+            (squared meters when projected), NaN on the padding
+        busMin - only with <busMinimum>, (bus, busPoint, line) distance from each bus point to the closest point
+            of each line, NaN on the padding
+    """
+    xp = Backend.GetArrayModule(MO,ML)
+    if projected:
+        busLat,busLon,lineLat,lineLon = Distance.BroadcastPoints(MO,ML)
+        Distances = lambda busLat,busLon: Distance.SquaredDistance(busLat,busLon,lineLat,lineLon)
+    else:
+        busLat,busLon,lineLat,lineLon = Distance.BroadcastRadians(MO,ML,xp)
+        Distances = lambda busLat,busLon: Distance.PairDistance(busLat,busLon,lineLat,lineLon,haversine,xp)
+
+    # Matriz D^[min]
+    if tileBytes and not Backend.IsGPU(xp):
+        pointBytes = MO.dtype.itemsize * MO.shape[0] * ML.shape[0] * ML.shape[1]
+        step = max(1, int(tileBytes // pointBytes))
+        resultsMin = None
+        busMin = []
+        for start in range(0,MO.shape[1],step):
+            tile = Distances(busLat[:,start:start+step],busLon[:,start:start+step])
+            # fmin ignores NaN like nanmin, without warning on padding-only tiles
+            tileMin = np.fmin.reduce(tile,axis=1)
+            resultsMin = tileMin if resultsMin is None else np.fmin(resultsMin,tileMin)
+            if busMinimum:
+                busMin.append(np.fmin.reduce(tile,axis=3))
+        busMin = np.concatenate(busMin,axis=1) if busMin else np.full((MO.shape[0],0,ML.shape[0]),np.nan,dtype=MO.dtype)
+    else:
+        results = Distances(busLat,busLon)
+        resultsMin = xp.nanmin(results,axis=1)
+        busMin = xp.nanmin(results,axis=3) if busMinimum else None
+    if busMinimum:
+        return resultsMin,busMin
+    return resultsMin
+
+
+def SweepAlgorithm(MO,ML,tolerances,haversine=True,tileBytes=None,projected=False):
+    """
+    Algorithm for many tolerances at once, the minimum distances are computed a single time
+    Arguments:
+        MO, ML, haversine, tileBytes, projected - as Algorithm
+        tolerances - increasing distance tolerances (meters)
+    Returns:
+        resultsPerc - (bus, line, tolerance) fraction of line points close to each bus for every tolerance
+    """
+    xp = Backend.GetArrayModule(MO,ML)
+    infVector = xp.sum(xp.isnan(ML[:,:,0]),axis=1)
+    thresholds = xp.asarray(np.asarray(tolerances,dtype=MO.dtype)**2 if projected else np.asarray(tolerances,dtype=float))
+
+    resultsMin = MinimumDistances(MO,ML,haversine,tileBytes,projected)
+    busAmount,lineAmount,sizeLine = resultsMin.shape
+
+    # Histogram of the first tolerance each line point is below: a point is below tolerance k when its
+    # bin is at most k. NaN padding falls past the last bin
+    bins = xp.searchsorted(thresholds,resultsMin.reshape(busAmount*lineAmount,sizeLine),side="right")
+    bins += (xp.arange(busAmount*lineAmount)*(len(tolerances)+1))[:,None]
+    histogram = xp.bincount(bins.ravel(),minlength=busAmount*lineAmount*(len(tolerances)+1)).reshape(busAmount,lineAmount,len(tolerances)+1)
+    below = xp.cumsum(histogram,axis=2)[:,:,:len(tolerances)]
+    return below / (sizeLine - infVector)[None,:,None]
+
 if __name__ == '__main__':
         from configparser import ConfigParser
         from time import time
@@ -181,23 +534,18 @@ if __name__ == '__main__':
         
         
         # Teste de desempenho
+        from data_processing.Trajectories import Trajectories
         quantOni = 40
         quantLi = 20
-        oni = np.random.rand(quantOni,2000,2)
-        oni = np.pad(oni,[(0,0),(0,4),(0,0)],constant_values=np.NaN)
-        li = np.random.rand(quantLi,2000,2)
-        li = np.pad(li,[(0,0),(0,4),(0,0)],constant_values=np.NaN)
-
-
-        busList = [f"O-{i}" for i in range(quantOni)]
-        lineList = [f"L-{i}" for i in range(quantLi)]
+        oni = Trajectories.fromArrays(list(np.random.rand(quantOni,2000,2)),[f"O-{i}" for i in range(quantOni)])
+        li = Trajectories.fromArrays(list(np.random.rand(quantLi,2000,2)),[(f"L-{i}","0") for i in range(quantLi)])
 
 
         if not CONFIG.has_section('default_correction_method'):
                 CONFIG['default_correction_method'] = {}
 
         start = time()
-        res = FilterData(oni,li,busList,lineList,CONFIG,logging)
+        res = FilterData(oni,li,CONFIG,logging)
         end = time()
         print(f"{quantOni}@2000 X {quantLi}@2000",end-start)
         #print(results)
@@ -0,0 +1,176 @@
+#
+# Multiresolution.py
+# Description:
+#	Coarse to fine line detection. Bus and line trajectories are cut in blocks of consecutive points, each
+#	block represented by its middle point and the radius of its points around it. Every bus/line pair is first
+#	scored at block resolution: by the triangle inequality, a line block is surely close when its representative
+#	is within tolerance - lineRadius of a bus point, and surely far when it is beyond tolerance + busRadius +
+#	lineRadius of every bus block. This bounds the fraction of close line points of each pair between a lower
+#	and an upper score. Pairs whose bounds fall on the same side of detectionPercentage are decided there, only
+#	the pairs whose band contains it run the full resolution Algorithm (through the dense engine).
+#
+
+import numpy as np
+
+from data_processing import Distance
+from data_processing.Trajectories import LineShapes
+
+# Points of each block of the coarse level. GPS points of the buses are far apart already (one per minute),
+# bus blocks of more than a few points have radii close to the tolerance and leave most pairs undecided
+DEFAULT_LINE_BLOCK_POINTS = 16
+DEFAULT_BUS_BLOCK_POINTS = 1
+
+# Maximum amount of (lineBlock, busBlock) distances computed at once
+MAX_ELEMENTS = 2**22
+
+# Margin kept by the coarse decisions around the tolerance, covers the rounding of the float64 distances
+# of the coarse level and of the float32 distances of the projected mode
+MARGIN_METERS = 1e-3
+MARGIN_RELATIVE = 1e-6
+
+
+def GetBlockPoints(CONFIGS):
+	"""
+	Returns:
+		busBlockPoints, lineBlockPoints - points of each bus and line block of the coarse level
+	Configurations:
+		CONFIGS['default_correction_method']['multiresBusBlockPoints'] - (optional) defaults to DEFAULT_BUS_BLOCK_POINTS
+		CONFIGS['default_correction_method']['multiresLineBlockPoints'] - (optional) defaults to DEFAULT_LINE_BLOCK_POINTS
+	"""
+	return (CONFIGS.getint('default_correction_method', 'multiresBusBlockPoints', fallback=DEFAULT_BUS_BLOCK_POINTS),
+		CONFIGS.getint('default_correction_method', 'multiresLineBlockPoints', fallback=DEFAULT_LINE_BLOCK_POINTS))
+
+
+def Points(busTrajectories, lineTrajectories, projected, origin=None):
+	"""
+	Returns the bus and line points as float64 (point, component) arrays, converted like the tensors of the
+	dense engine: (lat, lon, cos(lat)) in radians, or (north, east) projected meters from <origin> (defaults
+	to the origin of the lines, see Distance.ProjectionOrigin)
+	"""
+	if projected:
+		if origin is None:
+			origin = Distance.ProjectionOrigin(lineTrajectories.coordinates if len(lineTrajectories.coordinates) else busTrajectories.coordinates)
+		return (busTrajectories.projected(origin).coordinates.astype(float), lineTrajectories.projected(origin).coordinates.astype(float))
+
+	busLat, busLon = Distance.BusRadians(np.asarray(busTrajectories.coordinates, dtype=float))
+	if isinstance(lineTrajectories, LineShapes):
+		lineLat, lineLon, lineCos = (np.asarray(values, dtype=float) for values in (lineTrajectories.lat, lineTrajectories.lon, lineTrajectories.cosLat))
+	else:
+		lineLat, lineLon = Distance.LineRadians(np.asarray(lineTrajectories.coordinates, dtype=float))
+		lineCos = np.cos(lineLat)
+	return np.column_stack((busLat, busLon, np.cos(busLat))), np.column_stack((lineLat, lineLon, lineCos))
+
+
+def PointDistance(a, b):
+	"""
+	Elementwise distance in meters between broadcastable point arrays returned by Points
+	"""
+	if a.shape[-1] == 3:
+		return Distance.PairDistance(a[..., 0], a[..., 1], b[..., 0], b[..., 1], busCos=a[..., 2], lineCos=b[..., 2])
+	return np.sqrt(np.sum((a - b)**2, axis=-1))
+
+
+def Blocks(offsets, points, blockPoints):
+	"""
+	Cuts every trajectory in blocks of <blockPoints> consecutive points
+	Returns:
+		blockOffsets - (trajectories + 1) array, the blocks of trajectory i are blockOffsets[i]:blockOffsets[i+1]
+		representatives - point index of the middle point of each block
+		radius - maximum distance of the points of each block to its representative
+		sizes - amount of points of each block
+	"""
+	lengths = np.diff(offsets)
+	blockCounts = -(-lengths // blockPoints)
+	blockOffsets = np.concatenate(([0], np.cumsum(blockCounts)))
+	owner = np.repeat(np.arange(len(lengths)), blockCounts)
+	position = np.arange(blockOffsets[-1]) - blockOffsets[owner]
+	starts = offsets[owner] + position*blockPoints
+	sizes = np.minimum(blockPoints, offsets[owner+1] - starts)
+	representatives = starts + sizes // 2
+
+	# Blocks cover the points in order, point i belongs to block pointBlock[i]
+	pointBlock = np.repeat(np.arange(len(sizes)), sizes)
+	radius = np.zeros(len(sizes))
+	np.maximum.at(radius, pointBlock, PointDistance(points[offsets[0]:offsets[-1]], points[representatives[pointBlock]]))
+	return blockOffsets, representatives, radius, sizes
+
+
+def CoarseScores(busTrajectories, lineTrajectories, tolerance, candidates=None, projected=False, busBlockPoints=DEFAULT_BUS_BLOCK_POINTS, lineBlockPoints=DEFAULT_LINE_BLOCK_POINTS, origin=None):
+	"""
+	Returns:
+		lower, upper - (bus, line) amounts of line points surely close and possibly close to the bus, the exact
+			amount of the dense engine lies between them. Zero for pairs outside <candidates>
+	"""
+	busPoints, linePoints = Points(busTrajectories, lineTrajectories, projected, origin)
+	busBlocks, busRepresentatives, busRadius, _ = Blocks(busTrajectories.offsets, busPoints, busBlockPoints)
+	lineBlocks, lineRepresentatives, lineRadius, lineSizes = Blocks(lineTrajectories.offsets, linePoints, lineBlockPoints)
+	margin = MARGIN_METERS + MARGIN_RELATIVE*tolerance
+
+	lower = np.zeros((len(busTrajectories), len(lineTrajectories)), dtype=np.int64)
+	upper = np.zeros((len(busTrajectories), len(lineTrajectories)), dtype=np.int64)
+	for busIndex in range(len(busTrajectories)):
+		lines = np.arange(len(lineTrajectories)) if candidates is None else np.nonzero(candidates[busIndex])[0]
+		bus = slice(busBlocks[busIndex], busBlocks[busIndex+1])
+
+		# Every block of the selected lines, with the position of its line in <lines>
+		counts = lineBlocks[lines+1] - lineBlocks[lines]
+		owner = np.repeat(np.arange(len(lines)), counts)
+		blocks = np.repeat(lineBlocks[lines], counts) + (np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts))
+
+		nearest = np.full(len(blocks), np.inf)
+		lowerBound = np.full(len(blocks), np.inf)
+		if bus.stop > bus.start:
+			rowsPerChunk = max(1, MAX_ELEMENTS // (bus.stop - bus.start))
+			for chunk in range(0, len(blocks), rowsPerChunk):
+				chunkBlocks = blocks[chunk:chunk+rowsPerChunk]
+				distances = PointDistance(busPoints[None, busRepresentatives[bus]], linePoints[lineRepresentatives[chunkBlocks], None])
+				# Representatives are bus points, their distance bounds the nearest bus point from above
+				nearest[chunk:chunk+rowsPerChunk] = np.min(distances, axis=1)
+				lowerBound[chunk:chunk+rowsPerChunk] = np.min(distances - busRadius[None, bus], axis=1)
+
+		surelyClose = nearest + lineRadius[blocks] < tolerance - margin
+		possiblyClose = lowerBound - lineRadius[blocks] < tolerance + margin
+		lower[busIndex, lines] = np.bincount(owner, weights=lineSizes[blocks]*surelyClose, minlength=len(lines))
+		upper[busIndex, lines] = np.bincount(owner, weights=lineSizes[blocks]*possiblyClose, minlength=len(lines))
+	return lower, upper
+
+
+def DetectLines(busTrajectories, lineTrajectories, tolerance, detectionPercentage, Refine, candidates=None, projected=False, busBlockPoints=DEFAULT_BUS_BLOCK_POINTS, lineBlockPoints=DEFAULT_LINE_BLOCK_POINTS, stats=None, logging=None, origin=None):
+	"""
+	Arguments:
+		busTrajectories, lineTrajectories - Trajectories of the buses and lines
+		tolerance - distance tolerance in meters
+		detectionPercentage - minimum fraction of close line points for detection
+		Refine - function(busTrajectories, lineTrajectories, candidates) returning the full resolution (bus, line)
+			detection matrix of the candidate pairs
+		candidates - (optional) (bus, line) boolean matrix, only these pairs are evaluated
+		projected - compares projected coordinates (see Distance.Project) instead of the haversine
+		busBlockPoints, lineBlockPoints - points of each bus and line block of the coarse level
+		stats - (optional) dict filled with the amount of evaluated ('multires-pairs') and refined ('multires-refined-pairs') pairs
+		origin - (optional) projection origin of the projected mode. <Refine> must project the subsets from the same one
+	Returns:
+		(bus, line) boolean detection matrix, the same as the full resolution engine
+	"""
+	lower, upper = CoarseScores(busTrajectories, lineTrajectories, tolerance, candidates, projected, busBlockPoints, lineBlockPoints, origin)
+	lengths = lineTrajectories.lengths[None, :]
+	with np.errstate(divide="ignore", invalid="ignore"):
+		results = lower / lengths > detectionPercentage
+		refine = (upper / lengths > detectionPercentage) & ~results
+	if candidates is not None:
+		results &= candidates
+		refine &= candidates
+
+	refineBuses = np.nonzero(np.any(refine, axis=1))[0]
+	refineLines = np.nonzero(np.any(refine, axis=0))[0]
+	if len(refineBuses):
+		selection = np.ix_(refineBuses, refineLines)
+		results[selection] |= Refine(busTrajectories.subset(refineBuses), lineTrajectories.subset(refineLines), refine[selection]) & refine[selection]
+
+	pairs = int(np.count_nonzero(candidates)) if candidates is not None else results.size
+	refined = int(np.count_nonzero(refine))
+	if stats is not None:
+		stats['multires-pairs'] = stats.get('multires-pairs', 0) + pairs
+		stats['multires-refined-pairs'] = stats.get('multires-refined-pairs', 0) + refined
+	if logging:
+		logging.info(f"Multi-resolution detection refined {refined} of {pairs} bus/line pairs at full resolution")
+	return results
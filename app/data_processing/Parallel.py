@@ -0,0 +1,106 @@
+#
+# Parallel.py
+# Description:
+#	Process pool line detection. Bus batches are sharded across worker processes, the trajectories are
+#	shared read-only through memory-mapped files and every worker writes its rows straight into a
+#	preallocated memory-mapped output matrix.
+#
+
+import os
+import math
+import shutil
+import pathlib
+import tempfile
+from configparser import ConfigParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from data_processing import LineDetection, TilePlanner
+from data_processing.Trajectories import Trajectories
+
+# Shards per worker, so that the bigger buses (at the start of the list) do not leave workers idle
+SHARDS_PER_WORKER = 4
+
+# State of each worker process, filled by _Initializer
+_worker = dict()
+
+
+def GetWorkers(CONFIGS):
+	"""
+	Returns CONFIGS['default_correction_method']['workers'] (defaults to 1). 0 uses every available core
+	"""
+	workers = CONFIGS.getint('default_correction_method', 'workers', fallback=1)
+	return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def _Initializer(directory, configuration):
+	directory = pathlib.Path(directory)
+	CONFIGS = ConfigParser()
+	CONFIGS.read_dict(configuration)
+
+	_worker['configs'] = CONFIGS
+	_worker['bus'] = Trajectories.load(directory / "bus", mmapMode="r")
+	_worker['line'] = Trajectories.load(directory / "line", mmapMode="r")
+	_worker['output'] = np.load(directory / "output.npy", mmap_mode="r+")
+	_worker['candidates'] = np.load(directory / "candidates.npy", mmap_mode="r") if (directory / "candidates.npy").exists() else None
+
+
+def _DetectShard(start, end):
+	busShard = _worker['bus'].slice(start, end)
+	candidates = _worker['candidates'][start:end] if _worker['candidates'] is not None else None
+	_worker['output'][start:end] = LineDetection.RunEngine(busShard, _worker['line'], _worker['configs'], candidates=candidates)
+	_worker['output'].flush()
+	return start, end
+
+
+def ParallelDetection(busTrajectories, lineTrajectories, CONFIGS, workers, logging=None, candidates=None):
+	"""
+	Arguments:
+		busTrajectories - Trajectories of the buses
+		lineTrajectories - Trajectories of the lines
+		CONFIGS - configparser object
+		workers - amount of worker processes
+		logging - logger
+		candidates - (optional) (bus, line) boolean matrix of the pairs to be evaluated (see Envelope)
+	Returns:
+		fullResults - (bus, line) boolean detection matrix, identical to LineDetection.RunEngine's
+	Description:
+		Workers may tile their shard differently than the serial run (memory budget split per worker, length
+		buckets of the shard). Results are still identical: the detection of each bus/line pair only depends
+		on their points, never on the tile they were evaluated in.
+	"""
+	busStepSize = int(CONFIGS['default_correction_method']['busStepSize'])
+	busAmount = len(busTrajectories)
+	shardSize = busStepSize * max(1, math.ceil(busAmount / (busStepSize * workers * SHARDS_PER_WORKER)))
+	shards = [(start, min(start + shardSize, busAmount)) for start in range(0, busAmount, shardSize)]
+
+	# Workers always compute on the CPU
+	configuration = {'default_correction_method': dict(CONFIGS['default_correction_method'])}
+	configuration['default_correction_method']['backend'] = "numpy"
+	# The memory budget is shared by every worker
+	maxMemory = TilePlanner.GetMaxMemory(CONFIGS)
+	if maxMemory:
+		configuration['default_correction_method'][CONFIGS.optionxform('maxMemoryMBytes')] = str(maxMemory / workers / 2**20)
+
+	sharedRoot = "/dev/shm" if os.path.isdir("/dev/shm") else None
+	directory = pathlib.Path(tempfile.mkdtemp(prefix="line_detection_", dir=sharedRoot))
+	try:
+		busTrajectories.save(directory / "bus")
+		lineTrajectories.save(directory / "line")
+		if candidates is not None:
+			np.save(directory / "candidates.npy", candidates)
+		output = np.lib.format.open_memmap(directory / "output.npy", mode="w+", dtype=bool, shape=(busAmount, len(lineTrajectories)))
+		del output
+
+		if logging:
+			logging.info(f"Detection over {len(shards)} shards of {shardSize} buses with {workers} workers")
+		with ProcessPoolExecutor(max_workers=workers, initializer=_Initializer, initargs=(str(directory), configuration)) as executor:
+			for future in [executor.submit(_DetectShard, start, end) for start, end in shards]:
+				start, end = future.result()
+				if logging:
+					logging.debug(f"Buses {start} to {end} detected")
+
+		return np.array(np.load(directory / "output.npy", mmap_mode="r"))
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,61 @@
+#
+# RunLength.py
+# Description:
+#	Vectorized run-length encoding helpers. Functions working on matrices treat each row (last axis)
+#	as an independent sequence, so many belonging arrays can be processed at once.
+#
+
+import numpy as np
+
+
+def _RunStarts(array):
+	"""
+	Boolean mask, same shape as <array>, set on the first element of each run of each row
+	"""
+	array = np.asarray(array)
+	starts = np.ones(array.shape, dtype=bool)
+	starts[..., 1:] = array[..., 1:] != array[..., :-1]
+	return starts
+
+
+def Encode(array):
+	"""
+	Arguments:
+		array - 1-D array
+	Returns:
+		values - value of each run
+		starts - index where each run starts
+		lengths - amount of elements of each run
+	"""
+	array = np.asarray(array)
+	starts = np.nonzero(_RunStarts(array))[0]
+	lengths = np.diff(np.append(starts, len(array)))
+	return array[starts], starts, lengths
+
+
+def Decode(values, lengths):
+	"""
+	Inverse of Encode: repeats each value by its run length
+	"""
+	return np.repeat(values, lengths)
+
+
+def RunLengths(array):
+	"""
+	Returns, for each element, the length of the run it belongs to. Rows of a matrix are independent
+	"""
+	array = np.asarray(array)
+	runId = np.cumsum(_RunStarts(array).ravel()) - 1
+	return np.bincount(runId)[runId].reshape(array.shape)
+
+
+def SuppressShortRuns(array, limit):
+	"""
+	Arguments:
+		array - binary array or matrix (one sequence per row)
+		limit - minimum length of a valid run
+	Returns:
+		int64 array where every run shorter than <limit> is inverted, eliminating fluctuations
+	"""
+	array = np.asarray(array).astype("int64")
+	return np.where(RunLengths(array) < int(limit), 1 - array, array)
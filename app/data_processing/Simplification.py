@@ -0,0 +1,83 @@
+#
+# Simplification.py
+# Description:
+#	Distance based thinning of trajectories before detection. Consecutive points falling in the same grid
+#	cell are represented by the first of them, so stationary periods (terminals, traffic) collapse into a
+#	single point. Labels computed on the kept points are mapped back to every original point.
+#
+
+import numpy as np
+import pandas as pd
+
+from data_processing import Distance
+
+
+def GetSimplification(CONFIGS):
+	"""
+	Returns:
+		tolerance - thinning distance in meters (simplification x distanceTolerance), None when disabled
+		simplifyLines - True when line shapes are also thinned
+	Configurations:
+		CONFIGS['default_correction_method']['simplification'] - (optional) fraction of distanceTolerance, defaults to 0 (disabled)
+		CONFIGS['default_correction_method']['simplifyLines'] - (optional) defaults to False
+	"""
+	fraction = CONFIGS.getfloat('default_correction_method', 'simplification', fallback=0)
+	tolerance = fraction * float(CONFIGS['default_correction_method']['distanceTolerance'])
+	return (tolerance if tolerance > 0 else None), CONFIGS.getboolean('default_correction_method', 'simplifyLines', fallback=False)
+
+
+def ThinningMask(trajectories, tolerance):
+	"""
+	Arguments:
+		trajectories - Trajectories
+		tolerance - maximum distance (meters) between a removed point and the point representing it
+	Returns:
+		boolean mask over the coordinates, set on the kept points. The first and last point of each
+		trajectory and invalid (NaN) points are always kept
+	"""
+	lat, lon = Distance.BusRadians(np.asarray(trajectories.coordinates, dtype=float))
+	valid = ~(np.isnan(lat) | np.isnan(lon))
+
+	# Cells with a diagonal of <tolerance>. The longitude size uses the lowest latitude, where a radian is the longest
+	cellLat = tolerance / Distance.EARTH_RADIUS / np.sqrt(2)
+	cosLat = np.cos(np.min(np.abs(lat[valid]))) if np.any(valid) else 1.0
+	cellLon = cellLat / cosLat
+	row = np.floor(np.where(valid, lat, 0) / cellLat).astype(np.int64)
+	col = np.floor(np.where(valid, lon, 0) / cellLon).astype(np.int64)
+
+	keep = ~valid
+	keep[0:1] = True
+	keep[1:] |= (row[1:] != row[:-1]) | (col[1:] != col[:-1])
+
+	nonEmpty = trajectories.lengths > 0
+	keep[trajectories.offsets[:-1][nonEmpty]] = True
+	keep[trajectories.offsets[1:][nonEmpty] - 1] = True
+	return keep
+
+
+def Simplify(trajectories, tolerance):
+	"""
+	Returns:
+		simplified - Trajectories (same class and ids) with only the kept points
+		owner - for each original point, the index (in simplified.coordinates) of the point representing it
+	"""
+	keep = ThinningMask(trajectories, tolerance)
+	return trajectories.selectPoints(keep), np.cumsum(keep) - 1
+
+
+def ExpandLabels(resultTable, busTrajectories, simplified, owner):
+	"""
+	Arguments:
+		resultTable - LineCorrection.CorrectData result over the simplified buses
+		busTrajectories - original Trajectories of the buses
+		simplified, owner - as returned by Simplify(busTrajectories)
+	Returns:
+		resultTable over every original point, each point labeled as the point representing it
+	"""
+	busIndex = busTrajectories.index()
+	expanded = []
+	for bus in resultTable.columns:
+		position = busIndex[bus]
+		localOwner = owner[busTrajectories.offsets[position]:busTrajectories.offsets[position+1]] - simplified.offsets[position]
+		expanded += [list(resultTable[bus].to_numpy()[localOwner])]
+	return pd.DataFrame(expanded, index=list(resultTable.columns)).T
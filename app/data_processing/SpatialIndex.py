@@ -0,0 +1,130 @@
+#
+# SpatialIndex.py
+# Description:
+#	Grid bucket index over every line point. Instead of building the dense (bus, busPoint, line, linePoint)
+#	distance tensor, each bus point only gets compared with the line points of its neighbouring cells,
+#	which are sized so that every pair closer than the tolerance is guaranteed to be a neighbour.
+#
+
+import numpy as np
+
+from data_processing import Distance
+from data_processing.Trajectories import LineShapes
+
+# Margin over the cell size to absorb floating point differences close to the tolerance
+CELL_MARGIN = 1 + 1e-6
+
+# Maximum amount of (busPoint, linePoint) candidate pairs evaluated at once
+MAX_CANDIDATES = 2**22
+
+
+class LineIndex:
+	"""
+	Grid bucket index of all line points
+
+	Arguments:
+		lineTrajectories - Trajectories of the lines. Radians and cos(latitude) are reused when given LineShapes
+		tolerance - distance (meters) used by the radius queries
+	"""
+	def __init__(self, lineTrajectories, tolerance):
+		self.tolerance = tolerance
+		self.lineAmount = len(lineTrajectories)
+		self.lineSizes = lineTrajectories.lengths
+		pointLine = np.repeat(np.arange(self.lineAmount), self.lineSizes)
+
+		if not isinstance(lineTrajectories, LineShapes):
+			lineTrajectories = LineShapes.fromTrajectories(lineTrajectories)
+		lat, lon, cosLat = lineTrajectories.lat, lineTrajectories.lon, lineTrajectories.cosLat
+
+		# Cells at least as big as the tolerance, so every close pair is in neighbouring cells
+		latAngle, lonAngle = Distance.ToleranceAngles(tolerance, np.max(np.abs(lat)) if len(lat) else 0)
+		self.cellLat = latAngle * CELL_MARGIN
+		self.cellLon = lonAngle * CELL_MARGIN
+
+		cells = self._Cells(lat, lon)
+		order = np.argsort(cells, kind="stable")
+		self.keys, self.starts, self.counts = np.unique(cells[order], return_index=True, return_counts=True)
+		self.pointLine = pointLine[order]
+		self.lat = lat[order]
+		self.lon = lon[order]
+		self.cosLat = cosLat[order]
+
+	def _Cells(self, lat, lon):
+		row = np.floor(lat / self.cellLat).astype(np.int64)
+		col = np.floor(lon / self.cellLon).astype(np.int64)
+		return (row << 32) + col
+
+	def _Candidates(self, lat, lon):
+		"""
+		Returns (busPoint, linePoint) index pairs of every line point in the 3x3 cell neighbourhood of each bus point
+		"""
+		row = np.floor(lat / self.cellLat).astype(np.int64)
+		col = np.floor(lon / self.cellLon).astype(np.int64)
+		busPoints = []
+		starts = []
+		counts = []
+		for rowOffset in (-1, 0, 1):
+			for colOffset in (-1, 0, 1):
+				keys = ((row + rowOffset) << 32) + (col + colOffset)
+				position = np.searchsorted(self.keys, keys)
+				position[position == len(self.keys)] = 0
+				found = np.nonzero(self.keys[position] == keys)[0] if len(self.keys) else np.zeros(0, dtype=np.int64)
+				busPoints.append(found)
+				starts.append(self.starts[position[found]])
+				counts.append(self.counts[position[found]])
+		busPoints = np.concatenate(busPoints)
+		starts = np.concatenate(starts)
+		counts = np.concatenate(counts)
+
+		total = int(np.sum(counts))
+		offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+		return np.repeat(busPoints, counts), np.repeat(starts, counts) + offsets
+
+	def covered(self, busTrajectory):
+		"""
+		Arguments:
+			busTrajectory - (points, lat/lon) array in degrees
+		Returns:
+			boolean array over the indexed line points (index order) set when the point is within tolerance of the bus
+		"""
+		lat, lon = Distance.BusRadians(np.asarray(busTrajectory, dtype=float))
+
+		cosLat = np.cos(lat)
+
+		covered = np.zeros(len(self.lat), dtype=bool)
+		step = max(1, MAX_CANDIDATES // max(1, 9*int(np.max(self.counts, initial=1))))
+		for start in range(0, len(lat), step):
+			busPoints, linePoints = self._Candidates(lat[start:start+step], lon[start:start+step])
+			busPoints += start
+			distances = Distance.PairDistance(lat[busPoints], lon[busPoints], self.lat[linePoints], self.lon[linePoints],
+				busCos=cosLat[busPoints], lineCos=self.cosLat[linePoints])
+			covered[linePoints[distances < self.tolerance]] = True
+		return covered
+
+	def coverage(self, busTrajectory):
+		"""
+		Returns the fraction of points of each line within tolerance of the bus trajectory, as LineDetection.Algorithm
+		"""
+		below = np.bincount(self.pointLine[self.covered(busTrajectory)], minlength=self.lineAmount)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			return below / self.lineSizes
+
+
+def DetectLines(busTrajectories, lineTrajectories, tolerance, detectionPercentage, logging=None):
+	"""
+	Arguments:
+		busTrajectories - Trajectories of the buses
+		lineTrajectories - Trajectories of the lines. Radians and cos(latitude) are reused when given LineShapes
+		tolerance - distance tolerance in meters
+		detectionPercentage - minimum fraction of line points close to the bus for a detection
+	Returns:
+		(bus, line) boolean matrix, the same LineDetection.Algorithm returns for the whole data
+	"""
+	index = LineIndex(lineTrajectories, tolerance)
+	if logging:
+		logging.debug(f"Line index with {len(index.keys)} cells over {len(index.lat)} points")
+
+	results = np.zeros((len(busTrajectories), index.lineAmount), dtype=bool)
+	for bus in range(len(busTrajectories)):
+		results[bus] = index.coverage(busTrajectories[bus]) > np.array(detectionPercentage)
+	return results
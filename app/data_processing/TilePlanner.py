@@ -0,0 +1,175 @@
+#
+# TilePlanner.py
+# Description:
+#	Tiling of the dense detection. Trajectories are grouped in length buckets (powers of two or quantiles),
+#	ordered by decreasing length and split in consecutive tiles, so each tile holds trajectories of similar
+#	length and is padded only up to its own longest one. With a memory budget, tiles grow until the
+#	estimated peak memory of Algorithm reaches it.
+#
+
+import numpy as np
+
+# float64 (bus, busPoint, line, linePoint) distance arrays alive at the peak of Algorithm
+DISTANCE_COPIES = 4
+VALUE_BYTES = 8
+
+# Length bucketing modes, chosen by CONFIGS['default_correction_method']['bucketing']
+#   none - a single bucket, trajectories keep their order
+#   pow2 - trajectories with lengths in the same (2^(k-1), 2^k] interval
+#   quantile - bucketAmount buckets with about the same amount of trajectories each
+BUCKETING_MODES = ("none","pow2","quantile")
+DEFAULT_BUCKET_AMOUNT = 4
+
+
+def GetMaxMemory(CONFIGS):
+	"""
+	Returns CONFIGS['default_correction_method']['maxMemoryMBytes'] in bytes, None when unset or 0
+	"""
+	maxMemory = CONFIGS.getfloat('default_correction_method', 'maxMemoryMBytes', fallback=0)
+	return int(maxMemory * 2**20) if maxMemory > 0 else None
+
+
+def GetBucketing(CONFIGS):
+	"""
+	Returns the bucketing mode (defaults to 'pow2') and the amount of quantile buckets
+	"""
+	mode = CONFIGS.get('default_correction_method', 'bucketing', fallback="pow2")
+	if mode not in BUCKETING_MODES:
+		raise ValueError(f"Unknown bucketing '{mode}'. Options are: {', '.join(BUCKETING_MODES)}")
+	return mode, CONFIGS.getint('default_correction_method', 'bucketAmount', fallback=DEFAULT_BUCKET_AMOUNT)
+
+
+def Buckets(indices, lengths, mode, amount=DEFAULT_BUCKET_AMOUNT):
+	"""
+	Arguments:
+		indices - trajectory indices to be grouped
+		lengths - lengths of every trajectory
+		mode - one of BUCKETING_MODES
+		amount - amount of buckets of the 'quantile' mode
+	Returns:
+		list of index arrays of trajectories of similar length, each ordered by decreasing length
+	"""
+	indices = np.asarray(indices, dtype=np.int64)
+	if mode == "none" or len(indices) == 0:
+		return [indices]
+
+	indices = ByLength(indices, lengths)
+	selected = lengths[indices]
+	if mode == "pow2":
+		keys = np.ceil(np.log2(np.maximum(selected, 1))).astype(np.int64)
+	else:
+		edges = np.quantile(selected, np.linspace(0, 1, amount + 1)[1:-1])
+		keys = np.searchsorted(edges, selected, side="right")
+
+	# Ordered by length, so every bucket is a contiguous run of keys
+	boundaries = np.nonzero(keys[1:] != keys[:-1])[0] + 1
+	return np.split(indices, boundaries)
+
+
+def ChunkBytes(maxMemory):
+	"""
+	Bytes of each bus point chunk of Algorithm on the CPU (its tileBytes), half of the budget
+	"""
+	return maxMemory // (2 * DISTANCE_COPIES)
+
+
+def TileBytes(busCount, busPoints, lineElements, gpu):
+	"""
+	Arguments:
+		busCount, busPoints - amount of buses of the tile and length of the longest one
+		lineElements - amount of lines of the tile times the length of the longest one
+		gpu - True when Algorithm computes the whole tensor at once
+	Returns:
+		estimated peak memory (bytes) of Algorithm over the tile
+	"""
+	if gpu:
+		return VALUE_BYTES * DISTANCE_COPIES * busCount * busPoints * lineElements
+	# On the CPU the bus points are chunked in ChunkBytes, the other half of the budget holds the
+	# minimum distance matrices and at least one bus point of each chunk
+	return 2 * VALUE_BYTES * (DISTANCE_COPIES + 2) * busCount * lineElements
+
+
+def SplitTiles(indices, lengths, fits):
+	"""
+	Arguments:
+		indices - trajectory indices, ordered by decreasing length
+		lengths - lengths of the trajectories at <indices>
+		fits - fits(count, maxLength) is True when a tile of <count> trajectories up to <maxLength> points fits
+	Returns:
+		list of index arrays, consecutive tiles as big as <fits> allows (at least one trajectory each)
+	"""
+	tiles = []
+	start = 0
+	while start < len(indices):
+		end = start + 1
+		while end < len(indices) and fits(end + 1 - start, lengths[start]):
+			end += 1
+		tiles.append(indices[start:end])
+		start = end
+	return tiles
+
+
+def CandidateGroups(indices, candidates):
+	"""
+	Arguments:
+		indices - bus indices
+		candidates - (bus, line) boolean matrix of the pairs to be evaluated
+	Returns:
+		list of (bus indices, line indices), the buses at <indices> grouped by identical candidate lines, in
+		their order. Buses without any candidate line are left out
+	"""
+	indices = np.asarray(indices, dtype=np.int64)
+	if len(indices) == 0:
+		return []
+	patterns, inverse = np.unique(candidates[indices], axis=0, return_inverse=True)
+	inverse = inverse.reshape(-1)
+	groups = [(indices[inverse == index], np.nonzero(pattern)[0]) for index, pattern in enumerate(patterns)]
+	return [(buses, lines) for buses, lines in groups if len(lines)]
+
+
+def ByLength(indices, lengths):
+	"""
+	Returns <indices> ordered by decreasing trajectory length (<lengths> of every trajectory)
+	"""
+	indices = np.asarray(indices, dtype=np.int64)
+	return indices[np.argsort(-lengths[indices], kind="stable")]
+
+
+class TilePlan:
+	"""
+	Arguments:
+		busLengths, lineLengths - lengths of every bus and line trajectory
+		lineStepSize - maximum amount of lines of a tile
+		maxMemory - budget (bytes) of each tile
+		gpu - True when Algorithm runs on the GPU
+	"""
+	def __init__(self, busLengths, lineLengths, lineStepSize, maxMemory, gpu):
+		self.busLengths = np.asarray(busLengths)
+		self.lineLengths = np.asarray(lineLengths)
+		self.lineStepSize = lineStepSize
+		self.maxMemory = maxMemory
+		self.gpu = gpu
+
+		# Line tiles are bound by the longest lineStepSize lines, or less when a single longest bus would not fit
+		busPoints = int(np.max(self.busLengths, initial=1))
+		lineOrder = ByLength(np.arange(len(self.lineLengths)), self.lineLengths)
+		self.lineElements = 1
+		for tile in self.lineTiles(lineOrder, lambda count, maxLength: count <= lineStepSize and TileBytes(1, busPoints, count * maxLength, gpu) <= maxMemory):
+			self.lineElements = max(self.lineElements, len(tile) * int(self.lineLengths[tile[0]]))
+
+	def lineTiles(self, lineIndices, fits=None):
+		"""
+		Splits the selected lines in tiles of at most lineStepSize lines and lineElements padded points
+		"""
+		if fits is None:
+			fits = lambda count, maxLength: count <= self.lineStepSize and count * maxLength <= self.lineElements
+		lineIndices = ByLength(lineIndices, self.lineLengths)
+		return SplitTiles(lineIndices, self.lineLengths[lineIndices], fits)
+
+	def busTiles(self, busIndices=None):
+		"""
+		Splits the selected buses (every bus by default) in tiles that fit the budget against any line tile
+		"""
+		busIndices = ByLength(np.arange(len(self.busLengths)) if busIndices is None else busIndices, self.busLengths)
+		fits = lambda count, maxLength: TileBytes(count, maxLength, self.lineElements, self.gpu) <= self.maxMemory
+		return SplitTiles(busIndices, self.busLengths[busIndices], fits)
@@ -0,0 +1,187 @@
+#
+# Trajectories.py
+# Description:
+#	Ragged (CSR-style) storage of bus and line trajectories. Every trajectory is kept in a single flat
+#	float32 coordinate buffer, so memory follows the real amount of points instead of count x max length.
+#
+
+import json
+import pathlib
+
+import numpy as np
+
+from data_processing import Distance
+
+COORDINATE_TYPE = np.float32
+
+
+class Trajectories:
+	"""
+	Arguments:
+		coordinates - (points, lat/lon) buffer with every trajectory concatenated
+		offsets - (trajectories + 1) array, trajectory i is coordinates[offsets[i]:offsets[i+1]]
+		ids - identifier of each trajectory (bus_id for buses, (line_id, direction) for lines)
+	"""
+	def __init__(self, coordinates, offsets, ids):
+		self.coordinates = np.asarray(coordinates, dtype=COORDINATE_TYPE).reshape(-1, 2)
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.ids = list(ids)
+		if len(self.offsets) != len(self.ids) + 1 or self.offsets[-1] != len(self.coordinates):
+			raise ValueError("Offsets do not match the amount of ids and coordinates")
+
+	@classmethod
+	def empty(cls, sizes, ids):
+		"""
+		Allocates NaN filled storage for trajectories of the given sizes
+		"""
+		offsets = np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+		return cls(np.full((offsets[-1], 2), np.nan, dtype=COORDINATE_TYPE), offsets, ids)
+
+	@classmethod
+	def fromArrays(cls, arrays, ids):
+		"""
+		Builds the storage from a list of (points, lat/lon) arrays
+		"""
+		sizes = [len(array) for array in arrays]
+		trajectories = cls.empty(sizes, ids)
+		if len(arrays):
+			trajectories.coordinates[:] = np.concatenate([np.reshape(array, (-1, 2)) for array in arrays])
+		return trajectories
+
+	@classmethod
+	def fromPadded(cls, matrix, ids):
+		"""
+		Builds the storage from a NaN padded matrix[<trajetoria>][<coord>][<lat/lon>], dropping NaN rows
+		"""
+		matrix = np.asarray(matrix)
+		return cls.fromArrays([trajectory[~np.any(np.isnan(trajectory), axis=1)] for trajectory in matrix], ids)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __getitem__(self, index):
+		return self.coordinates[self.offsets[index]:self.offsets[index+1]]
+
+	@property
+	def lengths(self):
+		return np.diff(self.offsets)
+
+	@property
+	def nbytes(self):
+		return self.coordinates.nbytes + self.offsets.nbytes
+
+	def index(self):
+		"""
+		Returns a dict from id to trajectory position
+		"""
+		return {trajectoryId: position for position, trajectoryId in enumerate(self.ids)}
+
+	def slice(self, start, end):
+		"""
+		Returns trajectories start..end-1 sharing the coordinate buffer (no copy)
+		"""
+		return Trajectories(self.coordinates[self.offsets[start]:self.offsets[end]], self.offsets[start:end+1] - self.offsets[start], self.ids[start:end])
+
+	def subset(self, indices):
+		"""
+		Returns a new Trajectories with only the trajectories at <indices>, in that order
+		"""
+		indices = np.asarray(indices, dtype=np.int64)
+		return Trajectories.fromArrays([self[i] for i in indices], [self.ids[i] for i in indices])
+
+	def selectPoints(self, mask):
+		"""
+		Returns a new Trajectories with only the points where <mask> (aligned with coordinates) is set
+		"""
+		mask = np.asarray(mask, dtype=bool)
+		kept = np.concatenate(([0], np.cumsum(mask)))
+		return Trajectories(self.coordinates[mask], kept[self.offsets], self.ids)
+
+	def projected(self, origin):
+		"""
+		Returns the trajectories with coordinates projected to (north, east) meters from <origin> (see Distance.Project)
+		"""
+		return Trajectories(Distance.Project(self.coordinates, origin), self.offsets, self.ids)
+
+	def padded(self, indices=None, dtype=np.float64):
+		"""
+		Returns the selected trajectories as a NaN padded matrix[<trajetoria>][<coord>][<lat/lon>],
+		padded only up to the longest trajectory of the selection
+		"""
+		indices = np.arange(len(self)) if indices is None else np.asarray(indices, dtype=np.int64)
+		lengths = self.lengths[indices]
+		matrix = np.full((len(indices), int(np.max(lengths, initial=0)), 2), np.nan, dtype=dtype)
+		for row, (index, length) in enumerate(zip(indices, lengths)):
+			matrix[row, :length] = self[index]
+		return matrix
+
+	def save(self, directory):
+		"""
+		Saves the trajectories as coordinates.npy, offsets.npy and ids.json inside <directory>
+		"""
+		directory = pathlib.Path(directory)
+		directory.mkdir(parents=True, exist_ok=True)
+		np.save(directory / "coordinates.npy", self.coordinates)
+		np.save(directory / "offsets.npy", self.offsets)
+		with open(directory / "ids.json", "w") as fil:
+			json.dump(self.ids, fil)
+
+	@classmethod
+	def load(cls, directory, mmapMode=None):
+		"""
+		Loads trajectories saved by save(). With mmapMode='r' the coordinates are memory-mapped instead of read
+		"""
+		directory = pathlib.Path(directory)
+		with open(directory / "ids.json", "r") as fil:
+			ids = [tuple(i) if isinstance(i, list) else i for i in json.load(fil)]
+		return cls(np.load(directory / "coordinates.npy", mmap_mode=mmapMode), np.load(directory / "offsets.npy"), ids)
+
+
+class LineShapes(Trajectories):
+	"""
+	Line trajectories with the latitude, longitude (radians) and cos(latitude) of every point precomputed,
+	aligned with the coordinate buffer
+
+	Arguments:
+		coordinates, offsets, ids - as Trajectories
+		lat, lon, cosLat - (optional) precomputed values, derived from coordinates when not given
+	"""
+	def __init__(self, coordinates, offsets, ids, lat=None, lon=None, cosLat=None):
+		super().__init__(coordinates, offsets, ids)
+		if lat is None or lon is None:
+			lat, lon = Distance.LineRadians(self.coordinates.astype(float))
+		self.lat = lat
+		self.lon = lon
+		self.cosLat = np.cos(lat) if cosLat is None else cosLat
+
+	@classmethod
+	def fromTrajectories(cls, trajectories):
+		return cls(trajectories.coordinates, trajectories.offsets, trajectories.ids)
+
+	def subset(self, indices):
+		indices = np.asarray(indices, dtype=np.int64)
+		lengths = self.lengths[indices]
+		points = np.repeat(self.offsets[indices] - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) + np.arange(np.sum(lengths))
+		offsets = np.concatenate(([0], np.cumsum(lengths)))
+		return LineShapes(self.coordinates[points], offsets, [self.ids[i] for i in indices], self.lat[points], self.lon[points], self.cosLat[points])
+
+	def selectPoints(self, mask):
+		mask = np.asarray(mask, dtype=bool)
+		kept = np.concatenate(([0], np.cumsum(mask)))
+		return LineShapes(self.coordinates[mask], kept[self.offsets], self.ids, self.lat[mask], self.lon[mask], self.cosLat[mask])
+
+	def save(self, directory):
+		super().save(directory)
+		directory = pathlib.Path(directory)
+		np.save(directory / "lat.npy", self.lat)
+		np.save(directory / "lon.npy", self.lon)
+		np.save(directory / "cosLat.npy", self.cosLat)
+
+	@classmethod
+	def load(cls, directory, mmapMode=None):
+		directory = pathlib.Path(directory)
+		trajectories = Trajectories.load(directory, mmapMode)
+		return cls(trajectories.coordinates, trajectories.offsets, trajectories.ids,
+			np.load(directory / "lat.npy", mmap_mode=mmapMode),
+			np.load(directory / "lon.npy", mmap_mode=mmapMode),
+			np.load(directory / "cosLat.npy", mmap_mode=mmapMode))
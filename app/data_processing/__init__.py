@@ -1 +1 @@
-__all__ = ["LineDetection","LineCorrection"]
+__all__ = ["LineDetection","LineCorrection","Backend","Chord","Distance","EarlyExit","Envelope","Fused","Multiresolution","Parallel","RunLength","Simplification","SpatialIndex","TilePlanner","Trajectories"]
@@ -0,0 +1,154 @@
+import json
+import shutil
+import hashlib
+import pathlib
+import datetime
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from data_processing.Trajectories import LineShapes, Trajectories
+
+
+# Stage level checkpoints of the correction pipeline
+#
+# Each stage is saved in its own directory (npy files, memory-mapped on load) together with a manifest
+# holding the key of its inputs. A stage whose key did not change can be loaded instead of recomputed.
+# Stage directories are written under a temporary name and renamed, so a crash never leaves a partial stage.
+
+def Fingerprint(*items):
+	"""
+	Returns a short hash of the JSON representation of <items>
+	"""
+	return hashlib.sha256(json.dumps(items, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def ConfigFingerprint(CONFIGS, section):
+	return Fingerprint(dict(CONFIGS[section]) if CONFIGS.has_section(section) else {})
+
+
+class Checkpoint:
+	def __init__(self, directory, manifest, logging=None):
+		"""
+		Arguments:
+			directory - root directory of the checkpoints of one run (e.g. one date)
+			manifest - dict saved with every stage (date, filters, configuration hash...)
+			logging - logger
+		"""
+		self.directory = pathlib.Path(directory)
+		self.manifest = manifest
+		self.log = logging
+
+	def path(self, stage):
+		return self.directory / stage
+
+	def stageManifest(self, stage):
+		manifestPath = self.path(stage) / "manifest.json"
+		if not manifestPath.exists():
+			return None
+		with open(manifestPath, "r") as fil:
+			return json.load(fil)
+
+	def valid(self, stage, key):
+		"""
+		True if <stage> was saved with the same input key
+		"""
+		manifest = self.stageManifest(stage)
+		return manifest is not None and manifest.get('key') == key
+
+	def save(self, stage, key, **artifacts):
+		"""
+		Saves every artifact of <stage>. Supported artifacts are numpy arrays, Trajectories, pandas DataFrames
+		and JSON serializable objects
+		"""
+		self.directory.mkdir(parents=True, exist_ok=True)
+		temporaryPath = pathlib.Path(tempfile.mkdtemp(prefix=f".{stage}-", dir=self.directory))
+		kinds = dict()
+		try:
+			for name, artifact in artifacts.items():
+				if isinstance(artifact, LineShapes):
+					kinds[name] = "lineshapes"
+					artifact.save(temporaryPath / name)
+				elif isinstance(artifact, Trajectories):
+					kinds[name] = "trajectories"
+					artifact.save(temporaryPath / name)
+				elif isinstance(artifact, pd.DataFrame):
+					kinds[name] = "dataframe"
+					_SaveDataFrame(temporaryPath / name, artifact)
+				elif isinstance(artifact, np.ndarray):
+					kinds[name] = "array"
+					np.save(temporaryPath / f"{name}.npy", artifact)
+				else:
+					kinds[name] = "json"
+					with open(temporaryPath / f"{name}.json", "w") as fil:
+						json.dump(artifact, fil, default=str)
+
+			manifest = dict(self.manifest)
+			manifest.update({'stage': stage, 'key': key, 'artifacts': kinds, 'created': datetime.datetime.now().isoformat()})
+			with open(temporaryPath / "manifest.json", "w") as fil:
+				json.dump(manifest, fil, default=str, indent=1)
+
+			stagePath = self.path(stage)
+			if stagePath.exists():
+				shutil.rmtree(stagePath)
+			temporaryPath.rename(stagePath)
+		except BaseException:
+			shutil.rmtree(temporaryPath, ignore_errors=True)
+			raise
+		if self.log:
+			self.log.debug(f"Checkpoint of stage '{stage}' saved at {stagePath}")
+
+	def load(self, stage):
+		"""
+		Returns a dict with every artifact of <stage>
+		"""
+		stagePath = self.path(stage)
+		artifacts = dict()
+		for name, kind in self.stageManifest(stage)['artifacts'].items():
+			if kind == "lineshapes":
+				artifacts[name] = LineShapes.load(stagePath / name, mmapMode="r")
+			elif kind == "trajectories":
+				artifacts[name] = Trajectories.load(stagePath / name, mmapMode="r")
+			elif kind == "dataframe":
+				artifacts[name] = _LoadDataFrame(stagePath / name)
+			elif kind == "array":
+				artifacts[name] = np.load(stagePath / f"{name}.npy", mmap_mode="r")
+			else:
+				with open(stagePath / f"{name}.json", "r") as fil:
+					artifacts[name] = json.load(fil)
+		if self.log:
+			self.log.info(f"Stage '{stage}' resumed from checkpoint at {stagePath}")
+		return artifacts
+
+
+def _Labels(values):
+	return [tuple(i) if isinstance(i, list) else i for i in values]
+
+
+def _SaveDataFrame(directory, dataframe):
+	"""
+	Boolean/numeric frames are saved as is. Object frames (corrected line labels) are saved as strings with
+	missing values as ''
+	"""
+	directory.mkdir(parents=True)
+	values = dataframe.to_numpy()
+	objects = values.dtype == object
+	if objects:
+		values = np.where(pd.isna(values), "", values).astype(str)
+	np.save(directory / "values.npy", values)
+	with open(directory / "labels.json", "w") as fil:
+		json.dump({'index': list(dataframe.index), 'columns': list(dataframe.columns), 'objects': bool(objects)}, fil, default=str)
+
+
+def _LoadDataFrame(directory):
+	with open(directory / "labels.json", "r") as fil:
+		labels = json.load(fil)
+	values = np.load(directory / "values.npy")
+	if labels['objects']:
+		values = np.where(values == "", None, values.astype(object))
+
+	index = _Labels(labels['index'])
+	if len(index) and isinstance(index[0], tuple):
+		index = pd.MultiIndex.from_tuples(index)
+	return pd.DataFrame(values, index=index, columns=_Labels(labels['columns']))
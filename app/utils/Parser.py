@@ -2,6 +2,9 @@ import argparse
 import pathlib
 import datetime
 
+def float_list(text):
+	return [float(value) for value in text.split(",") if value.strip()]
+
 def parse_args():
 	parser = argparse.ArgumentParser(description="Trajectory classifier with GPU acceleration. Classifies long bus paths by line.")
 # Common options
@@ -28,14 +31,78 @@ def parse_args():
 	data_parser.add_argument("-d","--date",
 	type=datetime.date.fromisoformat,
 	default=None,
-	required=True,
 	help="(YYYY-MM-DD) Date to query bus paths"
 	)
+	data_parser.add_argument("--start-date",
+	type=datetime.date.fromisoformat,
+	default=None,
+	help="(YYYY-MM-DD) First date of a range of dates processed in a single run. Requires --end-date, ignored when --date is set."
+	)
+	data_parser.add_argument("--end-date",
+	type=datetime.date.fromisoformat,
+	default=None,
+	help="(YYYY-MM-DD) Last date (inclusive) of a range of dates processed in a single run."
+	)
 
 
 # Execution parameters
-# TODO: Control for max memory occupation size
-
+	execution_parser = parser.add_argument_group(title="Execution",
+	description="Options for how the detection and correction are computed")
+	execution_parser.add_argument("--backend",
+	choices=["auto","numpy","cupy"],
+	default=None,
+	help="Array backend for detection and correction. 'auto' uses cupy when installed, numpy otherwise. Overrides the 'backend' configuration."
+	)
+	execution_parser.add_argument("--max-memory",
+	type=float,
+	default=None,
+	help="(MB) Memory budget of the line detection. Tile sizes are chosen from the trajectory lengths to fit it, instead of busStepSize. Overrides the 'maxMemoryMBytes' configuration."
+	)
+	execution_parser.add_argument("--validate-distance",
+	action="store_true",
+	help="With the 'projected' distance mode, also runs the exact haversine detection and reports every bus/line pair classified differently."
+	)
+	execution_parser.add_argument("--incremental",
+	action="store_true",
+	help="Only corrects the rows not corrected yet of each bus, from its last corrected time_detection minus the overlap. Defaults to the current date."
+	)
+	execution_parser.add_argument("--overlap",
+	type=float,
+	default=None,
+	help="(minutes) Context of already corrected rows requested before each bus watermark by --incremental. Overrides the 'overlapMinutes' configuration."
+	)
+	execution_parser.add_argument("--sweep-tolerances",
+	type=float_list,
+	default=None,
+	help="(meters, comma separated) Parameter sweep: only runs the line detection, for every tolerance x percentage pair, computing the distances once. Defaults to the configured distanceTolerance when only --sweep-percentages is set."
+	)
+	execution_parser.add_argument("--sweep-percentages",
+	type=float_list,
+	default=None,
+	help="(comma separated) Detection percentages of the parameter sweep. Defaults to the configured detectionPercentage."
+	)
+	execution_parser.add_argument("--sweep-output",
+	type=pathlib.Path,
+	default=pathlib.Path("sweep"),
+	help="Directory of the parameter sweep results, one <date>.npz per date with the settings, detection counts and the fraction of close line points of every bus/line pair."
+	)
+	execution_parser.add_argument("--from-cache",
+	action="store_true",
+	help="Reads the bus data of each date from the local bus cache (memory-mapped) when the bus counts of the date did not change, and stores it there otherwise. See the 'busCachePath', 'busCacheMaxAgeDays' and 'busCacheMaxMBytes' configurations."
+	)
+	execution_parser.add_argument("--resume",
+	action="store_true",
+	help="Reuses the checkpoint of every stage whose inputs (date, filters, configuration and line_data) did not change since the last run. Implies --checkpoint."
+	)
+	execution_parser.add_argument("--checkpoint",
+	action="store_true",
+	help="Saves the checkpoint of every stage under --checkpoint-path, for a later --resume. Checkpoints are not saved otherwise."
+	)
+	execution_parser.add_argument("--checkpoint-path",
+	type=pathlib.Path,
+	default=pathlib.Path("/tmp/correction_checkpoint"),
+	help="Directory where stage checkpoints are saved, one subdirectory per date."
+	)
 
 # Debugging parameters
 	debug_parser = parser.add_argument_group(title="Debug:")
@@ -43,6 +110,21 @@ def parse_args():
 	action="store_true",
 	help="Checks integrity of database connection and exits"
 	)
+	debug_parser.add_argument("--metrics-format",
+	choices=["text","jsonl","prometheus"],
+	default="text",
+	help="Format of the per stage metrics: text summary, JSON lines appended per stage or Prometheus textfile. Defaults to text."
+	)
+	debug_parser.add_argument("--metrics-path",
+	type=pathlib.Path,
+	default=None,
+	help="File of the per stage metrics, flushed at the end of every stage. Defaults to performance.txt, performance.jsonl or performance.prom."
+	)
+	debug_parser.add_argument("--profile",
+	type=pathlib.Path,
+	default=None,
+	help="Directory where the acquisition, detection, correction and insertion stages save their cProfile results (<stage>.prof and <stage>.txt)."
+	)
 
 # Filtering options 
 	filtering_parser = parser.add_argument_group(title="Filtering inputs",
@@ -1,37 +1,267 @@
+import os
+import sys
+import json
 import time
+import atexit
+import pathlib
+import cProfile
+import pstats
+import datetime
+import resource
+import functools
+import threading
+import contextlib
 
 
-# Class to hold performance and measure execution time 
-# 
-# TODO: Use destructor to save progress in case of raised exception
+# Class to hold performance and measure execution time
 #
+# Every stage (span) records its wall time, process CPU time, peak RSS of the whole process (since its start,
+# not of the stage alone) at the stage end and the amount of rows, points and tiles it processed. Spans opened while another one is open in the same thread
+# are its children. Results are flushed to the output file at the end of every stage, and once more at
+# exit, so a crash only loses the stages still open.
+#
+# Output formats:
+#   text - human readable summary, rewritten at every stage end
+#   jsonl - one JSON object appended per stage end and per recorded value
+#   prometheus - node_exporter textfile, atomically rewritten at every stage end
+#
+# With a profile directory, stages started with profile=True run under cProfile and save <stage>.prof and a
+# <stage>.txt summary there. Each thread has its own profiler, which only sees the calls made by that thread
+# (not the other threads nor the detection worker processes), and a stage started while its thread is already
+# profiling is covered by the outer stage. Python 3.12+ allows a single active profiler per process, there a
+# stage started while another thread is profiling is not profiled. A profiled stage ends in the thread that started it.
+
+METRIC_FORMATS = ("text","jsonl","prometheus")
+METRIC_EXTENSIONS = {"text":".txt","jsonl":".jsonl","prometheus":".prom"}
+PROMETHEUS_PREFIX = "fasbus_correction"
+PROFILE_LINES = 40
+
+
+def PeakRss():
+    """
+    Peak resident memory of the whole process since its start in MB, it never decreases
+    """
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
 
 class Measure:
-    def __init__(self, filenameInput):
+    def __init__(self, filenameInput, outputFormat="text", profileDirectory=None):
+        """
+        Arguments:
+            filenameInput - output file
+            outputFormat - one of METRIC_FORMATS
+            profileDirectory - (optional) directory of the cProfile results of the stages started with profile=True
+        """
+        if outputFormat not in METRIC_FORMATS:
+            raise ValueError(f"Unknown metrics format '{outputFormat}'. Options are: {', '.join(METRIC_FORMATS)}")
         self.filename = filenameInput
+        self.outputFormat = outputFormat
+        self.profileDirectory = pathlib.Path(profileDirectory) if profileDirectory else None
+        self.run = datetime.datetime.now().isoformat()
         self.times = dict()
-        self.times['all'] = { 'start':time.time(),'forced':False}
+        self.times['all'] = self.newStage(None)
+        self.data = dict()
 
-    def start(self,key):
-        if not key in self.times.keys():
-            self.times[key] = {'start':None,'end':None}
-        self.times[key]['start'] = time.time()
-        self.times[key]['forced'] = False
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        # Profiler of each profiling thread, by thread identifier
+        self.profilers = dict()
+        self.closed = False
 
-    def end(self,key):
+        if self.outputFormat == "jsonl":
+            # Every run appends to the same file, lines are told apart by their run
+            self.emit({'type':'run','start':self.run,'argv':sys.argv})
+        atexit.register(self.close)
+
+    def stack(self):
+        if not hasattr(self.local,'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def newStage(self,parent):
+        return {
+            'start':time.time(),'cpuStart':time.process_time(),'end':None,'forced':False,
+            'parent':parent,'rows':0,'points':0,'tiles':0,'profiler':None,'profilerThread':None,
+        }
+
+    def start(self,key,profile=False):
+        with self.lock:
+            stack = self.stack()
+            self.times[key] = self.newStage(stack[-1] if stack else None)
+            stack.append(key)
+        thread = threading.get_ident()
+        if profile and self.profileDirectory and thread not in self.profilers:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another thread is profiling (Python 3.12+)
+                return
+            with self.lock:
+                self.profilers[thread] = self.times[key]['profiler'] = profiler
+                self.times[key]['profilerThread'] = thread
+
+    def end(self,key,forced=False):
         if not key in self.times.keys():
             raise Exception(f"Time for '{key}' not started")
-        self.times[key]['end'] = time.time()
+        stage = self.times[key]
+        if stage['profiler']:
+            stage['profiler'].disable()
+        with self.lock:
+            stage['end'] = time.time()
+            stage['cpuEnd'] = time.process_time()
+            stage['processPeakRssMBytes'] = PeakRss()
+            stage['forced'] = forced
+            stack = self.stack()
+            if key in stack:
+                stack.remove(key)
+            if stage['profiler']:
+                self.saveProfile(key,stage['profiler'])
+                self.profilers.pop(stage['profilerThread'],None)
+                stage['profiler'] = None
+            self.flush(key)
+
+    def count(self,key,rows=0,points=0,tiles=0):
+        """
+        Adds to the amount of rows, points and tiles processed by stage <key>
+        """
+        with self.lock:
+            stage = self.times[key]
+            stage['rows'] += int(rows)
+            stage['points'] += int(points)
+            stage['tiles'] += int(tiles)
+
+    @contextlib.contextmanager
+    def span(self,key,profile=False):
+        """
+        Context manager measuring the enclosed code as stage <key>
+        """
+        self.start(key,profile)
+        try:
+            yield self
+        finally:
+            self.end(key)
+
+    def timed(self,key,profile=False):
+        """
+        Decorator measuring every call of the function as stage <key>
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args,**kwargs):
+                with self.span(key,profile):
+                    return function(*args,**kwargs)
+            return wrapper
+        return decorator
+
+    def record(self,key,value):
+        # Non time performance data (sizes, ratios...), saved after the times
+        with self.lock:
+            self.data[key] = value
+            if self.outputFormat == "jsonl":
+                self.emit({'type':'data','run':self.run,'key':key,'value':value})
+            else:
+                self.write()
 
     def measure(self,key):
-        self.times['all']['end'] = time.time()
         if not key in self.times.keys():
             raise Exception(f"No measure for '{key}'")
         if not self.times[key]['end']:
-            self.end(key)
-            self.times[key]['forced'] = True
+            self.end(key,forced=True)
         return self.times[key]['end'] - self.times[key]['start']
-  
+
+    def stageMetrics(self,key):
+        """
+        Returns the metrics of the ended stage <key>
+        """
+        stage = self.times[key]
+        wall = stage['end'] - stage['start']
+        metrics = {
+            'stage':key,
+            'parent':stage['parent'],
+            'start':datetime.datetime.fromtimestamp(stage['start']).isoformat(),
+            'wall':wall,
+            'cpu':stage['cpuEnd'] - stage['cpuStart'],
+            'processPeakRssMBytes':stage.get('processPeakRssMBytes',PeakRss()),
+            'forced':stage['forced'],
+        }
+        for counter in ('rows','points','tiles'):
+            if stage.get(counter):
+                metrics[counter] = stage[counter]
+                metrics[f"{counter}PerSecond"] = stage[counter] / wall if wall > 0 else None
+        return metrics
+
+    def flush(self,key):
+        if self.outputFormat == "jsonl":
+            self.emit(dict(type='stage',run=self.run,**self.stageMetrics(key)))
+        else:
+            self.write()
+
+    def emit(self,line):
+        with open(self.filename,"a") as fil:
+            fil.write(json.dumps(line,default=str) + "\n")
+
+    def write(self):
+        # Written aside and renamed, so readers (e.g. node_exporter) never see a partial file
+        temporaryName = f"{self.filename}.tmp"
+        with open(temporaryName,"w") as fil:
+            fil.write(self.prometheus() if self.outputFormat == "prometheus" else f"{self}")
+        os.replace(temporaryName,self.filename)
+
+    def prometheus(self):
+        ended = [key for key,stage in self.times.items() if stage['end']]
+        lines = []
+        gauges = [
+            ("stage_wall_seconds","wall","Wall time of the stage"),
+            ("stage_cpu_seconds","cpu","Process CPU time during the stage"),
+            ("stage_process_peak_rss_mbytes","processPeakRssMBytes","Peak resident memory of the whole process since its start, at the end of the stage"),
+            ("stage_rows","rows","Rows processed by the stage"),
+            ("stage_points","points","Points processed by the stage"),
+            ("stage_tiles","tiles","Tiles processed by the stage"),
+            ("stage_tiles_per_second","tilesPerSecond","Tiles processed per second"),
+        ]
+        metrics = [self.stageMetrics(key) for key in ended]
+        for name,field,description in gauges:
+            values = [(metric['stage'],metric[field]) for metric in metrics if metric.get(field) is not None]
+            if not values:
+                continue
+            lines += [f"# HELP {PROMETHEUS_PREFIX}_{name} {description}", f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge"]
+            lines += [f'{PROMETHEUS_PREFIX}_{name}{{stage="{stage}"}} {value}' for stage,value in values]
+
+        # Numeric performance data, the items of nested dicts (one level) are told apart by a second label
+        values = []
+        for key,value in self.data.items():
+            items = value.items() if isinstance(value,dict) else [(None,value)]
+            for name,item in items:
+                if isinstance(item,(int,float)) and not isinstance(item,bool):
+                    labels = f'key="{key}"' if name is None else f'key="{key}",name="{name}"'
+                    values.append((labels,item))
+        if values:
+            lines += [f"# HELP {PROMETHEUS_PREFIX}_performance Performance data of the run", f"# TYPE {PROMETHEUS_PREFIX}_performance gauge"]
+            lines += [f'{PROMETHEUS_PREFIX}_performance{{{labels}}} {value}' for labels,value in values]
+        return "\n".join(lines) + "\n"
+
+    def saveProfile(self,key,profiler):
+        self.profileDirectory.mkdir(parents=True,exist_ok=True)
+        profiler.dump_stats(self.profileDirectory / f"{key}.prof")
+        with open(self.profileDirectory / f"{key}.txt","w") as fil:
+            pstats.Stats(profiler,stream=fil).sort_stats("cumulative").print_stats(PROFILE_LINES)
+
+    def close(self):
+        """
+        Ends every open stage (marked as FORCED) and flushes the results. Also called at exit
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for key,stage in list(self.times.items()):
+                if key != 'all' and not stage['end']:
+                    self.end(key,forced=True)
+            self.end('all')
+
     def execute(self,func,args,title="function"):
         res = title + "\n"
         for key,_ in self.times.items():
@@ -40,13 +270,11 @@ class Measure:
 
     def __str__(self):
         res = "Time results:\n"
-        for key,_ in self.times.items():
-            res += f"\t{key}: {self.measure(key)}" + (" FORCED" if self.times[key]['forced'] else "") + "\n"
+        for key,stage in self.times.items():
+            end = stage['end'] or time.time()
+            res += f"\t{key}: {end - stage['start']}" + (" FORCED" if stage['forced'] else "") + ("" if stage['end'] else " RUNNING") + "\n"
+        if self.data:
+            res += "Performance data:\n"
+            for key,value in self.data.items():
+                res += f"\t{key}: {value}\n"
         return res
-
-    def __del__(self):
-        for item in  self.times.keys():
-            if not "end" in self.times[item]:
-                self.end(item)
-        with open(self.filename,"w") as fil:
-            fil.write(f"{self}")
@@ -0,0 +1,274 @@
+#
+# benchmark.py
+# Description:
+#	Benchmark of the correction pipeline over synthetic cities (synthetic_city.py) of several sizes.
+#	Each scale runs in its own process, through the same stages as ProcessData:
+#		ingestion - StreamBusData over the generated bus_data rows
+#		line-detection - FilterData
+#		line-correction - CorrectData
+#		write-back - WriteLineDetected of the corrected lines
+#	Ingestion and write-back use ReplayDatabase, an in-memory connection, so they measure the client side
+#	cost (row decoding, CSV building) and not the database server.
+#
+#	Results are saved as JSON (commit, machine, configuration and, for every scale, wall and CPU time,
+#	peak RSS and throughput of each stage, plus the accuracy against the generated lines), and can be
+#	compared with the results of another commit with --compare.
+#
+# Usage:
+#	python3 benchmark.py --scales 100,1000,5000 --output results.json
+#	python3 benchmark.py --scales 100,1000 --compare baseline.json
+#
+
+import sys
+import json
+import time
+import pathlib
+import argparse
+import platform
+import datetime
+import subprocess
+from configparser import ConfigParser
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import numpy as np
+
+# Works from the repository (tests/ next to app/) and from the test container (/tests next to /app)
+for appPath in (pathlib.Path(__file__).resolve().parent.parent / "app", pathlib.Path("/app")):
+	if appPath.is_dir():
+		sys.path.insert(0, str(appPath))
+		break
+
+from data_access import BusData
+from data_processing import LineCorrection, LineDetection
+from utils.TimeMeasure import PeakRss
+from synthetic_city import City
+
+DEFAULT_SCALES = "100,1000,5000"
+
+# Used when no configuration file is given
+DEFAULT_CORRECTION_METHOD = {
+	'distanceTolerance': '300',
+	'detectionPercentage': '0.9',
+	'busStepSize': '100',
+	'lineStepSize': '50',
+	'limit': '3',
+}
+
+STAGES = ("ingestion", "line-detection", "line-correction", "write-back")
+
+
+class ReplayDatabase:
+	"""
+	In-memory connection serving the rows of a City to BUS_DATA_QUERY and absorbing the write-back
+	"""
+	def __init__(self, city):
+		self.columns = city.rows()
+		self.copiedBytes = 0
+
+	def cursor(self, name=None):
+		return ReplayCursor(self)
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		pass
+
+
+class ReplayCursor:
+	def __init__(self, database):
+		self.database = database
+		self.position = 0
+		self.itersize = None
+		self.rowcount = -1
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+	def execute(self, query, params=None):
+		self.position = 0
+
+	def fetchmany(self, size):
+		# Rows are built as psycopg2 returns them (datetime, float and str objects)
+		busIds, times, lat, lon, reported = self.database.columns
+		start, end = self.position, min(self.position + size, len(busIds))
+		self.position = end
+		return list(zip(busIds[start:end], times[start:end].astype(object), lat[start:end].tolist(), lon[start:end].tolist(), reported[start:end].tolist()))
+
+	def copy_expert(self, sql, buff):
+		self.database.copiedBytes += len(buff.read())
+		self.rowcount = len(self.database.columns[0])
+
+
+def Stage(results, name, points, function, *args):
+	"""
+	Runs function(*args), storing its wall time, CPU time, peak RSS (MB) and throughput (bus points per second)
+	"""
+	wallStart, cpuStart = time.perf_counter(), time.process_time()
+	value = function(*args)
+	wall, cpu = time.perf_counter() - wallStart, time.process_time() - cpuStart
+	results[name] = {
+		'wall': wall,
+		'cpu': cpu,
+		'peakRssMBytes': PeakRss(),
+		'pointsPerSecond': points / wall if wall > 0 else None,
+	}
+	return value
+
+
+def RunScale(buses, cityArguments, configuration, chunkSize):
+	"""
+	Benchmarks every stage over a city of <buses> buses. Runs in a fresh process, so the peak RSS is its own
+	"""
+	CONFIGS = ConfigParser()
+	CONFIGS.read_dict(configuration)
+	city = City(buses, **cityArguments)
+	busTrajectories = city.busTrajectories
+	points = len(busTrajectories.coordinates)
+	database = ReplayDatabase(city)
+	stages = dict()
+	detectionStats = dict()
+	generationRss = PeakRss()
+
+	nextDate = city.date + datetime.timedelta(days=1)
+	busTrajectories, busTimestamps, _ = Stage(stages, "ingestion", points, BusData.StreamBusData,
+		database, city.busSizeList(), city.date, nextDate, chunkSize)
+	pointDistances = dict() if CONFIGS.getboolean('default_correction_method', 'emitPointDistances', fallback=False) else None
+	detectionMatrix = Stage(stages, "line-detection", points, LineDetection.FilterData,
+		busTrajectories, city.lineShapes, CONFIGS, None, detectionStats, pointDistances)
+	detectionPercentage = float(CONFIGS['default_correction_method']['detectionPercentage'])
+	busResultTable = Stage(stages, "line-correction", points, LineCorrection.CorrectData,
+		detectionMatrix > detectionPercentage, busTrajectories, city.lineShapes, CONFIGS, pointDistances)
+	lineDetected = BusData.LineDetected(busTrajectories, busResultTable)
+	Stage(stages, "write-back", points, BusData.WriteLineDetected,
+		database, busTrajectories, busTimestamps, lineDetected, city.date, nextDate)
+
+	# Ingestion orders the buses by size, the generated lines follow the city order
+	cityTrajectories = city.busTrajectories
+	truth = np.where(city.truth == None, "No_line", city.truth)
+	truth = np.concatenate([truth[cityTrajectories.offsets[position]:cityTrajectories.offsets[position+1]]
+		for position in map(cityTrajectories.index().get, busTrajectories.ids)]) if points else truth
+	return {
+		'buses': buses,
+		'lines': len(city.lineIds),
+		'busPoints': points,
+		'linePoints': len(city.lineShapes.coordinates),
+		'generationPeakRssMBytes': generationRss,
+		'copiedBytes': database.copiedBytes,
+		'accuracy': float(np.mean(lineDetected == truth)) if points else None,
+		'detectedPairs': int(np.sum(np.asarray(detectionMatrix) > detectionPercentage)),
+		'detectionStats': detectionStats,
+		'stages': stages,
+		'total': {
+			'wall': sum(stage['wall'] for stage in stages.values()),
+			'cpu': sum(stage['cpu'] for stage in stages.values()),
+			'peakRssMBytes': PeakRss(),
+		},
+	}
+
+
+def Commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=pathlib.Path(__file__).resolve().parent,
+			capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def Compare(results, baseline, threshold):
+	"""
+	Prints the wall time ratio of every stage against <baseline>. Returns the list of stages slower than 1+threshold
+	"""
+	regressions = []
+	baseScales = {scale['buses']: scale for scale in baseline['results']}
+	print(f"Comparing with {baseline.get('commit')} ({baseline.get('created')})", file=sys.stderr)
+	for scale in results['results']:
+		base = baseScales.get(scale['buses'])
+		if base is None:
+			continue
+		for stage in STAGES + ("total",):
+			current = scale['total'] if stage == "total" else scale['stages'].get(stage)
+			previous = base['total'] if stage == "total" else base['stages'].get(stage)
+			if not current or not previous or previous['wall'] <= 0:
+				continue
+			ratio = current['wall'] / previous['wall']
+			flag = " REGRESSION" if ratio > 1 + threshold else ""
+			print(f"\t{scale['buses']} buses {stage}: {previous['wall']:.3f}s -> {current['wall']:.3f}s ({ratio:.2f}x){flag}", file=sys.stderr)
+			if flag:
+				regressions.append((scale['buses'], stage))
+	return regressions
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark of the correction pipeline over synthetic cities.")
+	parser.add_argument("--scales", default=DEFAULT_SCALES,
+		help=f"Comma separated amounts of buses. Defaults to {DEFAULT_SCALES}")
+	parser.add_argument("--lines", type=int, default=None,
+		help="Amount of lines of every city. Defaults to one line per 8 buses")
+	parser.add_argument("--points", type=int, default=400,
+		help="Average amount of GPS points per bus")
+	parser.add_argument("--seed", type=int, default=0,
+		help="Random seed of the cities")
+	parser.add_argument("-c", "--config", type=pathlib.Path, default=None,
+		help="Configuration file, as the one of ProcessData. Defaults to DEFAULT_CORRECTION_METHOD")
+	parser.add_argument("-o", "--output", type=pathlib.Path, default=None,
+		help="JSON file to save the results. Printed when not given")
+	parser.add_argument("--compare", type=pathlib.Path, default=None,
+		help="Results of a previous run. Exits with error when a stage got slower than --threshold")
+	parser.add_argument("--threshold", type=float, default=0.1,
+		help="Tolerated slowdown of --compare, defaults to 0.1 (10%%)")
+	return parser.parse_args()
+
+
+def main():
+	args = parse_args()
+
+	CONFIGS = ConfigParser()
+	CONFIGS.optionxform = str
+	CONFIGS['default_correction_method'] = DEFAULT_CORRECTION_METHOD
+	if args.config:
+		CONFIGS.read(args.config)
+	configuration = {section: dict(CONFIGS[section]) for section in CONFIGS.sections()}
+	chunkSize = CONFIGS.getint('data_acquisition', 'chunkSize', fallback=BusData.DEFAULT_CHUNK_SIZE)
+	cityArguments = {'lines': args.lines, 'pointsPerBus': args.points, 'seed': args.seed}
+
+	results = {
+		'commit': Commit(),
+		'created': datetime.datetime.now().isoformat(),
+		'machine': {
+			'platform': platform.platform(),
+			'processor': platform.processor(),
+			'cpus': multiprocessing.cpu_count(),
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+		},
+		'city': cityArguments,
+		'configuration': configuration,
+		'results': [],
+	}
+	for buses in [int(scale) for scale in args.scales.split(",")]:
+		with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+			scale = executor.submit(RunScale, buses, cityArguments, configuration, chunkSize).result()
+		results['results'].append(scale)
+		print(f"{buses} buses ({scale['busPoints']} points): " + ", ".join(f"{name} {stage['wall']:.3f}s" for name, stage in scale['stages'].items())
+			+ f", peak RSS {scale['total']['peakRssMBytes']:.0f}MB, accuracy {scale['accuracy']:.3f}", file=sys.stderr)
+
+	if args.output:
+		with open(args.output, "w") as fil:
+			json.dump(results, fil, indent=1)
+	else:
+		print(json.dumps(results, indent=1))
+
+	if args.compare:
+		with open(args.compare, "r") as fil:
+			baseline = json.load(fil)
+		if Compare(results, baseline, args.threshold):
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,7 +1,991 @@
 #
 # Main test unit for correction module
-# TODO
+# Description:
+#	Checks, mostly over a synthetic city (synthetic_city.py):
+#		the array backend selection and transfers
+#		the parallel detection and the grid, multires, early exit, fused (with numba) and gemm engines against the
+#		exhaustive dense run
+#		the distance mode validation
+#		the parameter sweep against separate detections
+#		that the bounding box prefilter never prunes a detection
+#		the tile planning of the dense engine
+#		the simplification label expansion
+#		the per point distances reused by the correction
+#		the run-length correction
+#		the stage checkpoints
+#		the streaming acquisition of the bus rows
+#		the bus cache round trip and eviction
+#		the line shape cache
+#		that the write-back never rewrites the bus_data coordinates
+#		the bus windows and queries of the incremental mode
+#		the date range and the pipelined acquisition, correction and write-back of the days
+#		the per thread profiling and the prometheus output of the stage measures
 #
+# Usage:
+#	python3 main_test.py
+#
+
+import os
+import sys
+import json
+import argparse
+import time
+import pathlib
+import datetime
+import tempfile
+import logging
+import threading
+import unittest
+import unittest.mock
+from configparser import ConfigParser
+
+import numpy as np
+import pandas as pd
+
+# Works from the repository (tests/ next to app/) and from the test container (/tests next to /app)
+for appPath in (pathlib.Path(__file__).resolve().parent.parent / "app", pathlib.Path("/app")):
+	if appPath.is_dir():
+		sys.path.insert(0, str(appPath))
+		break
+
+import ProcessData
+from data_access import BusCache, BusData, LineData
+from data_processing import Backend, Distance, EarlyExit, Envelope, Fused, LineCorrection, LineDetection, RunLength, Simplification, TilePlanner
+from data_processing.Trajectories import LineShapes, Trajectories
+from utils.Checkpoint import Checkpoint, Fingerprint
+from utils.TimeMeasure import Measure
+from synthetic_city import City
+
+
+def Configuration(**options):
+	CONFIGS = ConfigParser()
+	CONFIGS.optionxform = str
+	CONFIGS['default_correction_method'] = {
+		'distanceTolerance': '300',
+		'detectionPercentage': '0.9',
+		'busStepSize': '16',
+		'lineStepSize': '16',
+		'limit': '3',
+	}
+	for key, value in options.items():
+		CONFIGS['default_correction_method'][key] = str(value)
+	return CONFIGS
+
+
+class BackendTest(unittest.TestCase):
+	def test_configured_backend(self):
+		self.assertIs(Backend.GetConfiguredBackend(Configuration(backend="numpy")), np)
+		self.assertIs(Backend.GetConfiguredBackend(Configuration(backend=" NumPy ")), np)
+		with self.assertRaises(ValueError):
+			Backend.GetConfiguredBackend(Configuration(backend="torch"))
+
+		# The command line overrides the configuration file
+		configuration = Configuration(backend="cupy")
+		ProcessData.OverrideConfigs(configuration, argparse.Namespace(backend="numpy", max_memory=None, overlap=None))
+		self.assertIs(Backend.GetConfiguredBackend(configuration), np)
+
+	def test_without_cupy(self):
+		with unittest.mock.patch.object(Backend, "cp", None):
+			self.assertFalse(Backend.CupyAvailable())
+			# auto (also the default) falls back to numpy, an explicit cupy request fails
+			self.assertIs(Backend.GetConfiguredBackend(Configuration()), np)
+			self.assertIs(Backend.GetConfiguredBackend(Configuration(backend="auto")), np)
+			with self.assertRaises(ImportError):
+				Backend.GetConfiguredBackend(Configuration(backend="cupy"))
+			self.assertIs(Backend.GetArrayModule(np.zeros(2)), np)
+
+	def test_numpy_transfers(self):
+		array = np.arange(6, dtype=np.float32).reshape(2, 3)
+		self.assertFalse(Backend.IsGPU(np))
+		onDevice = Backend.ToDevice(array, np)
+		self.assertIsInstance(onDevice, np.ndarray)
+		np.testing.assert_array_equal(onDevice, array)
+		self.assertIsInstance(Backend.ToHost([1, 2]), np.ndarray)
+		np.testing.assert_array_equal(Backend.ToHost(onDevice), array)
+
+	def test_tile_bytes(self):
+		self.assertEqual(Backend.GetTileBytes(Configuration()), Backend.DEFAULT_CPU_TILE_MBYTES * 2**20)
+		self.assertEqual(Backend.GetTileBytes(Configuration(cpuTileMBytes=0.5)), 2**19)
+
+
+class MultiresolutionTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.city = City(24, lines=6, pointsPerBus=120, seed=1)
+
+	def assertSameDetections(self, lineShapes=None, **options):
+		lineShapes = self.city.lineShapes if lineShapes is None else lineShapes
+		exhaustive = LineDetection.FilterData(self.city.busTrajectories, lineShapes, Configuration(**options), None)
+		stats = dict()
+		multiresolution = LineDetection.FilterData(self.city.busTrajectories, lineShapes, Configuration(detectionEngine="multires", **options), None, stats)
+		np.testing.assert_array_equal(multiresolution.values, exhaustive.values)
+		self.assertLessEqual(stats['multires-refined-pairs'], stats['multires-pairs'])
+		return exhaustive
+
+	def test_haversine(self):
+		for percentage in (0.1, 0.5, 0.9):
+			exhaustive = self.assertSameDetections(detectionPercentage=percentage)
+			self.assertGreater(np.count_nonzero(exhaustive.values), 0)
+
+	def test_projected(self):
+		self.assertSameDetections(distanceMode="projected")
+
+	def test_projected_asymmetric_lines(self):
+		# A far away line moves the projection origin of the full line set away from the one of the refined
+		# lines. Tolerances are taken from real bus/line point distances, so some points sit on the threshold
+		lineShapes = self.city.lineShapes
+		farLine = np.asarray(lineShapes[0], dtype=float) + (0.8, 0.8)
+		lineShapes = LineShapes.fromTrajectories(Trajectories.fromArrays([lineShapes[i] for i in range(len(lineShapes))] + [farLine], lineShapes.ids + [("far", "0")]))
+
+		origin = Distance.ProjectionOrigin(lineShapes.coordinates)
+		busPoints = self.city.busTrajectories.projected(origin).coordinates
+		linePoints = lineShapes.projected(origin).coordinates
+		generator = np.random.default_rng(0)
+		pairs = generator.integers(0, len(linePoints), 40), generator.integers(0, len(busPoints), 40)
+		distances = np.sqrt(np.sum((linePoints[pairs[0]] - busPoints[pairs[1]])**2, axis=1))
+		for tolerance in distances[distances < 2000][:15]:
+			for percentage in (0.1, 0.3, 0.5):
+				self.assertSameDetections(lineShapes, distanceMode="projected", distanceTolerance=float(tolerance), detectionPercentage=percentage)
+
+	def test_tolerances_and_blocks(self):
+		for tolerance in (50, 1000):
+			for blockPoints in (1, 64):
+				self.assertSameDetections(distanceTolerance=tolerance, multiresLineBlockPoints=blockPoints, multiresBusBlockPoints=blockPoints, prefilter=False)
+
+
+class ParallelTest(unittest.TestCase):
+	def test_same_as_serial(self):
+		city = City(40, lines=6, pointsPerBus=80, seed=4)
+		for options in ({}, {'maxMemoryMBytes': 1}, {'distanceMode': "projected"}, {'prefilter': False}):
+			serial = LineDetection.FilterData(city.busTrajectories, city.lineShapes, Configuration(**options), None)
+			parallel = LineDetection.FilterData(city.busTrajectories, city.lineShapes, Configuration(workers=3, **options), None)
+			pd.testing.assert_frame_equal(parallel, serial)
+
+
+class GridTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.city = City(24, lines=6, pointsPerBus=120, seed=1)
+
+	def test_same_detections(self):
+		for tolerance in (50, 300, 1000):
+			for percentage in (0.1, 0.5, 0.9):
+				exhaustive = LineDetection.FilterData(self.city.busTrajectories, self.city.lineShapes, Configuration(distanceTolerance=tolerance, detectionPercentage=percentage), None)
+				grid = LineDetection.FilterData(self.city.busTrajectories, self.city.lineShapes, Configuration(distanceTolerance=tolerance, detectionPercentage=percentage, detectionEngine="grid"), None)
+				pd.testing.assert_frame_equal(grid, exhaustive)
+
+	def test_projected_refused(self):
+		with self.assertRaises(ValueError):
+			LineDetection.RunEngine(self.city.busTrajectories, self.city.lineShapes, Configuration(detectionEngine="grid", distanceMode="projected"))
+
+
+@unittest.skipUnless(Fused.NumbaAvailable(), "numba is not installed")
+class FusedTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.city = City(24, lines=6, pointsPerBus=120, seed=1)
+
+	def test_same_detections(self):
+		busTrajectories, lineShapes = self.city.busTrajectories, self.city.lineShapes
+		candidates = np.random.default_rng(0).random((len(busTrajectories), len(lineShapes))) < 0.5
+		for mode in Distance.DISTANCE_MODES:
+			for tolerance in (50, 300, 1000):
+				for percentage in (0.1, 0.5, 0.9):
+					exhaustive = LineDetection.RunEngine(busTrajectories, lineShapes, Configuration(distanceMode=mode, distanceTolerance=tolerance, detectionPercentage=percentage))
+					configuration = Configuration(distanceMode=mode, distanceTolerance=tolerance, detectionPercentage=percentage, detectionEngine="fused")
+					np.testing.assert_array_equal(LineDetection.RunEngine(busTrajectories, lineShapes, configuration), exhaustive)
+					np.testing.assert_array_equal(LineDetection.RunEngine(busTrajectories, lineShapes, configuration, candidates=candidates), exhaustive & candidates)
+
+	def test_same_fractions(self):
+		# Without the early stop the counts are exact, the same fractions as the dense sweep
+		busTrajectories, lineShapes = self.city.busTrajectories, self.city.lineShapes
+		pairBus, pairLine = np.nonzero(np.ones((len(busTrajectories), len(lineShapes)), dtype=bool))
+		for mode in Distance.DISTANCE_MODES:
+			tolerances, _, fractions, _ = LineDetection.SweepDetection(busTrajectories, lineShapes, (50, 300, 1000), (0.5,), Configuration(distanceMode=mode, prefilter=False))
+			for tolerance, expected in zip(tolerances, fractions):
+				np.testing.assert_array_equal(Fused.PairFractions(busTrajectories, lineShapes, tolerance, pairBus, pairLine, mode == "projected"), expected[pairBus, pairLine])
+
+
+class EarlyExitTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.city = City(24, lines=6, pointsPerBus=120, seed=1)
+
+	def test_required_points(self):
+		lengths = np.arange(0, 60)
+		for percentage in (0, 0.1, 1 / 3, 0.5, 0.9, 0.99, 1):
+			required = EarlyExit.RequiredPoints(lengths, percentage)
+			for length, count in zip(lengths[1:], required[1:]):
+				# The smallest count with count/length > percentage, length+1 when there is none
+				self.assertEqual(count, next((c for c in range(length + 1) if c / length > percentage), length + 1))
+
+	def test_same_detections(self):
+		busTrajectories, lineShapes = self.city.busTrajectories, self.city.lineShapes
+		candidates = np.random.default_rng(0).random((len(busTrajectories), len(lineShapes))) < 0.5
+		for mode in Distance.DISTANCE_MODES:
+			for tolerance in (50, 300, 1000):
+				for percentage in (0, 0.5, 0.9, 1):
+					exhaustive = LineDetection.RunEngine(busTrajectories, lineShapes, Configuration(distanceMode=mode, distanceTolerance=tolerance, detectionPercentage=percentage))
+					for blockPoints in (1, 16, 1024):
+						configuration = Configuration(distanceMode=mode, distanceTolerance=tolerance, detectionPercentage=percentage, detectionEngine="early", earlyBlockPoints=blockPoints)
+						np.testing.assert_array_equal(LineDetection.RunEngine(busTrajectories, lineShapes, configuration), exhaustive)
+					np.testing.assert_array_equal(LineDetection.RunEngine(busTrajectories, lineShapes, configuration, candidates=candidates), exhaustive & candidates)
+
+
+class GemmTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.city = City(24, lines=6, pointsPerBus=120, seed=1)
+
+	def test_batches_and_candidates(self):
+		busTrajectories, lineShapes = self.city.busTrajectories, self.city.lineShapes
+		candidates = np.random.default_rng(0).random((len(busTrajectories), len(lineShapes))) < 0.5
+		for tolerance in (50, 300, 1000):
+			exhaustive = LineDetection.RunEngine(busTrajectories, lineShapes, Configuration(distanceTolerance=tolerance))
+			# Small budgets split the buses in several batches and the line points in several chunks
+			for tileMBytes in (0.01, 4):
+				configuration = Configuration(distanceTolerance=tolerance, detectionEngine="gemm", cpuTileMBytes=tileMBytes)
+				np.testing.assert_array_equal(LineDetection.RunEngine(busTrajectories, lineShapes, configuration), exhaustive)
+				np.testing.assert_array_equal(LineDetection.RunEngine(busTrajectories, lineShapes, configuration, candidates=candidates), exhaustive & candidates)
+
+	def test_projected_refused(self):
+		with self.assertRaises(ValueError):
+			LineDetection.RunEngine(self.city.busTrajectories, self.city.lineShapes, Configuration(detectionEngine="gemm", distanceMode="projected"))
+
+
+class DistanceModeTest(unittest.TestCase):
+	def test_validation_reuses_projected_results(self):
+		city = City(24, lines=6, pointsPerBus=120, seed=1)
+		configuration = Configuration(distanceMode="projected")
+		projected = LineDetection.FilterData(city.busTrajectories, city.lineShapes, configuration, None)
+		report = LineDetection.ValidateDistanceMode(city.busTrajectories, city.lineShapes, configuration, projectedResults=np.asarray(projected, dtype=bool).T)
+		self.assertEqual(report, LineDetection.ValidateDistanceMode(city.busTrajectories, city.lineShapes, configuration))
+		self.assertEqual(report['projected-detections'], int(np.count_nonzero(projected.values)))
+
+
+class SweepTest(unittest.TestCase):
+	def test_cells_match_filter_data(self):
+		city = City(24, lines=6, pointsPerBus=120, seed=1)
+		busTrajectories, lineShapes = city.busTrajectories, city.lineShapes
+		# Tolerances on real bus/line point distances put points exactly on the threshold
+		generator = np.random.default_rng(0)
+		busPoints, linePoints = busTrajectories.coordinates.astype(float), lineShapes.coordinates.astype(float)
+		pairs = generator.integers(0, len(busPoints), 20), generator.integers(0, len(linePoints), 20)
+		distances = Distance.PairDistance(*Distance.BusRadians(busPoints[pairs[0]]), *Distance.LineRadians(linePoints[pairs[1]]))
+		for mode in Distance.DISTANCE_MODES:
+			tolerances = np.concatenate(([50, 300, 1000], distances[distances < 2000][:3]))
+			percentages = (0.1, 0.5, 0.9)
+			tolerances, percentages, fractions, detections = LineDetection.SweepDetection(busTrajectories, lineShapes, tolerances, percentages, Configuration(distanceMode=mode))
+			for t, tolerance in enumerate(tolerances):
+				for p, percentage in enumerate(percentages):
+					results = LineDetection.FilterData(busTrajectories, lineShapes, Configuration(distanceMode=mode, distanceTolerance=repr(float(tolerance)), detectionPercentage=percentage), None)
+					np.testing.assert_array_equal(fractions[t] > percentage, results.values.T, f"{mode} tolerance {tolerance!r} percentage {percentage}")
+					self.assertEqual(detections[t, p], np.count_nonzero(results.values))
+
+
+class EnvelopeTest(unittest.TestCase):
+	def test_never_prunes_detections(self):
+		# One point lines, one far away to move the projection origin, and one point buses close to them along
+		# the axes, where the boxes are tight. Tolerances are taken from the distances the engines compute, so
+		# pairs sit exactly on the threshold
+		generator = np.random.default_rng(0)
+		linePoints = np.array([(-22.9, -43.3), (-22.95, -43.2), (-20.9, -41.3)]) + generator.normal(0, 0.01, (3, 2))
+		lineShapes = LineShapes.fromTrajectories(Trajectories.fromArrays([point[None] for point in linePoints], [(f"{line}", "0") for line in range(len(linePoints))]))
+		distance, bearing = generator.uniform(20, 100, 120), generator.integers(0, 4, 120) * np.pi / 2
+		busPoints = np.repeat(linePoints, 40, axis=0)
+		busPoints = busPoints + np.column_stack((distance * np.cos(bearing), distance * np.sin(bearing) / np.cos(np.radians(busPoints[:, 0])))) / 111320
+		busTrajectories = Trajectories.fromArrays([point[None] for point in busPoints], [f"B{bus}" for bus in range(len(busPoints))])
+
+		for mode in Distance.DISTANCE_MODES:
+			if mode == "projected":
+				origin = Distance.ProjectionOrigin(lineShapes.coordinates)
+				busProjected, lineProjected = busTrajectories.projected(origin).coordinates, lineShapes.projected(origin).coordinates
+				distances = np.sqrt(np.sum((busProjected[:, None] - lineProjected[None])**2, axis=2, dtype=np.float32))
+			else:
+				distances = Distance.PairDistance(*Distance.BroadcastRadians(busTrajectories.coordinates.astype(float)[:, None], lineShapes.coordinates.astype(float)[:, None])).reshape(len(busPoints), len(linePoints))
+			detected = 0
+			for tolerance in np.concatenate([distances[line * 40:(line + 1) * 40:4, line] for line in range(len(linePoints))]):
+				for tolerance in (tolerance, np.nextafter(tolerance, np.inf), np.nextafter(np.float32(tolerance), np.float32(np.inf))):
+					configuration = Configuration(distanceMode=mode, distanceTolerance=repr(float(tolerance)), detectionPercentage=0.5, prefilter=False)
+					detections = LineDetection.RunEngine(busTrajectories, lineShapes, configuration)
+					candidates = Envelope.CandidatePairs(busTrajectories, lineShapes, float(tolerance), LineDetection.PrefilterOrigin(busTrajectories, lineShapes, configuration))
+					self.assertFalse(np.any(detections & ~candidates), f"{mode} pruned a detected pair at tolerance {tolerance!r}")
+					detected += np.count_nonzero(detections)
+			self.assertGreater(detected, 0)
+
+	def test_prefilter_keeps_detections(self):
+		city = City(24, lines=6, pointsPerBus=120, seed=1)
+		for mode in Distance.DISTANCE_MODES:
+			for tolerance in (50, 300, 1000):
+				stats = dict()
+				exhaustive = LineDetection.FilterData(city.busTrajectories, city.lineShapes, Configuration(distanceMode=mode, distanceTolerance=tolerance, prefilter=False), None)
+				prefiltered = LineDetection.FilterData(city.busTrajectories, city.lineShapes, Configuration(distanceMode=mode, distanceTolerance=tolerance), None, stats)
+				pd.testing.assert_frame_equal(prefiltered, exhaustive)
+				self.assertGreater(stats['prefilter-pruned-ratio'], 0)
+				# Bus tiles are grouped by candidate lines, only the candidate pairs are evaluated
+				self.assertEqual(stats['detection-evaluated-pairs'], stats['prefilter-candidate-pairs'])
+
+
+class TilePlannerTest(unittest.TestCase):
+	def assertCoveredOnce(self, groups, indices):
+		np.testing.assert_array_equal(np.sort(np.concatenate(groups)), np.sort(indices))
+
+	def test_buckets(self):
+		generator = np.random.default_rng(0)
+		lengths = generator.integers(1, 500, 200)
+		indices = generator.permutation(200)[:150]
+		np.testing.assert_array_equal(TilePlanner.Buckets(indices, lengths, "none")[0], indices)
+		for mode in ("pow2", "quantile"):
+			buckets = TilePlanner.Buckets(indices, lengths, mode, amount=4)
+			self.assertCoveredOnce(buckets, indices)
+			for bucket in buckets:
+				self.assertTrue(np.all(np.diff(lengths[bucket]) <= 0))
+			# Buckets hold disjoint length ranges, longest first
+			for longer, shorter in zip(buckets[:-1], buckets[1:]):
+				self.assertGreater(lengths[longer].min(), lengths[shorter].max())
+			if mode == "pow2":
+				for bucket in buckets:
+					self.assertEqual(len(np.unique(np.ceil(np.log2(lengths[bucket])))), 1)
+			else:
+				self.assertLessEqual(len(buckets), 4)
+
+	def test_split_tiles(self):
+		lengths = np.random.default_rng(1).integers(1, 300, 100)
+		indices = TilePlanner.ByLength(np.arange(100), lengths)
+		for budget in (1, 500, 5000, 10**6):
+			fits = lambda count, maxLength: count * maxLength <= budget
+			tiles = TilePlanner.SplitTiles(indices, lengths[indices], fits)
+			np.testing.assert_array_equal(np.concatenate(tiles), indices)
+			for tile in tiles:
+				self.assertTrue(len(tile) == 1 or fits(len(tile), lengths[tile].max()))
+
+	def test_tile_plan(self):
+		generator = np.random.default_rng(2)
+		busLengths, lineLengths = generator.integers(1, 400, 120), generator.integers(2, 300, 30)
+		for gpu in (False, True):
+			for maxMemory in (2**16, 2**20, 2**26):
+				plan = TilePlanner.TilePlan(busLengths, lineLengths, 8, maxMemory, gpu)
+				lineTiles = plan.lineTiles(np.arange(len(lineLengths)))
+				self.assertCoveredOnce(lineTiles, np.arange(len(lineLengths)))
+				for tile in lineTiles:
+					self.assertLessEqual(len(tile), 8)
+					self.assertTrue(len(tile) == 1 or len(tile) * lineLengths[tile].max() <= plan.lineElements)
+				for busIndices in (None, generator.permutation(len(busLengths))[:50]):
+					busTiles = plan.busTiles(busIndices)
+					self.assertCoveredOnce(busTiles, np.arange(len(busLengths)) if busIndices is None else busIndices)
+					for tile in busTiles:
+						self.assertTrue(len(tile) == 1 or TilePlanner.TileBytes(len(tile), busLengths[tile].max(), plan.lineElements, gpu) <= maxMemory)
+
+	def test_max_memory(self):
+		self.assertEqual(TilePlanner.GetMaxMemory(Configuration(maxMemoryMBytes=3)), 3 * 2**20)
+		self.assertIsNone(TilePlanner.GetMaxMemory(Configuration()))
+
+
+class SimplificationTest(unittest.TestCase):
+	def test_expand_labels(self):
+		city = City(12, lines=4, pointsPerBus=200, seed=3)
+		busTrajectories, tolerance = city.busTrajectories, 150
+		simplified, owner = Simplification.Simplify(busTrajectories, tolerance)
+		self.assertLess(len(simplified.coordinates), len(busTrajectories.coordinates))
+
+		# Every original point is represented by a kept point of the same bus within tolerance
+		original, kept = busTrajectories.coordinates.astype(float), simplified.coordinates.astype(float)
+		busOf = np.repeat(np.arange(len(busTrajectories)), busTrajectories.lengths)
+		self.assertTrue(np.all((simplified.offsets[busOf] <= owner) & (owner < simplified.offsets[busOf + 1])))
+		distances = Distance.PairDistance(*Distance.BusRadians(original), *Distance.BusRadians(kept[owner]))
+		self.assertTrue(np.all(distances <= tolerance))
+
+		# Unique labels on the kept points show where every original label comes from
+		labels = pd.DataFrame.from_dict({bus: [f"{bus}/{point}" for point in range(length)] for bus, length in zip(simplified.ids, simplified.lengths)}, orient="index").T
+		expanded = Simplification.ExpandLabels(labels, busTrajectories, simplified, owner)
+		self.assertEqual(list(expanded.columns), list(busTrajectories.ids))
+		for position, (bus, length) in enumerate(zip(busTrajectories.ids, busTrajectories.lengths)):
+			localOwner = owner[busTrajectories.offsets[position]:busTrajectories.offsets[position + 1]] - simplified.offsets[position]
+			self.assertEqual(list(expanded[bus][:length]), [f"{bus}/{point}" for point in localOwner])
+			self.assertTrue(expanded[bus][length:].isna().all())
+
+		# Corrected over the thinned buses, every original point of a corrected bus gets the line of its representative
+		configuration = Configuration()
+		detectionMatrix = LineDetection.FilterData(simplified, city.lineShapes, configuration, None)
+		resultTable = LineCorrection.CorrectData(detectionMatrix > 0.9, simplified, city.lineShapes, configuration)
+		expanded = Simplification.ExpandLabels(resultTable, busTrajectories, simplified, owner)
+		busIndex = busTrajectories.index()
+		self.assertGreater(len(resultTable.columns), 0)
+		for bus in resultTable.columns:
+			position = busIndex[bus]
+			localOwner = owner[busTrajectories.offsets[position]:busTrajectories.offsets[position + 1]] - simplified.offsets[position]
+			np.testing.assert_array_equal(expanded[bus][:len(localOwner)].to_numpy(), resultTable[bus].to_numpy()[localOwner])
+
+
+class PointDistanceTest(unittest.TestCase):
+	def test_encode_keeps_side_of_tolerance(self):
+		# 777.7 is not representable in float16, values around it must stay on the side the detection saw
+		for tolerance in (300, 777.7):
+			distances = np.array([np.nextafter(tolerance, -np.inf), tolerance, np.nextafter(tolerance, np.inf), tolerance - 0.2, tolerance + 0.2, 0, 5000])
+			for dtype in LineDetection.POINT_DISTANCE_TYPES:
+				encoded = LineDetection.EncodePointDistances(distances, tolerance, np.dtype(dtype))
+				self.assertEqual(encoded.dtype, np.dtype(dtype))
+				np.testing.assert_array_equal(encoded.astype(float) < tolerance, distances < tolerance, f"{dtype} tolerance {tolerance}")
+			# Projected distances are squared float32 meters, compared with the squared float32 tolerance
+			squared = np.array([np.nextafter(np.float32(tolerance)**2, np.float32(0)), np.float32(tolerance)**2, np.float32(1), np.float32(tolerance + 1)**2], dtype=np.float32)
+			for dtype in LineDetection.POINT_DISTANCE_TYPES:
+				encoded = LineDetection.EncodePointDistances(squared, tolerance, np.dtype(dtype), projected=True)
+				np.testing.assert_array_equal(encoded.astype(float) < tolerance, squared < np.float32(tolerance)**2)
+
+	def EdgeTolerances(self, busTrajectories, lineShapes, mode):
+		# Tolerances between emitted distances and their float16 rounding, which casting alone would put on the wrong side
+		pointDistances = dict()
+		LineDetection.FilterData(busTrajectories, lineShapes, Configuration(distanceMode=mode, distanceTolerance=777.7, detectionPercentage=0.5), None, pointDistances=pointDistances)
+		distances = np.unique(np.concatenate(list(pointDistances.values())).astype(float))
+		distances = distances[(distances > 300) & (distances < 777.7)]
+		rounded = distances.astype(np.float16).astype(float)
+		return list(((distances + rounded) / 2)[rounded > distances][::-1][:3])
+
+	def test_correction_reuses_distances(self):
+		# Noisy GPS spreads the bus points up to the tolerances
+		city = City(12, lines=4, pointsPerBus=120, seed=1, gpsNoise=200)
+		# Directions of a line overlap, so a single line keeps conflicts from hiding a point on the wrong side
+		singleLine = LineShapes.fromTrajectories(Trajectories.fromArrays([city.lineShapes[0]], city.lineShapes.ids[:1]))
+		for mode in Distance.DISTANCE_MODES:
+			edges = self.EdgeTolerances(city.busTrajectories, singleLine, mode)
+			self.assertTrue(edges)
+			for lineShapes, tolerances in ((city.lineShapes, (50, 300, 777.7)), (singleLine, [777.7] + edges)):
+				for engine in ("dense", "early"):
+					for dtype in LineDetection.POINT_DISTANCE_TYPES:
+						for tolerance in tolerances:
+							# limit 1 keeps every point, a single one on the wrong side changes the correction
+							configuration = Configuration(detectionEngine=engine, distanceMode=mode, pointDistanceType=dtype, distanceTolerance=repr(float(tolerance)), detectionPercentage=0.5, limit=1)
+							pointDistances = dict()
+							detectionMatrix = LineDetection.FilterData(city.busTrajectories, lineShapes, configuration, None, pointDistances=pointDistances)
+							self.assertEqual(len(pointDistances), np.count_nonzero(detectionMatrix.values))
+							self.assertTrue(all(distances.dtype == np.dtype(dtype) for distances in pointDistances.values()))
+							computed = LineCorrection.CorrectData(detectionMatrix, city.busTrajectories, lineShapes, configuration)
+							reused = LineCorrection.CorrectData(detectionMatrix, city.busTrajectories, lineShapes, configuration, pointDistances)
+							pd.testing.assert_frame_equal(reused, computed, obj=f"{engine} {mode} {dtype} tolerance {float(tolerance)!r}")
+
+
+class RunLengthTest(unittest.TestCase):
+	def test_encode_decode(self):
+		values, starts, lengths = RunLength.Encode(np.array([1, 1, 0, 0, 0, 1]))
+		np.testing.assert_array_equal(values, [1, 0, 1])
+		np.testing.assert_array_equal(starts, [0, 2, 5])
+		np.testing.assert_array_equal(lengths, [2, 3, 1])
+		array = np.random.default_rng(0).integers(0, 2, 200)
+		np.testing.assert_array_equal(RunLength.Decode(*RunLength.Encode(array)[::2]), array)
+
+	def test_run_lengths_per_row(self):
+		np.testing.assert_array_equal(RunLength.RunLengths(np.array([[1, 1, 0], [0, 1, 1]])), [[2, 2, 1], [1, 2, 2]])
+
+	def test_suppress_short_runs(self):
+		# A short first run is inverted at its own position
+		np.testing.assert_array_equal(RunLength.SuppressShortRuns(np.array([1, 1, 0, 0, 0, 1, 1, 1]), 3), [0, 0, 0, 0, 0, 1, 1, 1])
+		np.testing.assert_array_equal(RunLength.SuppressShortRuns(np.array([0, 0, 0, 1, 0, 0, 0]), 3), [0, 0, 0, 0, 0, 0, 0])
+
+		# Every point of a run shorter than the limit is inverted, the others are kept
+		matrix = np.random.default_rng(1).integers(0, 2, (20, 50))
+		for limit in (1, 2, 3, 5):
+			expected = matrix.copy()
+			for row in range(len(matrix)):
+				_, starts, lengths = RunLength.Encode(matrix[row])
+				for start, length in zip(starts, lengths):
+					if length < limit:
+						expected[row, start:start+length] = 1 - matrix[row, start:start+length]
+			np.testing.assert_array_equal(RunLength.SuppressShortRuns(matrix, limit), expected)
+			np.testing.assert_array_equal(LineCorrection.CorrectLine(matrix[0], limit), expected[0])
+
+	def test_resolve_conflicts(self):
+		# Points 3 and 4 are claimed by both lines, the second one holds them in its longest run
+		belonging = np.array([
+			[1, 1, 1, 1, 1, 0, 0, 0, 0, 0],
+			[0, 0, 0, 1, 1, 1, 1, 1, 1, 1],
+		])
+		np.testing.assert_array_equal(LineCorrection.ResolveConflicts(belonging, 3), [
+			[1, 1, 1, 0, 0, 0, 0, 0, 0, 0],
+			[0, 0, 0, 1, 1, 1, 1, 1, 1, 1],
+		])
+		# Losing the conflict leaves a run shorter than the limit, which is suppressed
+		belonging = np.array([
+			[0, 0, 0, 1, 1, 1, 1, 0, 0, 0],
+			[0, 0, 0, 0, 0, 1, 1, 1, 1, 1],
+		])
+		np.testing.assert_array_equal(LineCorrection.ResolveConflicts(belonging, 3), [
+			[0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+			[0, 0, 0, 0, 0, 1, 1, 1, 1, 1],
+		])
+		np.testing.assert_array_equal(LineCorrection.ResolveConflicts(belonging[:1], 3), belonging[:1])
+
+
+class CheckpointTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+		self.checkpoint = Checkpoint(self.directory.name, {'date': "2021-01-01"})
+
+	def test_round_trip(self):
+		city = City(3, lines=2, pointsPerBus=10, seed=5)
+		labels = pd.DataFrame([["A", None], [None, "B"]], index=[0, 1], columns=["b0", "b1"])
+		detections = pd.DataFrame([[True, False]], index=pd.MultiIndex.from_tuples([("L0", "0")]), columns=["b0", "b1"])
+		self.checkpoint.save("stage", "key", busTrajectories=city.busTrajectories, lineShapes=city.lineShapes, timestamps=city.busTimestamps,
+			busSizeList=[("b0", 3)], labels=labels, detections=detections)
+
+		self.assertTrue(self.checkpoint.valid("stage", "key"))
+		artifacts = self.checkpoint.load("stage")
+		np.testing.assert_array_equal(artifacts['busTrajectories'].coordinates, city.busTrajectories.coordinates)
+		np.testing.assert_array_equal(artifacts['busTrajectories'].offsets, city.busTrajectories.offsets)
+		self.assertEqual(list(artifacts['busTrajectories'].ids), list(city.busTrajectories.ids))
+		self.assertIsInstance(artifacts['lineShapes'], LineShapes)
+		np.testing.assert_array_equal(artifacts['lineShapes'].cosLat, city.lineShapes.cosLat)
+		np.testing.assert_array_equal(artifacts['timestamps'], city.busTimestamps)
+		self.assertEqual(artifacts['busSizeList'], [["b0", 3]])
+		pd.testing.assert_frame_equal(artifacts['labels'], labels)
+		pd.testing.assert_frame_equal(artifacts['detections'], detections)
+		self.assertEqual(self.checkpoint.stageManifest("stage")['date'], "2021-01-01")
+
+	def test_invalidation(self):
+		self.assertFalse(self.checkpoint.valid("stage", "key"))
+		self.checkpoint.save("stage", Fingerprint("stage", [("b0", 3)]), values=np.arange(3))
+		self.assertTrue(self.checkpoint.valid("stage", Fingerprint("stage", [("b0", 3)])))
+		# A late row changes the bus sizes and so the key
+		self.assertFalse(self.checkpoint.valid("stage", Fingerprint("stage", [("b0", 4)])))
+
+		self.checkpoint.save("stage", "other", values=np.arange(4))
+		self.assertFalse(self.checkpoint.valid("stage", Fingerprint("stage", [("b0", 3)])))
+		np.testing.assert_array_equal(self.checkpoint.load("stage")['values'], np.arange(4))
+
+	def test_failed_save_keeps_previous_stage(self):
+		self.checkpoint.save("stage", "key", values=np.arange(3))
+		class Unserializable:
+			def __str__(self):
+				raise ValueError("not serializable")
+
+		with self.assertRaises(ValueError):
+			self.checkpoint.save("stage", "new", values=np.arange(4), broken=Unserializable())
+		self.assertTrue(self.checkpoint.valid("stage", "key"))
+		np.testing.assert_array_equal(self.checkpoint.load("stage")['values'], np.arange(3))
+		self.assertEqual(sorted(path.name for path in pathlib.Path(self.directory.name).iterdir()), ["stage"])
+
+
+class BusCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+		self.city = City(6, lines=2, pointsPerBus=40, seed=5)
+		self.day = self.city.date
+
+	def Cache(self, maxAge=datetime.timedelta(days=30), maxBytes=2**30):
+		return BusCache.BusCache(self.directory.name, maxAge, maxBytes)
+
+	def Save(self, cache, key, lastUse=None):
+		cache.save(self.day, key, self.city.busTrajectories, self.city.busTimestamps, self.city.busReported)
+		if lastUse is not None:
+			os.utime(cache.path(self.day, key) / "manifest.json", (lastUse, lastUse))
+
+	def test_round_trip(self):
+		cache = self.Cache()
+		self.assertIsNone(cache.load(self.day, "sizes"))
+		self.Save(cache, "sizes")
+		busTrajectories, busTimestamps, busReported = cache.load(self.day, "sizes")
+		np.testing.assert_array_equal(busTrajectories.coordinates, self.city.busTrajectories.coordinates)
+		np.testing.assert_array_equal(busTrajectories.offsets, self.city.busTrajectories.offsets)
+		self.assertEqual(list(busTrajectories.ids), list(self.city.busTrajectories.ids))
+		np.testing.assert_array_equal(busTimestamps, self.city.busTimestamps)
+		np.testing.assert_array_equal(busReported, self.city.busReported)
+		self.assertIsNone(cache.load(self.day, "other sizes"))
+
+	def test_eviction_on_save(self):
+		cache = self.Cache()
+		now = time.time()
+		self.Save(cache, "old", now - 300)
+		self.Save(cache, "used", now - 200)
+		entrySize = cache.entries()[0][1]
+		# Loading marks the entry as used, the least recently used one goes first
+		cache.load(self.day, "old")
+		cache.maxBytes = 2 * entrySize
+		self.Save(cache, "new")
+		self.assertEqual(sorted(path.name for _, _, path in cache.entries()), [f"{self.day}-new", f"{self.day}-old"])
+
+		# The saved entry is kept even when alone above the limit
+		cache.maxBytes = 1
+		self.Save(cache, "newest")
+		self.assertEqual([path.name for _, _, path in cache.entries()], [f"{self.day}-newest"])
+
+	def test_eviction_on_open(self):
+		cache = self.Cache()
+		now = time.time()
+		self.Save(cache, "expired", now - 3 * 86400)
+		self.Save(cache, "recent", now - 100)
+		self.Save(cache, "latest", now)
+		self.assertEqual(len(cache.entries()), 3)
+
+		cache = self.Cache(maxAge=datetime.timedelta(days=1))
+		self.assertIsNone(cache.load(self.day, "expired"))
+		self.assertEqual(len(cache.entries()), 2)
+
+		cache = self.Cache(maxBytes=max(size for _, size, _ in cache.entries()))
+		self.assertIsNone(cache.load(self.day, "recent"))
+		self.assertIsNotNone(cache.load(self.day, "latest"))
+
+
+class RecordingDatabase:
+	"""
+	Connection recording the statements, their parameters and the COPY data sent. Each fetchall or fetchone
+	returns the next of <results>
+	"""
+	def __init__(self, results=()):
+		self.statements = []
+		self.params = []
+		self.copied = []
+		self.results = list(results)
+		self.rowcount = 0
+
+	def cursor(self, name=None):
+		return self
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+	def execute(self, query, params=None):
+		self.statements.append(query)
+		self.params.append(params)
+
+	def fetchall(self):
+		return self.results.pop(0)
+
+	def fetchone(self):
+		return self.results.pop(0)
+
+	def copy_expert(self, sql, buff):
+		self.statements.append(sql)
+		self.copied.append(buff.read())
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		pass
+
+
+class StreamingDatabase(RecordingDatabase):
+	"""
+	RecordingDatabase whose named cursors return <rows> through fetchmany
+	"""
+	def __init__(self, rows):
+		super().__init__()
+		self.rows = list(rows)
+		self.names = []
+		self.fetched = []
+
+	def cursor(self, name=None):
+		self.names.append(name)
+		return self
+
+	def fetchmany(self, size):
+		rows, self.rows = self.rows[:size], self.rows[size:]
+		self.fetched.append(len(rows))
+		return rows
+
+
+class StreamBusDataTest(unittest.TestCase):
+	def setUp(self):
+		self.city = City(5, lines=2, pointsPerBus=30, seed=6)
+		busIds, timestamps, lat, lon, reported = self.city.rows()
+		self.rows = list(zip(busIds, timestamps.astype(datetime.datetime), lat, lon, reported))
+
+	def Stream(self, rows, busSizeList, chunkSize=7):
+		database = StreamingDatabase(rows)
+		results = BusData.StreamBusData(database, busSizeList, self.city.date, self.city.date, chunkSize, logging.getLogger("stream"))
+		self.assertEqual(database.names, ["bus_data_stream"])
+		self.assertEqual(database.params, [(tuple(bus for bus, _ in busSizeList), self.city.date, self.city.date)])
+		self.assertTrue(all(fetched <= chunkSize for fetched in database.fetched))
+		return results
+
+	def assertGrouped(self, results, rows, busSizeList):
+		# Every bus gets its rows in order, at most the counted amount, in busSizeList order
+		busTrajectories, busTimestamps, busReported = results
+		expected = [[row for row in rows if row[0] == bus][:size] for bus, size in busSizeList]
+		self.assertEqual(list(busTrajectories.ids), [bus for bus, _ in busSizeList])
+		np.testing.assert_array_equal(busTrajectories.lengths, [len(busRows) for busRows in expected])
+		flat = [row for busRows in expected for row in busRows]
+		np.testing.assert_array_equal(busTrajectories.coordinates, np.array([row[2:4] for row in flat], dtype=busTrajectories.coordinates.dtype))
+		np.testing.assert_array_equal(busTimestamps, np.array([row[1] for row in flat], dtype="datetime64[us]"))
+		np.testing.assert_array_equal(busReported, np.array([row[4] for row in flat], dtype=str))
+
+	def test_runs_split_across_chunks(self):
+		busSizeList = self.city.busSizeList()
+		self.assertGreater(min(size for _, size in busSizeList), 7)
+		with self.assertNoLogs("stream", "WARNING"):
+			results = self.Stream(self.rows, busSizeList)
+		self.assertGrouped(results, self.rows, busSizeList)
+
+	def test_rows_after_count(self):
+		# Rows arriving after the bus sizes were counted are dropped
+		busSizeList = [(bus, size - 3 if position == 1 else size) for position, (bus, size) in enumerate(self.city.busSizeList())]
+		with self.assertLogs("stream", "WARNING") as logs:
+			results = self.Stream(self.rows, busSizeList)
+		self.assertGrouped(results, self.rows, busSizeList)
+		self.assertIn("3 bus rows arrived after", logs.output[0])
+
+	def test_rows_missing(self):
+		# Counted rows that never arrive leave the bus shorter, the trajectories are rebuilt without the gap
+		busSizeList = self.city.busSizeList()
+		missingBus = busSizeList[0][0]
+		missing = [index for index, row in enumerate(self.rows) if row[0] == missingBus][-4:]
+		rows = [row for index, row in enumerate(self.rows) if index not in missing]
+		with self.assertLogs("stream", "WARNING") as logs:
+			results = self.Stream(rows, busSizeList)
+		self.assertGrouped(results, rows, busSizeList)
+		self.assertEqual(results[0].lengths[0], busSizeList[0][1] - 4)
+		self.assertIn("4 bus rows counted were not received", logs.output[0])
+
+
+class LineCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+		self.configuration = ConfigParser()
+		self.configuration['data_acquisition'] = {'lineCachePath': self.directory.name}
+		# line_data rows of the synthetic city, ordered by line, direction and position
+		lineShapes = City(4, lines=3, pointsPerBus=10, seed=7).lineShapes
+		rows = []
+		for index, (lineId, direction) in enumerate(lineShapes.ids):
+			rows += [(lineId, direction, lat, lon) for lat, lon in np.asarray(lineShapes[index], dtype=float).tolist()]
+		self.rows = sorted(rows, key=lambda row: row[:2])
+
+	def Load(self, version, rows=None):
+		database = RecordingDatabase([version] + ([rows] if rows is not None else []))
+		return LineData.LoadLineShapes(database, self.configuration), database
+
+	def assertSameShapes(self, lineShapes, expected):
+		self.assertEqual(list(lineShapes.ids), list(expected.ids))
+		np.testing.assert_array_equal(lineShapes.offsets, expected.offsets)
+		np.testing.assert_array_equal(lineShapes.coordinates, expected.coordinates)
+		np.testing.assert_array_equal(lineShapes.cosLat, expected.cosLat)
+
+	def test_fill_reuse_and_rebuild(self):
+		expected = LineData.FetchLineShapes(RecordingDatabase([self.rows]))
+
+		# First run fetches line_data and fills the cache
+		lineShapes, database = self.Load((120, 39, 5, 7, 11), self.rows)
+		self.assertEqual(database.statements, [LineData.LINE_VERSION_QUERY, LineData.LINE_DATA_QUERY])
+		self.assertSameShapes(lineShapes, expected)
+		self.assertEqual([path.name for path in pathlib.Path(self.directory.name).iterdir()], ["120_39_5_7_11"])
+
+		# Same version, read from the cache without fetching line_data
+		lineShapes, database = self.Load((120, 39, 5, 7, 11))
+		self.assertEqual(database.statements, [LineData.LINE_VERSION_QUERY])
+		self.assertSameShapes(lineShapes, expected)
+
+		# A changed line_data rebuilds the cache and drops the old version
+		changed = self.rows[:-1]
+		lineShapes, database = self.Load((119, 39, 5, 7, 12), changed)
+		self.assertEqual(database.statements, [LineData.LINE_VERSION_QUERY, LineData.LINE_DATA_QUERY])
+		self.assertSameShapes(lineShapes, LineData.FetchLineShapes(RecordingDatabase([changed])))
+		self.assertEqual([path.name for path in pathlib.Path(self.directory.name).iterdir()], ["119_39_5_7_12"])
+
+	def test_disabled(self):
+		self.configuration['data_acquisition']['lineCachePath'] = ""
+		database = RecordingDatabase([self.rows])
+		LineData.LoadLineShapes(database, self.configuration)
+		self.assertEqual(database.statements, [LineData.LINE_DATA_QUERY])
+
+
+class WriteBackTest(unittest.TestCase):
+	def test_coordinates_untouched(self):
+		# Trajectories hold float32 coordinates, only the corrected line may be written back
+		city = City(4, lines=2, pointsPerBus=20, seed=2)
+		busTrajectories = city.busTrajectories
+		lineDetected = np.full(len(busTrajectories.coordinates), "No_line", dtype=object)
+		database = RecordingDatabase()
+		BusData.WriteLineDetected(database, busTrajectories, city.busTimestamps, lineDetected, city.date, city.date)
+
+		rows = [line.split(",") for line in "".join(database.copied).splitlines()]
+		self.assertEqual(len(rows), len(busTrajectories.coordinates))
+		self.assertTrue(all(len(row) == 3 for row in rows))
+		for statement in database.statements:
+			self.assertNotIn("latitude", statement)
+			self.assertNotIn("longitude", statement)
+
+
+	def test_line_detected(self):
+		busTrajectories = Trajectories.fromArrays([np.zeros((3, 2)), np.zeros((2, 2)), np.zeros((4, 2))], ["A", "B", "C"])
+		# Columns are padded to the longest corrected bus, missing lines are None, NaN or empty
+		busResultTable = pd.DataFrame({'C': ["101", None, "", np.nan], 'A': ["102", "102", np.nan, np.nan]})
+		np.testing.assert_array_equal(BusData.LineDetected(busTrajectories, busResultTable),
+			["102", "102", "No_line", "No_line", "No_line", "101", "No_line", "No_line", "No_line"])
+
+
+class TimeMeasureTest(unittest.TestCase):
+	def test_profile_per_thread(self):
+		with tempfile.TemporaryDirectory() as directory:
+			directory = pathlib.Path(directory)
+			mes = Measure(str(directory / "performance.jsonl"), "jsonl", directory / "profiles")
+			# Both stages are open at the same time, each in its own thread
+			barrier = threading.Barrier(2)
+			def Stage(key):
+				with mes.span(key, profile=True):
+					barrier.wait()
+					sum(range(1000))
+					barrier.wait()
+			threads = [threading.Thread(target=Stage, args=(key,)) for key in ("reader", "detection")]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			mes.close()
+
+			profiled = {path.stem for path in (directory / "profiles").glob("*.prof")}
+			# Python 3.12+ allows a single active profiler per process
+			self.assertEqual(len(profiled), 2 if sys.version_info < (3, 12) else 1)
+			self.assertLessEqual(profiled, {"reader", "detection"})
+			self.assertEqual(mes.profilers, dict())
+			stages = [json.loads(line) for line in (directory / "performance.jsonl").read_text().splitlines()]
+			self.assertTrue(all('processPeakRssMBytes' in stage for stage in stages if stage['type'] == 'stage'))
+
+
+	def test_prometheus_nested_data(self):
+		with tempfile.TemporaryDirectory() as directory:
+			mes = Measure(str(pathlib.Path(directory) / "performance.prom"), "prometheus")
+			mes.record("prefilter", {'pairs': 10, 'candidate-pairs': 4, 'label': "text"})
+			mes.record("prefilterpairs", 7)
+			mes.record("flag", True)
+			with mes.span("stage"):
+				pass
+			mes.close()
+
+			samples = dict()
+			for line in (pathlib.Path(directory) / "performance.prom").read_text().splitlines():
+				if line.startswith("fasbus_correction_performance{"):
+					series, value = line.rsplit(" ", 1)
+					samples[series] = float(value)
+			self.assertEqual(samples, {
+				'fasbus_correction_performance{key="prefilter",name="pairs"}': 10,
+				'fasbus_correction_performance{key="prefilter",name="candidate-pairs"}': 4,
+				'fasbus_correction_performance{key="prefilterpairs"}': 7,
+			})
+
+
+class DateRangeTest(unittest.TestCase):
+	def Dates(self, date=None, start=None, end=None, incremental=False):
+		args = argparse.Namespace(date=date, start_date=start, end_date=end, incremental=incremental)
+		return ProcessData.DateRange(args, logging.getLogger("dates"))
+
+	def test_ranges(self):
+		day = datetime.date(2024, 2, 28)
+		self.assertEqual(self.Dates(date=day), [day])
+		self.assertEqual(self.Dates(start=day, end=day), [day])
+		self.assertEqual(self.Dates(start=day, end=datetime.date(2024, 3, 1)), [day, datetime.date(2024, 2, 29), datetime.date(2024, 3, 1)])
+		# --date takes precedence over --start-date/--end-date
+		self.assertEqual(self.Dates(date=day, start=datetime.date(2024, 1, 1), end=datetime.date(2024, 1, 5)), [day])
+		self.assertEqual(self.Dates(incremental=True), [datetime.date.today()])
+		self.assertEqual(self.Dates(date=day, incremental=True), [day])
+
+	def test_invalid(self):
+		day = datetime.date(2024, 2, 28)
+		for options in ({'start': day, 'end': day - datetime.timedelta(days=1)}, {'start': day}, {'end': day}, {}, {'start': day, 'end': day, 'incremental': True}):
+			with self.assertRaises(SystemExit), self.assertLogs("dates", "CRITICAL"):
+				self.Dates(**options)
+
+
+class PipelineTest(unittest.TestCase):
+	def test_days_overlap_and_write_in_order(self):
+		dates = [datetime.date(2024, 1, day) for day in (1, 2, 3)]
+		acquired = {date: threading.Event() for date in dates}
+		processing = {date: threading.Event() for date in dates}
+		events = []
+		lock = threading.Lock()
+		def Record(*event):
+			with lock:
+				events.append(event)
+
+		def Acquire(date):
+			Record("acquire", date)
+			acquired[date].set()
+			return {'date': date}
+
+		def Process(date, day):
+			processing[date].set()
+			Record("process", date)
+			# The next day is acquired while this one is processed
+			if date != dates[-1]:
+				self.assertTrue(acquired[dates[dates.index(date) + 1]].wait(5))
+			return f"result {date}"
+
+		def Write(date, day, result):
+			# The next day is processed while this one is written
+			if date != dates[-1]:
+				self.assertTrue(processing[dates[dates.index(date) + 1]].wait(5))
+			Record("write", date, day['date'], result)
+
+		ProcessData.RunPipeline(dates, Acquire, Process, Write)
+		self.assertEqual([event[1:] for event in events if event[0] == "write"], [(date, date, f"result {date}") for date in dates])
+		self.assertEqual([event[1] for event in events if event[0] == "acquire"], dates)
+		for date in dates:
+			self.assertLess(events.index(("process", date)), events.index(("write", date, date, f"result {date}")))
+
+	def test_skipped_days(self):
+		# Days without data are not processed, days without a result are not written
+		dates = [datetime.date(2024, 1, day) for day in (1, 2, 3, 4)]
+		processed, written = [], []
+		Acquire = lambda date: None if date.day == 2 else date
+		def Process(date, day):
+			processed.append(date)
+			return None if date.day == 3 else date
+		ProcessData.RunPipeline(dates, Acquire, Process, lambda date, day, result: written.append(result))
+		self.assertEqual(processed, [dates[0], dates[2], dates[3]])
+		self.assertEqual(written, [dates[0], dates[3]])
+
+	def test_write_error_stops_the_run(self):
+		dates = [datetime.date(2024, 1, day) for day in (1, 2, 3)]
+		processed = []
+		def Write(date, day, result):
+			raise RuntimeError(f"write of {date} failed")
+		def Process(date, day):
+			processed.append(date)
+			return date
+		with self.assertRaisesRegex(RuntimeError, "2024-01-01"):
+			ProcessData.RunPipeline(dates, lambda date: date, Process, Write)
+		self.assertEqual(processed, dates[:2])
+
+
+class IncrementalTest(unittest.TestCase):
+	def test_bus_windows(self):
+		day, nextDay = datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)
+		at = lambda hour, minute=0: datetime.datetime(2024, 1, 1, hour, minute)
+		database = RecordingDatabase([[
+			("A", at(10), at(10, 30)),  # corrected up to 10:00, new rows after it
+			("B", at(10), at(6)),  # late row older than the watermark
+			("C", None, at(7)),  # never corrected
+			("D", at(10), at(9, 50)),  # late row inside the overlap
+		]])
+		windows = BusData.BusWindows(database, day, nextDay, datetime.timedelta(minutes=15))
+		self.assertEqual(windows, {"A": at(9, 45), "B": at(6), "C": at(0), "D": at(9, 45)})
+		self.assertEqual(database.statements, [BusData.BUS_WATERMARK_QUERY])
+		self.assertEqual(database.params, [(day, nextDay)])
+
+	def test_window_queries(self):
+		day, nextDay = datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)
+		windows = {"A": datetime.datetime(2024, 1, 1, 9, 45), "C": datetime.datetime(2024, 1, 1)}
+		database = RecordingDatabase([[("A", 40), ("C", 12)], [("A", ["100", "101"])]])
+		self.assertEqual(BusData.WindowSizes(database, windows, day, nextDay), [("A", 40), ("C", 12)])
+		self.assertEqual(BusData.WindowLines(database, windows, day, nextDay), {"A": {"100", "101"}})
+		self.assertEqual(database.statements, [BusData.BUS_WINDOW_SIZE_QUERY, BusData.BUS_WINDOW_LINES_QUERY])
+		# Bus ids and window starts are sent as aligned arrays
+		for params in database.params:
+			buses, since, start, end = params
+			self.assertEqual(dict(zip(buses, since)), windows)
+			self.assertEqual((start, end), (day, nextDay))
+
+	def test_write_back_only_new_rows(self):
+		city = City(2, lines=1, pointsPerBus=10, seed=2)
+		lineDetected = np.full(len(city.busTrajectories.coordinates), "No_line", dtype=object)
+		for incremental, update in ((False, BusData.BUS_CORRECTION_UPDATE), (True, BusData.BUS_CORRECTION_UPDATE_NEW)):
+			database = RecordingDatabase()
+			BusData.WriteLineDetected(database, city.busTrajectories, city.busTimestamps, lineDetected, city.date, city.date, incremental=incremental)
+			self.assertEqual(database.statements[-1], update)
 
 
-exit(0)
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,179 @@
+#
+# synthetic_city.py
+# Description:
+#	Synthetic city generator for the benchmarks. Lines are random walks over a street grid around a
+#	center, sampled like line_data shapes, direction '1' being the reverse of direction '0'. Buses run
+#	back and forth along their line with GPS noise, outliers, stops, deadhead stretches (no line) and
+#	occasional line switches between trips, as the bus_data rows of one day.
+#
+
+import datetime
+
+import numpy as np
+
+from data_processing.Trajectories import LineShapes, Trajectories
+
+METERS_PER_DEGREE = 111320.0
+
+# Rio de Janeiro
+DEFAULT_CENTER = (-22.9, -43.3)
+
+
+class City:
+	"""
+	Arguments:
+		buses - amount of buses
+		lines - amount of lines (two directions each), defaults to one line per 8 buses
+		pointsPerBus - average amount of GPS points of each bus (between half and the full amount)
+		seed - random seed, the same arguments always generate the same city
+		center - (lat, lon) of the city center
+		extent - side (meters) of the square holding every line
+		lineLength - (min, max) length (meters) of the lines
+		lineSpacing - distance (meters) between line shape points
+		interval - seconds between GPS points
+		speed - average speed (m/s) of a moving bus
+		stopProbability - probability of a bus being stopped at a GPS point
+		gpsNoise - standard deviation (meters) of the GPS error
+		outlierProbability, outlierDistance - probability and distance (meters) of GPS outliers
+		deadheadProbability - probability of a bus driving off route (no line) between trips
+		switchProbability - probability of a bus switching to another line between trips
+		wrongReportProbability - probability of a wrong or empty line_reported on a point
+	Attributes:
+		lineShapes - LineShapes of every line, ids are (line_id, direction)
+		busTrajectories - Trajectories of every bus, ids are bus_id
+		busTimestamps - time_detection of every bus point, aligned with busTrajectories.coordinates
+		busReported - line_reported of every bus point
+		truth - line the bus was running on each point, None on deadhead stretches
+	"""
+	def __init__(self, buses, lines=None, pointsPerBus=400, seed=0, center=DEFAULT_CENTER, extent=30000,
+			lineLength=(8000, 25000), lineSpacing=25, interval=60, speed=7, stopProbability=0.2, gpsNoise=10,
+			outlierProbability=0.005, outlierDistance=1000, deadheadProbability=0.1, switchProbability=0.05,
+			wrongReportProbability=0.05, date=datetime.date(2024, 1, 1)):
+		self.rng = np.random.default_rng(seed)
+		self.center = np.asarray(center, dtype=float)
+		self.extent = extent
+		self.interval = interval
+		self.speed = speed
+		self.stopProbability = stopProbability
+		self.date = date
+
+		lines = max(1, buses // 8) if lines is None else lines
+		self.lineIds = [f"{100 + line}" for line in range(lines)]
+		self.routes = [self.route(self.rng.uniform(*lineLength), lineSpacing) for _ in range(lines)]
+		shapes, ids = [], []
+		for lineId, route in zip(self.lineIds, self.routes):
+			shapes += [self.toDegrees(route), self.toDegrees(route[::-1])]
+			ids += [(lineId, "0"), (lineId, "1")]
+		self.lineShapes = LineShapes.fromTrajectories(Trajectories.fromArrays(shapes, ids))
+
+		paths, truth = [], []
+		for _ in range(buses):
+			points = int(self.rng.integers(pointsPerBus // 2, pointsPerBus + 1))
+			path, labels = self.busPath(points, deadheadProbability, switchProbability)
+			paths.append(path)
+			truth.append(labels)
+		busIds = [f"B{bus:05d}" for bus in range(buses)]
+
+		coordinates = np.concatenate(paths) if buses else np.zeros((0, 2))
+		coordinates = coordinates + self.rng.normal(0, gpsNoise, coordinates.shape)
+		outliers = self.rng.random(len(coordinates)) < outlierProbability
+		coordinates[outliers] += self.rng.normal(0, outlierDistance, (np.sum(outliers), 2))
+		lengths = [len(path) for path in paths]
+		self.busTrajectories = Trajectories.fromArrays(np.split(self.toDegrees(coordinates), np.cumsum(lengths)[:-1]) if buses else [], busIds)
+
+		self.truth = np.array([label for labels in truth for label in labels], dtype=object)
+		self.busReported = np.where(self.truth == None, "", self.truth).astype(object)
+		wrong = self.rng.random(len(self.truth)) < wrongReportProbability
+		self.busReported[wrong] = self.rng.choice(self.lineIds + [""], np.sum(wrong))
+		self.busReported = self.busReported.astype(str)
+
+		start = np.datetime64(datetime.datetime.combine(date, datetime.time(5)), "us")
+		firstPoint = self.rng.integers(0, 3 * 3600, buses) if buses else np.zeros(0, dtype=np.int64)
+		seconds = np.concatenate([first + np.arange(length) * interval for first, length in zip(firstPoint, lengths)]) if buses else np.zeros(0)
+		self.busTimestamps = start + seconds.astype("timedelta64[s]")
+
+	def toDegrees(self, points):
+		"""
+		(north, east) meters from the center to (lat, lon) degrees
+		"""
+		lat = self.center[0] + points[:, 0] / METERS_PER_DEGREE
+		lon = self.center[1] + points[:, 1] / (METERS_PER_DEGREE * np.cos(np.radians(self.center[0])))
+		return np.column_stack((lat, lon))
+
+	def route(self, length, spacing):
+		"""
+		Random walk over the street grid, turning at the end of each block and kept inside the extent.
+		Returns (points, north/east) meters sampled every <spacing> meters
+		"""
+		half = self.extent / 2
+		corners = [self.rng.uniform(-half, half, 2)]
+		heading = self.rng.integers(4)
+		travelled = 0
+		while travelled < length:
+			heading = (heading + self.rng.choice([-1, 0, 0, 1])) % 4
+			block = min(self.rng.uniform(300, 1500), length - travelled)
+			step = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]][heading], dtype=float)
+			corner = corners[-1] + step * block
+			if np.any(np.abs(corner) > half):
+				# Turns back at the city limits
+				heading = (heading + 2) % 4
+				corner = corners[-1] - step * block
+			corners.append(corner)
+			travelled += block
+		corners = np.array(corners)
+		arc = np.concatenate(([0], np.cumsum(np.linalg.norm(np.diff(corners, axis=0), axis=1))))
+		positions = np.linspace(0, arc[-1], max(2, int(arc[-1] // spacing) + 1))
+		return np.column_stack((np.interp(positions, arc, corners[:, 0]), np.interp(positions, arc, corners[:, 1])))
+
+	def busPath(self, points, deadheadProbability, switchProbability):
+		"""
+		Returns the (points, north/east) meters of one bus and the line of each point
+		"""
+		line = int(self.rng.integers(len(self.routes)))
+		reverse = bool(self.rng.integers(2))
+		path, labels = [], []
+		while len(labels) < points:
+			if self.rng.random() < deadheadProbability:
+				# Off route towards the start of the next trip
+				start = path[-1][-1] if path else self.rng.uniform(-self.extent / 2, self.extent / 2, 2)
+				target = self.routes[line][-1 if reverse else 0]
+				steps = self.steps(np.linalg.norm(target - start), points - len(labels))
+				fraction = steps / max(steps[-1], 1)
+				path.append(start + fraction[:, None] * (target - start))
+				labels += [None] * len(steps)
+				continue
+
+			route = self.routes[line][::-1] if reverse else self.routes[line]
+			arc = np.concatenate(([0], np.cumsum(np.linalg.norm(np.diff(route, axis=0), axis=1))))
+			steps = self.steps(arc[-1], points - len(labels))
+			path.append(np.column_stack((np.interp(steps, arc, route[:, 0]), np.interp(steps, arc, route[:, 1]))))
+			labels += [self.lineIds[line]] * len(steps)
+
+			reverse = not reverse
+			if self.rng.random() < switchProbability:
+				line = int(self.rng.integers(len(self.routes)))
+		return np.concatenate(path)[:points], labels[:points]
+
+	def steps(self, distance, maxPoints):
+		"""
+		Distance travelled at each GPS point over a trip of <distance> meters, at most <maxPoints> points
+		"""
+		moving = self.rng.random(maxPoints) >= self.stopProbability
+		travelled = np.cumsum(moving * self.rng.uniform(0.5, 1.5, maxPoints) * self.speed * self.interval)
+		travelled = np.concatenate(([0], travelled[:-1]))
+		return np.minimum(travelled[:max(1, np.searchsorted(travelled, distance) + 1)], distance)
+
+	def rows(self):
+		"""
+		Returns the bus_data columns (bus_id, time_detection, latitude, longitude, line_reported) ordered by bus and time
+		"""
+		busIds = np.repeat(np.array(self.busTrajectories.ids, dtype=object), self.busTrajectories.lengths)
+		coordinates = self.busTrajectories.coordinates.astype(float)
+		return busIds, self.busTimestamps, coordinates[:, 0], coordinates[:, 1], self.busReported
+
+	def busSizeList(self):
+		"""
+		Returns (bus_id, points) of every bus ordered by size, as the bus count query
+		"""
+		sizes = list(zip(self.busTrajectories.ids, self.busTrajectories.lengths.tolist()))
+		return sorted(sizes, key=lambda size: -size[1])